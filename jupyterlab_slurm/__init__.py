@@ -8,7 +8,7 @@ except ImportError:
     warnings.warn("Importing 'jupyterlab_slurm' outside a proper installation.")
     __version__ = "dev"
 
-from .config import SlurmCommandPaths
+from .config import SlurmCommandPaths, redact_settings
 from .handlers import setup_handlers
 
 
@@ -36,10 +36,10 @@ def _load_jupyter_server_extension(server_app):
     name = "jupyterlab_slurm"
     server_app.log.info(f"Registered {name} server extension")
     slurm_commands = SlurmCommandPaths(parent=server_app)
-    server_app.log.info(slurm_commands.get_paths())
+    server_app.log.info(redact_settings(slurm_commands.get_settings()))
 
     web_app = server_app.web_app
-    web_app.settings.update(slurm_commands.get_paths())
+    web_app.settings.update(slurm_commands.get_settings())
 
     temporary_directory = web_app.settings['temporary_directory'] if 'temporary_directory' in web_app.settings else None
     #server_app.log.addHandler(logging.FileHandler('/tmp/jupyter_debug'))
@@ -0,0 +1,511 @@
+import asyncio
+import getpass
+import http.client
+import json
+import logging
+import os
+import select
+import shlex
+import socket
+import tempfile
+import urllib.parse
+
+from .cache import SnapshotCache
+from .commands import (SQUEUE_OUTPUT_FORMAT, CommandBusy, CommandRunner, query_squeue, query_squeue_structured,
+                       squeue_command, squeue_succeeded)
+from .joboutput import parse_scontrol_output
+from .jobtable import JOB_STATE_CODES, JobTable, job_ids, job_states, number
+from .snapshot import SqueueSnapshot, cluster_row_key
+
+logger = logging.Logger(__file__)
+
+# batch scripts received larger than this are spooled to a temporary file rather than held in memory
+SCRIPT_SPOOL_THRESHOLD = 1024 * 1024
+
+# requests that may be sent again when a keep-alive connection turns out to be closed: resending a job submission
+# slurmrestd already accepted would submit the job twice
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+# the environment jobs submitted through slurmrestd get, from the server's: not all of it, as the server's holds
+# tokens (SLURM_JWT, Jupyter's) that would otherwise be stored with every job
+SUBMIT_ENVIRONMENT = ("PATH", "HOME", "USER", "LOGNAME", "SHELL", "LANG", "LC_ALL", "TZ")
+
+
+# A batch script received a piece at a time, e.g. from a streamed request body. It is kept in memory and piped to
+# sbatch, and only moved to a temporary file (in dir) once it grows past max_size.
+class ScriptSpool:
+    def __init__(self, max_size: int = SCRIPT_SPOOL_THRESHOLD, dir: str = None):
+        self.max_size = max_size
+        self.dir = dir
+        self.size = 0
+        self._buffer = bytearray()
+        self._file = None
+
+    def __str__(self):
+        return "<batch script, {} bytes>".format(self.size)
+
+    @property
+    def in_memory(self):
+        return self._file is None
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self._file is None and self.size > self.max_size:
+            self._file = tempfile.TemporaryFile(mode='w+b', dir=self.dir)
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._buffer += data
+
+    def getvalue(self):
+        if self._file is None:
+            return bytes(self._buffer)
+        self._file.seek(0)
+        return self._file.read()
+
+    def fileno(self):
+        """A descriptor to read the spooled script from, from its start."""
+        self._file.flush()
+        self._file.seek(0)
+        return self._file.fileno()
+
+    def close(self):
+        self._buffer = bytearray()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# How the handlers talk to Slurm. Every backend returns command style results ({"stdout", "stderr", "returncode"}),
+# with errors for individual jobs reported on stderr lines naming the job ID, so the handlers don't need to know
+# which backend they are using.
+class SlurmBackend:
+    def squeue_key(self, user_only: bool):
+        """A hashable key identifying the squeue query, for the snapshot cache."""
+        raise NotImplementedError()
+
+    async def squeue(self, user_only: bool) -> SqueueSnapshot:
+        raise NotImplementedError()
+
+    async def sbatch(self, script=None, path: str = None, cwd: str = None) -> dict:
+        """Submit a script, given as its contents (str, bytes or a ScriptSpool) or a path to it."""
+        raise NotImplementedError()
+
+    async def job_command(self, command: str, args: list, jobIDs: list) -> dict:
+        """Run scancel or scontrol <action> on a list of jobs."""
+        raise NotImplementedError()
+
+    async def show_job(self, jobID: str) -> dict:
+        """scontrol show job: the command result, with the job's records (one per array task) as "records",
+        dicts keyed as in scontrol's output (JobId, JobState, StdOut, ...)."""
+        raise NotImplementedError()
+
+    def invalidate(self):
+        """Forget any queue state the backend caches itself, called after jobs were submitted or changed."""
+        pass
+
+
+# The Slurm command line tools, run through a CommandRunner. squeue_format is "text" for the fixed width squeue
+# output, or "json"/"yaml" for squeue --json/--yaml (Slurm 21.08 or later). With cluster, every command is run with
+# -M <cluster> to address that cluster of a multi-cluster setup.
+class CLIBackend(SlurmBackend):
+    def __init__(self, paths: dict = None, runner: CommandRunner = None, squeue_format: str = "text",
+                 cluster: str = None, log=logger):
+        self.paths = dict(paths or {})
+        self.squeue_format = squeue_format
+        self.cluster = cluster
+        self._runner = runner if runner is not None else CommandRunner(log=log)
+        self._serverlog = log
+
+    def path(self, command: str):
+        if self.cluster is not None:
+            return "{} -M {}".format(self.paths.get(command, command), shlex.quote(self.cluster))
+        return self.paths.get(command, command)
+
+    def squeue_key(self, user_only: bool):
+        if self.squeue_format != "text":
+            return self.path("squeue"), user_only, self.squeue_format
+        return self.path("squeue"), user_only, SQUEUE_OUTPUT_FORMAT
+
+    async def squeue(self, user_only: bool):
+        if self.squeue_format != "text":
+            return await query_squeue_structured(self.path("squeue"), user_only, self._runner, self.squeue_format)
+        return await query_squeue(squeue_command(self.path("squeue"), user_only), self._runner)
+
+    async def sbatch(self, script=None, path: str = None, cwd: str = None):
+        if path is not None:
+            return await self._runner.run("{} {}".format(self.path("sbatch"), shlex.quote(path)), cwd=cwd)
+
+        # the script is piped to sbatch's stdin, only scripts already spooled to disk are read from their file
+        if isinstance(script, ScriptSpool):
+            if not script.in_memory:
+                return await self._runner.run(self.path("sbatch"), stdin=script.fileno(), cwd=cwd)
+            script = script.getvalue()
+        if isinstance(script, str):
+            script = script.encode()
+        return await self._runner.run(self.path("sbatch"), cwd=cwd, input=script)
+
+    async def job_command(self, command: str, args: list, jobIDs: list):
+        # scontrol hold/release take a comma separated job list, scancel a space separated one
+        separator = "," if command == "scontrol" else " "
+        return await self._runner.run("{} {} {}".format(self.path(command), " ".join(args), separator.join(jobIDs)))
+
+    async def show_job(self, jobID: str):
+        out = await self._runner.run("{} show job -o {}".format(self.path("scontrol"), jobID))
+        out["records"] = parse_scontrol_output(out["stdout"]) if out["returncode"] == 0 else []
+        return out
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self._socket_path)
+        self.sock = sock
+
+
+# A pool of persistent (keep-alive) HTTP connections to slurmrestd, over TCP (http://host:port) or a Unix socket
+# (unix:///path/to/socket). http.client is blocking, so requests run on a thread per pooled connection and at most
+# max_connections requests are in flight at once.
+class SlurmrestdClient:
+    def __init__(self, url: str, max_connections: int = 8, timeout: float = 60.0, headers: dict = None):
+        self.url = urllib.parse.urlsplit(url)
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self._idle = []
+        self._slots = None
+        self._max_connections = max_connections
+
+    def _connect(self):
+        if self.url.scheme == "unix":
+            return UnixHTTPConnection(self.url.path, timeout=self.timeout)
+        if self.url.scheme == "https":
+            return http.client.HTTPSConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+
+    def _request(self, connection, method: str, path: str, body: bytes):
+        headers = dict(self.headers)
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    @staticmethod
+    def _dropped(connection):
+        # an idle connection with something to read has been closed by the server (or is out of step with it)
+        if connection.sock is None:
+            return False
+        try:
+            return bool(select.select([connection.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def _idle_connection(self):
+        while self._idle:
+            connection = self._idle.pop()
+            if not self._dropped(connection):
+                return connection
+            connection.close()
+        return self._connect()
+
+    def _pooled_request(self, method: str, path: str, body: bytes):
+        connection = self._idle_connection()
+        try:
+            try:
+                result = self._request(connection, method, path, body)
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # the server closed an idle keep-alive connection as it was reused. Retry once on a fresh one, but
+                # only requests that can be repeated: others may have been carried out, and fail instead
+                if method not in IDEMPOTENT_METHODS:
+                    raise
+                connection.close()
+                connection = self._connect()
+                result = self._request(connection, method, path, body)
+        except BaseException:
+            connection.close()
+            raise
+        self._idle.append(connection)
+        return result
+
+    async def request(self, method: str, path: str, data: dict = None):
+        """Returns (HTTP status, decoded JSON body)."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_connections)
+        body = json.dumps(data).encode() if data is not None else None
+        async with self._slots:
+            status, content = await asyncio.get_running_loop().run_in_executor(
+                None, self._pooled_request, method, path, body)
+        return status, json.loads(content) if content else {}
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+def expand_filename_pattern(pattern: str, job: dict):
+    # the sbatch --output/--error patterns slurmrestd returns unexpanded, scontrol expands them
+    jobid, job_id, task_id = job_ids(job)
+    replacements = {
+        "%%": "%", "%A": str(job_id), "%a": str(task_id) if "_" in jobid else "4294967294",
+        "%j": str(job.get("job_id")), "%u": job.get("user_name", ""), "%x": job.get("name", ""),
+        "%N": (job.get("batch_host") or "")
+        }
+    expanded = []
+    i = 0
+    while i < len(pattern):
+        token = pattern[i:i + 2]
+        if token in replacements:
+            expanded.append(replacements[token])
+            i += 2
+        else:
+            expanded.append(pattern[i])
+            i += 1
+    return "".join(expanded)
+
+
+def scontrol_record(job: dict):
+    """A slurmrestd job as the main fields of an scontrol show job record."""
+    states = job_states(job)
+    workdir = job.get("current_working_directory", "")
+    default_output = os.path.join(workdir, "slurm-%A_%a.out" if number(job.get("array_job_id")) else "slurm-%j.out")
+    stdout = job.get("standard_output") or default_output
+    stderr = job.get("standard_error") or stdout
+    array_task_id = number(job.get("array_task_id"))
+    return {
+        "JobId": str(job.get("job_id")),
+        "ArrayJobId": str(number(job.get("array_job_id")) or ""),
+        "ArrayTaskId": str(array_task_id) if array_task_id is not None else job.get("array_task_string", ""),
+        "JobName": job.get("name", ""),
+        "UserId": job.get("user_name", ""),
+        "Partition": job.get("partition", ""),
+        "JobState": next((state for state in states if state in JOB_STATE_CODES), states[0] if states else ""),
+        "Reason": job.get("state_reason", ""),
+        "NodeList": job.get("nodes", ""),
+        "NumNodes": str(number(job.get("node_count")) or ""),
+        "WorkDir": workdir,
+        "Command": job.get("command", ""),
+        "StdOut": expand_filename_pattern(stdout, job),
+        "StdErr": expand_filename_pattern(stderr, job)
+        }
+
+
+def read_script(path: str):
+    with open(path) as f:
+        return f.read()
+
+
+def rest_errors(response: dict):
+    return [error.get("description") or error.get("error") or str(error) for error in response.get("errors", [])]
+
+
+# slurmrestd, the Slurm REST API, over a pooled HTTP client: no fork/exec per request
+class SlurmrestdBackend(SlurmBackend):
+    def __init__(self, url: str, api_version: str = "v0.0.40", token: str = None, user: str = None,
+                 max_connections: int = 8, timeout: float = 60.0, log=logger):
+        self.url = url
+        self.api_version = api_version
+        self.user = user or getpass.getuser()
+        headers = {"X-SLURM-USER-NAME": self.user}
+        token = token or os.environ.get("SLURM_JWT")
+        if token:
+            headers["X-SLURM-USER-TOKEN"] = token
+        self._client = SlurmrestdClient(url, max_connections=max_connections, timeout=timeout, headers=headers)
+        self._serverlog = log
+
+    def endpoint(self, *parts):
+        return "/" + "/".join(["slurm", self.api_version] + [urllib.parse.quote(str(part)) for part in parts])
+
+    async def _request(self, method: str, path: str, data: dict = None):
+        self._serverlog.debug("SlurmrestdBackend: %s %s", method, path)
+        try:
+            return await self._client.request(method, path, data)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self._serverlog.exception(e)
+            return None, {"errors": [{"description": "slurmrestd request failed: {}".format(e)}]}
+
+    def squeue_key(self, user_only: bool):
+        return "slurmrestd", self.url, user_only
+
+    async def squeue(self, user_only: bool):
+        status, response = await self._request("GET", self.endpoint("jobs"))
+        errors = rest_errors(response)
+        if status != 200 or errors:
+            return SqueueSnapshot([], {
+                "responseMessage": "Failure: slurmrestd jobs",
+                "returncode": 1,
+                "errorMessage": "\n".join(errors) or "HTTP {}".format(status)
+                })
+        table = JobTable.from_jobs(response.get("jobs", []), self.user if user_only else None)
+        return SqueueSnapshot(table.rows(), {
+            "responseMessage": "Success: slurmrestd jobs",
+            "returncode": 0,
+            "errorMessage": ""
+            }, table=table)
+
+    async def sbatch(self, script=None, path: str = None, cwd: str = None):
+        loop = asyncio.get_running_loop()
+        if path is not None:
+            try:
+                script = await loop.run_in_executor(None, read_script, os.path.join(cwd or "", path))
+            except OSError as e:
+                return {"stdout": "", "stderr": "Could not read {}: {}".format(path, e), "returncode": 1}
+        elif isinstance(script, ScriptSpool):
+            script = script.getvalue() if script.in_memory else await loop.run_in_executor(None, script.getvalue)
+        if isinstance(script, bytes):
+            script = script.decode()
+        status, response = await self._request("POST", self.endpoint("job", "submit"), {
+            "script": script,
+            "job": {
+                "current_working_directory": cwd or os.getcwd(),
+                "environment": ["{}={}".format(key, os.environ[key]) for key in SUBMIT_ENVIRONMENT
+                                if key in os.environ]
+                }
+            })
+        errors = rest_errors(response)
+        if status != 200 or errors:
+            return {"stdout": "", "stderr": "\n".join(errors) or "HTTP {}".format(status), "returncode": 1}
+        return {"stdout": "Submitted batch job {}".format(response.get("job_id")), "stderr": "", "returncode": 0}
+
+    async def _job_request(self, command: str, args: list, jobID: str):
+        if command == "scancel":
+            return await self._request("DELETE", self.endpoint("job", jobID))
+        if command == "scontrol" and args in (["hold"], ["release"]):
+            return await self._request("POST", self.endpoint("job", jobID), {"hold": args == ["hold"]})
+        return None, {"errors": [{"description": "{} {} is not supported by slurmrestd".format(
+            command, " ".join(args))}]}
+
+    async def job_command(self, command: str, args: list, jobIDs: list):
+        responses = await asyncio.gather(*[self._job_request(command, args, jobID) for jobID in jobIDs])
+        stderr = []
+        for jobID, (status, response) in zip(jobIDs, responses):
+            errors = rest_errors(response)
+            if status != 200 or errors:
+                stderr.append("job {}: {}".format(jobID, "; ".join(errors) or "HTTP {}".format(status)))
+        return {"stdout": "", "stderr": "\n".join(stderr), "returncode": 1 if stderr else 0}
+
+    async def show_job(self, jobID: str):
+        status, response = await self._request("GET", self.endpoint("job", jobID))
+        errors = rest_errors(response)
+        if status != 200 or errors:
+            return {"stdout": "", "stderr": "\n".join(errors) or "HTTP {}".format(status), "returncode": 1,
+                    "records": []}
+        return {"stdout": "", "stderr": "", "returncode": 0,
+                "records": [scontrol_record(job) for job in response.get("jobs", [])]}
+
+    def close(self):
+        self._client.close()
+
+
+class UnknownCluster(Exception):
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.message = "Unknown cluster {}".format(cluster)
+
+    def __str__(self):
+        return self.message
+
+
+# Several clusters behind one backend. squeue fans out to every cluster at once, each with its own snapshot cache
+# and timeout, and the rows are merged into one snapshot with a CLUSTER column. A cluster that fails or doesn't
+# answer in time only loses its own rows, or has its last snapshot served instead, and is reported in the status's
+# "clusters". Job commands go to the member named with member(), the first cluster by default.
+class FederatedBackend(SlurmBackend):
+    def __init__(self, members: dict, timeout: float = 10.0, cache_ttl: float = 5.0, cache_stale_ttl: float = 30.0,
+                 metrics=None, log=logger):
+        self.members = dict(members)
+        self.timeout = timeout
+        self._caches = {name: SnapshotCache(ttl=cache_ttl, stale_ttl=cache_stale_ttl, name="squeue@" + name,
+                                            metrics=metrics, log=log)
+                        for name in self.members}
+        self._serverlog = log
+
+    @property
+    def default_cluster(self):
+        return next(iter(self.members))
+
+    def member(self, cluster: str = None):
+        if cluster is None:
+            cluster = self.default_cluster
+        if cluster not in self.members:
+            raise UnknownCluster(cluster)
+        return self.members[cluster]
+
+    def squeue_key(self, user_only: bool):
+        return ("clusters",) + tuple(backend.squeue_key(user_only) for backend in self.members.values())
+
+    def invalidate(self):
+        for cache in self._caches.values():
+            cache.invalidate()
+
+    async def cluster_squeue(self, cluster: str, user_only: bool):
+        """(snapshot or None, status) of one cluster, never waiting longer than the timeout."""
+        backend = self.members[cluster]
+        cache = self._caches[cluster]
+        key = backend.squeue_key(user_only)
+        try:
+            # the cache shields the fetch, so a timed out squeue still finishes and is cached for the next request
+            snapshot = await asyncio.wait_for(
+                cache.get(key, lambda: backend.squeue(user_only), cacheable=squeue_succeeded), self.timeout)
+            if snapshot.succeeded:
+                return snapshot, snapshot.status
+            status = snapshot.status
+        except asyncio.TimeoutError:
+            status = {
+                "responseMessage": "Failure: squeue on {}".format(cluster),
+                "returncode": -1,
+                "errorMessage": "no answer within {} seconds".format(self.timeout)
+                }
+        except CommandBusy as busy:
+            status = {
+                "responseMessage": "Busy: squeue on {}".format(cluster),
+                "returncode": -1,
+                "errorMessage": busy.message
+                }
+        except Exception as e:
+            self._serverlog.exception(e)
+            status = {
+                "responseMessage": "Failure: squeue on {}".format(cluster),
+                "returncode": -1,
+                "errorMessage": "Unhandled Exception: {}".format(str(e))
+                }
+
+        self._serverlog.warning("FederatedBackend: {} {}".format(cluster, status["errorMessage"]))
+        cached = cache.peek(key)
+        return (cached.value if cached is not None else None), dict(status, stale=cached is not None)
+
+    async def squeue(self, user_only: bool):
+        clusters = list(self.members)
+        results = await asyncio.gather(*[self.cluster_squeue(cluster, user_only) for cluster in clusters])
+        data = []
+        statuses = {}
+        for cluster, (snapshot, status) in zip(clusters, results):
+            statuses[cluster] = status
+            if snapshot is not None:
+                data += [row + [cluster] for row in snapshot.data]
+
+        failed = [cluster for cluster in clusters if statuses[cluster]["returncode"] != 0]
+        answered = [cluster for cluster, (snapshot, _) in zip(clusters, results) if snapshot is not None]
+        return SqueueSnapshot(data, {
+            "responseMessage": "{}: squeue on {} of {} clusters".format(
+                "Success" if answered else "Failure", len(clusters) - len(failed), len(clusters)),
+            "returncode": 0 if answered else -1,
+            "errorMessage": "\n".join("{}: {}".format(cluster, statuses[cluster]["errorMessage"])
+                                      for cluster in failed),
+            "clusters": statuses
+            }, row_key=cluster_row_key)
+
+    async def sbatch(self, script=None, path: str = None, cwd: str = None):
+        return await self.member().sbatch(script=script, path=path, cwd=cwd)
+
+    async def job_command(self, command: str, args: list, jobIDs: list):
+        return await self.member().job_command(command, args, jobIDs)
+
+    async def show_job(self, jobID: str):
+        return await self.member().show_job(jobID)
@@ -0,0 +1,140 @@
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.Logger(__file__)
+
+
+class CacheEntry:
+    def __init__(self, value, timestamp: float):
+        self.value = value
+        self.timestamp = timestamp
+
+    @property
+    def age(self):
+        return time.monotonic() - self.timestamp
+
+
+# A process-wide cache of command output snapshots (e.g. squeue results), shared by every handler instance.
+#
+# Snapshots are fresh for `ttl` seconds. Once expired, a snapshot is still served for up to `stale_ttl` more
+# seconds while a single background refresh runs; past that, callers wait for the refresh. Concurrent callers for
+# the same key always share one in-flight fetch, so N open tabs cost one subprocess rather than N.
+#
+# The last `history` values stored for each key are kept so that clients can be sent changes since the version they
+# already have.
+#
+# Lookups are counted in metrics (a SlurmMetrics) under the cache's name, if given.
+class SnapshotCache:
+    def __init__(self, ttl: float = 5.0, stale_ttl: float = 30.0, history: int = 0, name: str = "snapshot",
+                 metrics=None, log=logger):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.name = name
+        self._metrics = metrics
+        self._serverlog = log
+        self._snapshots = {}
+        self._history_size = history
+        self._history = {}
+        self._inflight = {}
+        # bumped by invalidate() so that fetches started before an invalidation are not stored
+        self._generation = 0
+
+    def peek(self, key):
+        return self._snapshots.get(key)
+
+    def history(self, key):
+        """Values previously stored for key, newest first. Unlike snapshots, history survives invalidate()."""
+        return list(self._history.get(key, ()))
+
+    def invalidate(self, key=None):
+        self._generation += 1
+        if key is None:
+            self._snapshots.clear()
+            self._inflight.clear()
+        else:
+            self._snapshots.pop(key, None)
+            self._inflight.pop(key, None)
+
+    async def get(self, key, fetch, cacheable=None, allow_stale=True):
+        """Return the snapshot value for key, calling the coroutine function fetch() at most once at a time.
+
+        cacheable is an optional predicate deciding whether a fetched value is stored, e.g. to avoid caching
+        failed commands. With allow_stale=False an expired snapshot is never returned, the caller waits for the
+        refresh instead.
+        """
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            age = snapshot.age
+            if age < self.ttl:
+                self._count("hit")
+                return snapshot.value
+            if allow_stale and age < self.ttl + self.stale_ttl:
+                self._count("stale")
+                self._refresh(key, fetch, cacheable)
+                return snapshot.value
+
+        self._count("shared" if key in self._inflight else "miss")
+        # shield the shared fetch so one cancelled request does not cancel it for every other waiter
+        return await asyncio.shield(self._refresh(key, fetch, cacheable))
+
+    def _count(self, result: str):
+        if self._metrics is not None:
+            self._metrics.cache_lookups.labels(self.name, result).inc()
+
+    def _refresh(self, key, fetch, cacheable):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(key, fetch, cacheable, self._generation))
+            future.add_done_callback(lambda f: self._done(key, f))
+            self._inflight[key] = future
+        return future
+
+    async def _fetch(self, key, fetch, cacheable, generation):
+        value = await fetch()
+        if generation == self._generation and (cacheable is None or cacheable(value)):
+            self._snapshots[key] = CacheEntry(value, time.monotonic())
+            if self._history_size > 0:
+                self._history.setdefault(key, collections.deque(maxlen=self._history_size)).appendleft(value)
+        return value
+
+    def _done(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        # background refreshes may have no waiter left to retrieve their exception
+        if not future.cancelled() and future.exception() is not None:
+            self._serverlog.error("SnapshotCache refresh failed: {}".format(future.exception()))
+
+
+# A bounded, least recently used map of job ID -> value (e.g. the job's parsed scontrol show job records). Each value
+# is stored with a fingerprint of the job, e.g. its state and nodes in the squeue snapshot, and is only returned to
+# callers with the same fingerprint, so an entry lives until the job changes or it is evicted.
+class JobDetailCache:
+    def __init__(self, max_entries: int = 1024, name: str = "job_detail", metrics=None):
+        self.max_entries = max_entries
+        self.name = name
+        self._metrics = metrics
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, jobID: str, fingerprint):
+        entry = self._entries.get(jobID)
+        if entry is None or fingerprint is None or entry[0] != fingerprint:
+            self._count("miss")
+            return None
+        self._entries.move_to_end(jobID)
+        self._count("hit")
+        return entry[1]
+
+    def put(self, jobID: str, fingerprint, value):
+        self._entries[jobID] = (fingerprint, value)
+        self._entries.move_to_end(jobID)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _count(self, result: str):
+        if self._metrics is not None:
+            self._metrics.cache_lookups.labels(self.name, result).inc()
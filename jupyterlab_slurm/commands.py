@@ -0,0 +1,344 @@
+import asyncio
+import collections
+import contextlib
+import html
+import logging
+import os
+import shlex
+import time
+
+from .jobtable import JobTable, decode_jobs
+from .snapshot import SqueueSnapshot
+
+logger = logging.Logger(__file__)
+
+# squeue -h automatically removes the header row -o <format string> ensures that the output is in a
+# format expected by the extension Hard-coding this is not great -- ideally we would allow the user to
+# customize this, or have the default output be the user's output
+SQUEUE_OUTPUT_FORMAT = '-o "%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R" -h'
+
+# longest line accepted from a streamed command, squeue reasons can be long
+STREAM_LINE_LIMIT = 1024 * 1024
+
+# seconds a command may run, and seconds it gets to exit after SIGTERM before it is sent SIGKILL
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_KILL_GRACE = 5.0
+
+
+class CommandTimeout(Exception):
+    def __init__(self, command, timeout):
+        self.command = command
+        self.timeout = timeout
+        self.message = "{} timed out after {} seconds".format(command, timeout)
+
+    def __str__(self):
+        return self.message
+
+
+async def terminate(process, kill_grace: float = DEFAULT_KILL_GRACE, log=logger):
+    """SIGTERM the process, SIGKILL it if still running after kill_grace seconds, and always reap it."""
+    if process.returncode is None:
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), timeout=kill_grace)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            log.warning("terminate(): pid %d ignored SIGTERM, killing it", process.pid)
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+    await process.wait()
+
+
+async def wait_or_terminate(process, awaitable, command: str, timeout: float, kill_grace: float, log=logger):
+    # a timed out (or cancelled) command is killed and reaped rather than left running with its pipes open
+    try:
+        return await asyncio.wait_for(awaitable, timeout=timeout)
+    except asyncio.TimeoutError:
+        log.error("%s timed out after %s seconds", command, timeout)
+        await terminate(process, kill_grace, log)
+        raise CommandTimeout(command_name(command), timeout)
+    except BaseException:
+        await terminate(process, kill_grace, log)
+        raise
+
+
+# stdin is a file descriptor to read from, or input the bytes written to the command's stdin through a pipe
+async def run_command(command: str = None, stdin=None, cwd=None, timeout: float = DEFAULT_TIMEOUT,
+                      kill_grace: float = DEFAULT_KILL_GRACE, input: bytes = None, log=logger):
+    log.debug("run_command(): %s, cwd: %s", command, cwd)
+    commands = shlex.split(command)
+    process = await asyncio.create_subprocess_exec(*commands,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE,
+                                                   stdin=asyncio.subprocess.PIPE if input is not None else stdin,
+                                                   cwd=cwd)
+    stdout, stderr = await wait_or_terminate(process, process.communicate(input), command, timeout, kill_grace,
+                                             log)
+    # decode stdout and from bytes to str, and return stdout, stderr, and returncode
+    return {
+        "stdout": stdout.decode().strip(),
+        "stderr": stderr.decode().strip(),
+        "returncode": process.returncode,
+        "bytes": len(stdout)
+        }
+
+
+def squeue_command(squeue: str, user_only: bool, output_formatting: str = SQUEUE_OUTPUT_FORMAT):
+    if user_only:
+        return "{} -u {} {}".format(squeue, os.environ["USER"], output_formatting)
+    return "{} {}".format(squeue, output_formatting)
+
+
+def parse_squeue_row(row: str):
+    # maxsplit=7 so we can still display squeue entries with final columns with spaces like the
+    # following: (burst_buffer/cray: dws_data_in: DataWarp REST API error: offline namespaces: [34831] -
+    # ask a system administrator to consult the dwmd log for more information
+    entries = row.split(maxsplit=7)
+    if len(entries) == 8:
+        # html.escape because some job ID's might have '<'s and similar characters in them.
+        # Also, hypothetically we could be Bobbytable'd without html.escape here,
+        # e.g. if someone had as a jobname '<script>virus.js</script>'.
+        return [(html.escape(entry)).strip() for entry in entries]
+    return None
+
+
+def parse_squeue_output(stdout: str):
+    data_list = []
+    for row in stdout.splitlines():
+        entries = parse_squeue_row(row)
+        if entries is not None:
+            data_list.append(entries)
+    return data_list
+
+
+# Like run_command(), but stdout is read and handed to parse_line() a line at a time instead of being buffered
+# whole, so large outputs (squeue for every user) never exist in memory as one bytes and one str copy
+async def run_command_lines(command: str, parse_line, timeout: float = DEFAULT_TIMEOUT,
+                            kill_grace: float = DEFAULT_KILL_GRACE, log=logger):
+    log.debug("run_command_lines(): %s", command)
+    process = await asyncio.create_subprocess_exec(*shlex.split(command),
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE,
+                                                   limit=STREAM_LINE_LIMIT)
+
+    nbytes = 0
+
+    async def read_stdout():
+        nonlocal nbytes
+        async for line in process.stdout:
+            nbytes += len(line)
+            parse_line(line.decode())
+
+    # stderr is drained concurrently so a chatty command can't block on a full pipe
+    _, stderr = await wait_or_terminate(process, asyncio.gather(read_stdout(), process.stderr.read()),
+                                        command, timeout, kill_grace, log)
+    await process.wait()
+    return {
+        "stderr": stderr.decode().strip(),
+        "returncode": process.returncode,
+        "bytes": nbytes
+        }
+
+
+# runs squeue and packages the parsed rows with the command status into a snapshot, the unit of data cached and
+# shared between squeue requests
+async def query_squeue(exec_command: str, runner: "CommandRunner"):
+    data_list = []
+    # lines that aren't squeue rows are kept for the failure message
+    other_lines = []
+
+    def parse_line(line):
+        entries = parse_squeue_row(line)
+        if entries is not None:
+            data_list.append(entries)
+        elif len(other_lines) < 20:
+            other_lines.append(line.strip())
+
+    out = await runner.run_lines(exec_command, parse_line)
+
+    returncode = out["returncode"]
+    cmd_stdout = "\n".join(line for line in other_lines if line)
+
+    cmd_stderr = ""
+    if "stderr" in out and len(out["stderr"].strip()) > 0:
+        cmd_stderr = out["stderr"]
+
+    if returncode != 0:
+        responseMessage = "Failure: {} {}".format(exec_command, cmd_stdout)
+        errorMessage = cmd_stderr
+    else:
+        responseMessage = "Success: {}".format(exec_command)
+        errorMessage = ""
+
+    return SqueueSnapshot(data_list, {
+        "responseMessage": responseMessage,
+        "returncode": returncode,
+        "errorMessage": errorMessage
+        })
+
+
+# runs squeue --json (or --yaml) and builds the snapshot from the decoded jobs instead of the fixed width text, so
+# long names and reasons with spaces come through whole
+async def query_squeue_structured(squeue: str, user_only: bool, runner: "CommandRunner", output_format: str = "json"):
+    user = os.environ["USER"] if user_only else None
+    exec_command = "{} --{}".format(squeue, output_format)
+    if user is not None:
+        exec_command += " -u {}".format(user)
+
+    out = await runner.run(exec_command)
+    returncode = out["returncode"]
+    errors = []
+    table = JobTable()
+    if returncode == 0:
+        try:
+            jobs, errors = decode_jobs(out["stdout"], output_format)
+            # older Slurm versions ignore filters with --json, so the user is filtered here as well
+            table = JobTable.from_jobs(jobs, user)
+        except (ValueError, AttributeError) as e:
+            errors = ["Could not parse {} output: {}".format(exec_command, e)]
+        if errors:
+            returncode = 1
+
+    if returncode != 0:
+        responseMessage = "Failure: {}".format(exec_command)
+        errorMessage = "\n".join(errors) or out["stderr"]
+    else:
+        responseMessage = "Success: {}".format(exec_command)
+        errorMessage = ""
+
+    return SqueueSnapshot(table.rows(), {
+        "responseMessage": responseMessage,
+        "returncode": returncode,
+        "errorMessage": errorMessage
+        }, table=table)
+
+
+def squeue_succeeded(snapshot: SqueueSnapshot):
+    return snapshot.succeeded
+
+
+def command_name(command: str):
+    # e.g. "/usr/bin/squeue -h" -> "squeue"
+    return os.path.basename(shlex.split(command)[0])
+
+
+class CommandBusy(Exception):
+    def __init__(self, command, retry_after):
+        self.command = command
+        self.retry_after = retry_after
+        self.message = "{} is busy, retry after {} ms".format(command, retry_after)
+
+
+# Admission control for the Slurm commands run by the extension. Each command (by executable name) has at most
+# concurrency[name] processes running at once and at most queue_depth[name] more requests waiting for one to finish.
+# Requests beyond that fail fast with CommandBusy instead of piling up on slurmctld and the server's event loop.
+# Commands without a concurrency limit run unrestricted.
+#
+# Every command is also killed after timeouts[name] seconds (default_timeout if unlisted), and no more than
+# max_processes children, including ones still being killed, are ever outstanding.
+#
+# Durations, exit codes, timeouts, rejections and output sizes are recorded in metrics (a SlurmMetrics), if given.
+class CommandRunner:
+    def __init__(self, concurrency: dict = None, queue_depth: dict = None, retry_after: int = 1000,
+                 timeouts: dict = None, default_timeout: float = DEFAULT_TIMEOUT,
+                 kill_grace: float = DEFAULT_KILL_GRACE, max_processes: int = 0, metrics=None, log=logger):
+        self.concurrency = dict(concurrency or {})
+        self.queue_depth = dict(queue_depth or {})
+        self.retry_after = retry_after
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.kill_grace = kill_grace
+        self.max_processes = max_processes
+        # number of child processes started and not yet reaped
+        self.outstanding = 0
+        self._metrics = metrics
+        self._serverlog = log
+        self._semaphores = {}
+        self._waiting = collections.Counter()
+
+    def timeout_for(self, command: str):
+        return self.timeouts.get(command_name(command), self.default_timeout)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, command: str):
+        name = command_name(command)
+        try:
+            async with self._command_slot(name):
+                if self.max_processes and self.outstanding >= self.max_processes:
+                    self._serverlog.warning("CommandRunner: {} child processes outstanding".format(self.outstanding))
+                    raise CommandBusy(name, self.retry_after)
+                self.outstanding += 1
+                if self._metrics is not None:
+                    self._metrics.subprocesses.inc()
+                try:
+                    yield
+                finally:
+                    self.outstanding -= 1
+                    if self._metrics is not None:
+                        self._metrics.subprocesses.dec()
+        except CommandBusy:
+            if self._metrics is not None:
+                self._metrics.command_busy.labels(name).inc()
+            raise
+
+    @contextlib.asynccontextmanager
+    async def _command_slot(self, name: str):
+        limit = self.concurrency.get(name)
+        if not limit:
+            yield
+            return
+
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            semaphore = self._semaphores[name] = asyncio.Semaphore(limit)
+        if semaphore.locked() and self._waiting[name] >= self.queue_depth.get(name, 0):
+            self._serverlog.warning("CommandRunner: {} is at its limit of {} running and {} queued".format(
+                name, limit, self._waiting[name]))
+            raise CommandBusy(name, self.retry_after)
+
+        self._waiting[name] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._waiting[name] -= 1
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    async def run(self, command: str, stdin=None, cwd=None, input: bytes = None):
+        start = time.monotonic()
+        async with self.slot(command):
+            with self._observe(command, start) as observed:
+                out = await run_command(command, stdin=stdin, cwd=cwd, timeout=self.timeout_for(command),
+                                        kill_grace=self.kill_grace, input=input, log=self._serverlog)
+                observed.update(out)
+                return out
+
+    async def run_lines(self, command: str, parse_line):
+        start = time.monotonic()
+        async with self.slot(command):
+            with self._observe(command, start) as observed:
+                out = await run_command_lines(command, parse_line, timeout=self.timeout_for(command),
+                                              kill_grace=self.kill_grace, log=self._serverlog)
+                observed.update(out)
+                return out
+
+    @contextlib.contextmanager
+    def _observe(self, command: str, start: float):
+        # the caller fills in the command output, whose returncode and size are recorded with the duration
+        observed = {}
+        name = command_name(command)
+        try:
+            yield observed
+        except CommandTimeout:
+            if self._metrics is not None:
+                self._metrics.command_timeouts.labels(name).inc()
+            raise
+        finally:
+            if self._metrics is not None:
+                self._metrics.observe_command(name, time.monotonic() - start, observed.get("returncode"),
+                                              observed.get("bytes", 0))
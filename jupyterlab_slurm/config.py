@@ -1,6 +1,26 @@
-from traitlets import Unicode
+from traitlets import Bool, CaselessStrEnum, Dict, Float, Integer, TraitError, Unicode, validate
 from traitlets.config import Configurable
 
+# settings whose values are never logged, including in the per-cluster settings
+SECRET_SETTINGS = ('slurmrestd_token', 'cookie_secret', 'password', 'token')
+
+
+# settings each of several clusters may set for itself (clusters)
+CLUSTER_SETTINGS = ('squeue_path', 'scancel_path', 'scontrol_path', 'sbatch_path', 'sinfo_path', 'squeue_format',
+                    'slurm_backend', 'slurmrestd_url', 'slurmrestd_api_version', 'slurmrestd_token',
+                    'slurmrestd_max_connections')
+
+
+def redact_settings(settings: dict):
+    redacted = {}
+    for key, value in settings.items():
+        if key in SECRET_SETTINGS and value:
+            value = "***"
+        elif isinstance(value, dict):
+            value = redact_settings(value)
+        redacted[key] = value
+    return redacted
+
 
 class SlurmCommandPaths(Configurable):
     squeue_path = Unicode(
@@ -23,12 +43,256 @@ class SlurmCommandPaths(Configurable):
         help=""
     ).tag(config=True)
 
+    sacct_path = Unicode(
+        default_value="sacct",
+        help=""
+    ).tag(config=True)
+
+    sinfo_path = Unicode(
+        default_value="sinfo",
+        help=""
+    ).tag(config=True)
+
     # add spath as trait
 
+    squeue_format = CaselessStrEnum(
+        ["text", "json", "yaml"],
+        default_value="text",
+        help="squeue output read by the extension: 'text' (fixed width columns), 'json' (squeue --json, decoded with "
+             "orjson if installed) or 'yaml' (squeue --yaml, needs PyYAML)"
+    ).tag(config=True)
+
+    squeue_cache_ttl = Float(
+        default_value=5.0,
+        help="Seconds a squeue snapshot is reused by every request before squeue is run again"
+    ).tag(config=True)
+
+    squeue_cache_stale_ttl = Float(
+        default_value=30.0,
+        help="Seconds past squeue_cache_ttl during which the old snapshot is still served while it is refreshed"
+    ).tag(config=True)
+
+    squeue_cache_history = Integer(
+        default_value=4,
+        help="Number of previous squeue snapshots kept per query so clients can be sent only what changed since them"
+    ).tag(config=True)
+
+    squeue_poll_interval = Float(
+        default_value=15.0,
+        help="Seconds between squeue runs of the server-side poller that pushes updates to auto-reloading clients"
+    ).tag(config=True)
+
+    squeue_rate_limit = Float(
+        default_value=2.0,
+        help="squeue requests per second each user may make once squeue_rate_burst is used up; requests over the "
+             "limit are answered from the last snapshot. 0 for no limit"
+    ).tag(config=True)
+
+    squeue_rate_burst = Integer(
+        default_value=20,
+        help="squeue requests each user may make at once before squeue_rate_limit applies"
+    ).tag(config=True)
+
+    command_concurrency = Dict(
+        default_value={"squeue": 4, "sbatch": 4, "scancel": 4, "scontrol": 4, "sacct": 1, "sinfo": 1},
+        help="Maximum number of each Slurm command (by executable name) running at once, unlisted commands are "
+             "not limited"
+    ).tag(config=True)
+
+    command_queue_depth = Dict(
+        default_value={"squeue": 16, "sbatch": 32, "scancel": 32, "scontrol": 32, "sacct": 8, "sinfo": 16},
+        help="Maximum number of requests waiting for each Slurm command once command_concurrency is reached, "
+             "further requests are answered with 503 and a Retry-After header"
+    ).tag(config=True)
+
+    busy_retry_after = Integer(
+        default_value=1000,
+        help="Milliseconds a client is told to wait before retrying a request rejected because its command is busy"
+    ).tag(config=True)
+
+    command_timeouts = Dict(
+        default_value={"squeue": 60.0, "sbatch": 60.0, "scancel": 30.0, "scontrol": 30.0, "sacct": 120.0,
+                       "sinfo": 60.0},
+        help="Seconds each Slurm command (by executable name) may run before it is terminated, unlisted commands "
+             "use command_timeout"
+    ).tag(config=True)
+
+    command_timeout = Float(
+        default_value=60.0,
+        help="Seconds any Slurm command not listed in command_timeouts may run before it is terminated"
+    ).tag(config=True)
+
+    kill_grace_period = Float(
+        default_value=5.0,
+        help="Seconds a timed out command is given to exit after SIGTERM before it is sent SIGKILL"
+    ).tag(config=True)
+
+    max_subprocesses = Integer(
+        default_value=32,
+        help="Maximum number of Slurm command processes outstanding at once, including ones being terminated; "
+             "0 for no limit"
+    ).tag(config=True)
+
+    sbatch_bulk_parallelism = Integer(
+        default_value=4,
+        help="Maximum number of scripts of one bulk or sweep sbatch request being submitted at once"
+    ).tag(config=True)
+
+    sbatch_bulk_max_jobs = Integer(
+        default_value=1000,
+        help="Maximum number of scripts a bulk or sweep sbatch request may submit"
+    ).tag(config=True)
+
+    sbatch_max_body_size = Integer(
+        default_value=64 * 1024 * 1024,
+        help="Maximum size in bytes of an sbatch request body (a script, or a bulk request's scripts)"
+    ).tag(config=True)
+
+    job_output_poll_interval = Float(
+        default_value=1.0,
+        help="Seconds between checks for new output of a job's StdOut/StdErr file being followed by a client"
+    ).tag(config=True)
+
+    sacct_db_path = Unicode(
+        default_value="",
+        help="SQLite database the sacct job history is kept in, defaults to jupyterlab_slurm/sacct.sqlite in the "
+             "Jupyter data directory"
+    ).tag(config=True)
+
+    sacct_history_days = Float(
+        default_value=14.0,
+        help="Days of finished jobs kept in the job history"
+    ).tag(config=True)
+
+    sacct_refresh_interval = Float(
+        default_value=60.0,
+        help="Seconds between the incremental sacct queries that bring the job history up to date"
+    ).tag(config=True)
+
+    job_detail_cache_size = Integer(
+        default_value=1024,
+        help="Number of jobs whose scontrol show job details are kept, each until the job's state or time changes "
+             "in the squeue snapshot"
+    ).tag(config=True)
+
+    sinfo_refresh_interval = Float(
+        default_value=30.0,
+        help="Seconds the sinfo partition overview is shared by every session before sinfo is run again"
+    ).tag(config=True)
+
+    slurm_backend = CaselessStrEnum(
+        ["cli", "slurmrestd"],
+        default_value="cli",
+        help="How Slurm is queried and controlled: 'cli' runs the Slurm commands, 'slurmrestd' uses the Slurm REST API"
+    ).tag(config=True)
+
+    slurmrestd_url = Unicode(
+        default_value="http://localhost:6820",
+        help="slurmrestd address, http://host:port or unix:///path/to/slurmrestd.socket"
+    ).tag(config=True)
+
+    slurmrestd_api_version = Unicode(
+        default_value="v0.0.40",
+        help="Version of the Slurm REST API to use, as in /slurm/<version>/jobs"
+    ).tag(config=True)
+
+    slurmrestd_token = Unicode(
+        default_value="",
+        help="JWT sent to slurmrestd as X-SLURM-USER-TOKEN, defaults to the SLURM_JWT environment variable"
+    ).tag(config=True)
+
+    slurmrestd_max_connections = Integer(
+        default_value=8,
+        help="Maximum number of persistent connections to slurmrestd, and so of requests to it at once"
+    ).tag(config=True)
+
+    clusters = Dict(
+        default_value={},
+        help="Clusters shown together, by name, each with a dict of settings overriding these settings for it "
+             "(e.g. squeue_path, sbatch_path, slurm_backend, slurmrestd_url). Clusters without their own command "
+             "paths or slurmrestd are addressed with the default commands and -M <name>. Empty for a single cluster"
+    ).tag(config=True)
+
+    @validate('clusters')
+    def _validate_clusters(self, proposal):
+        # a misspelled setting would otherwise be ignored, and the cluster quietly reached some other way
+        for name, options in proposal['value'].items():
+            unknown = sorted(set(options or {}) - set(CLUSTER_SETTINGS))
+            if unknown:
+                raise TraitError("Unknown settings {} for cluster {}, expected some of {}".format(
+                    ", ".join(unknown), name, ", ".join(CLUSTER_SETTINGS)))
+            if (options or {}).get('slurm_backend', 'cli') not in ('cli', 'slurmrestd'):
+                raise TraitError("slurm_backend of cluster {} must be cli or slurmrestd".format(name))
+        return proposal['value']
+
+    cluster_timeout = Float(
+        default_value=10.0,
+        help="Seconds each cluster is given to answer a queue or partition query before the others are returned "
+             "without it"
+    ).tag(config=True)
+
+    log_request_rate = Float(
+        default_value=1.0,
+        help="Requests logged per second for each endpoint once log_request_burst is used up, the rest are counted "
+             "and not logged; 0 to log every request"
+    ).tag(config=True)
+
+    log_request_burst = Integer(
+        default_value=10,
+        help="Requests logged at once for each endpoint before log_request_rate applies"
+    ).tag(config=True)
+
+    log_payloads = Bool(
+        default_value=False,
+        help="Log request bodies, batch scripts and command results at DEBUG level; they may be large and contain "
+             "anything"
+    ).tag(config=True)
+
     def get_paths(self):
         return {
             'squeue_path': self.squeue_path,
             'scancel_path': self.scancel_path,
             'scontrol_path': self.scontrol_path,
-            'sbatch_path': self.sbatch_path
+            'sbatch_path': self.sbatch_path,
+            'sacct_path': self.sacct_path,
+            'sinfo_path': self.sinfo_path
         }
+
+    def get_settings(self):
+        settings = self.get_paths()
+        settings.update({
+            'squeue_format': self.squeue_format,
+            'squeue_cache_ttl': self.squeue_cache_ttl,
+            'squeue_cache_stale_ttl': self.squeue_cache_stale_ttl,
+            'squeue_cache_history': self.squeue_cache_history,
+            'squeue_poll_interval': self.squeue_poll_interval,
+            'squeue_rate_limit': self.squeue_rate_limit,
+            'squeue_rate_burst': self.squeue_rate_burst,
+            'command_concurrency': self.command_concurrency,
+            'command_queue_depth': self.command_queue_depth,
+            'busy_retry_after': self.busy_retry_after,
+            'command_timeouts': self.command_timeouts,
+            'command_timeout': self.command_timeout,
+            'kill_grace_period': self.kill_grace_period,
+            'max_subprocesses': self.max_subprocesses,
+            'sbatch_bulk_parallelism': self.sbatch_bulk_parallelism,
+            'sbatch_bulk_max_jobs': self.sbatch_bulk_max_jobs,
+            'sbatch_max_body_size': self.sbatch_max_body_size,
+            'job_output_poll_interval': self.job_output_poll_interval,
+            'sacct_db_path': self.sacct_db_path,
+            'sacct_history_days': self.sacct_history_days,
+            'sacct_refresh_interval': self.sacct_refresh_interval,
+            'job_detail_cache_size': self.job_detail_cache_size,
+            'sinfo_refresh_interval': self.sinfo_refresh_interval,
+            'slurm_backend': self.slurm_backend,
+            'slurmrestd_url': self.slurmrestd_url,
+            'slurmrestd_api_version': self.slurmrestd_api_version,
+            'slurmrestd_token': self.slurmrestd_token,
+            'slurmrestd_max_connections': self.slurmrestd_max_connections,
+            'clusters': self.clusters,
+            'cluster_timeout': self.cluster_timeout,
+            'log_request_rate': self.log_request_rate,
+            'log_request_burst': self.log_request_burst,
+            'log_payloads': self.log_payloads
+        })
+        return settings
@@ -0,0 +1,69 @@
+import json
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# responses with fewer rows than this are sent uncompressed, compressing them costs more than it saves
+COMPRESS_MIN_ROWS = 20
+
+# number of rows serialised (and compressed) at a time
+CHUNK_ROWS = 2000
+
+
+def encode_columns(rows: list):
+    """The rows as a list of columns. Columns with few distinct values (partition, user, state, ...) are dictionary
+    encoded as {"dictionary": [values], "codes": [index per row]}, the others are sent as {"values": [...]}."""
+    columns = []
+    for values in zip(*rows):
+        dictionary = {}
+        codes = [dictionary.setdefault(value, len(dictionary)) for value in values]
+        if len(dictionary) * 2 <= len(values):
+            columns.append({"dictionary": list(dictionary), "codes": codes})
+        else:
+            columns.append({"values": list(values)})
+    return columns
+
+
+def json_chunks(data_dict: dict, rows: list, columnar: bool = False):
+    """data_dict with rows added as "data" (or as "columns" if columnar), serialised a chunk at a time."""
+    if columnar:
+        yield json.dumps(dict(data_dict, format="columnar", columns=encode_columns(rows)))
+        return
+
+    yield json.dumps(data_dict)[:-1] + ', "data": ['
+    for start in range(0, len(rows), CHUNK_ROWS):
+        yield (", " if start > 0 else "") + json.dumps(rows[start:start + CHUNK_ROWS])[1:-1]
+    yield "]}"
+
+
+def accepted_encoding(accept_encoding: str):
+    """The best content encoding we support out of an Accept-Encoding header: br, gzip or None."""
+    accepted = set()
+    for entry in accept_encoding.split(","):
+        name, _, params = entry.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress_chunks(chunks, encoding: str):
+    """Compress an iterable of str chunks with encoding ("br" or "gzip"), yielding compressed bytes as they come."""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=4)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = compress(chunk.encode())
+        if data:
+            yield data
+    yield finish()
@@ -1,20 +1,53 @@
 import asyncio
-import html
+import codecs
+import getpass
 import json
 import logging
+import math
 import os
 import re
 import shlex
-import tempfile
 
-from jupyter_server.base.handlers import APIHandler
+from jupyter_core.paths import jupyter_data_dir
+from jupyter_server.base.handlers import APIHandler, JupyterHandler
 from jupyter_server.utils import url_path_join
 import tornado
+import tornado.httputil
+import tornado.iostream
 import tornado.web
+import tornado.websocket
 
-logger = logging.Logger(__file__)
+try:
+    from jupyter_server.base.websocket import WebSocketMixin
+except ImportError:
+    # jupyter_server < 2.4
+    from jupyter_server.base.zmqhandlers import WebSocketMixin
 
-jobIDMatcher = re.compile("^[0-9]+$")
+from .backends import CLIBackend, FederatedBackend, ScriptSpool, SlurmBackend, SlurmrestdBackend, UnknownCluster
+from .cache import JobDetailCache, SnapshotCache
+from .commands import CommandBusy, CommandRunner, squeue_succeeded
+from .config import redact_settings
+from .encoding import COMPRESS_MIN_ROWS, accepted_encoding, compress_chunks, json_chunks
+from .history import COLUMNS as SACCT_COLUMNS, JobHistoryStore, history_succeeded, refresh_history
+from .joboutput import DEFAULT_TAIL_LINES, file_size, read_range, tail_offset
+from .logs import SlurmLog
+from .metrics import CONTENT_TYPE_LATEST, SlurmMetrics
+from .poller import SqueuePoller
+from .ratelimit import RateLimiter
+from .sinfo import query_sinfo, sinfo_succeeded
+from .snapshot import SqueueSnapshot
+from .sweep import InvalidSweep, expand_template, parameter_grid, submitted_jobid
+
+logger = SlurmLog(logging.Logger(__file__))
+
+# plain, array task (1234_5) and array range (1234_[1-10,15%2]) job IDs
+jobIDMatcher = re.compile(r"^[0-9]+(_([0-9]+|\[[0-9,\-%:]+\]))?$")
+
+# maximum number of job IDs passed to a single scancel/scontrol invocation
+JOBID_CHUNK_SIZE = 256
+
+# times one script of a bulk sbatch request waits out a busy sbatch before it is reported as failed
+BULK_BUSY_RETRIES = 5
 
 
 class MissingSlurmJobID(Exception):
@@ -44,12 +77,11 @@ class ExampleHandler(APIHandler):
     def initialize(self, log=logger):
         super().initialize()
         self._serverlog = log
-        self._serverlog.info("ExampleHandler.initialize()")
 
     @tornado.web.authenticated
     def get(self):
         try:
-            self._serverlog.info("ExampleHandler.get()")
+            self._serverlog.request("get_example", "ExampleHandler.get()")
             self.finish(json.dumps({
                 "data": "This is the /jupyterlab_slurm/get_example endpoint!"
                 }))
@@ -59,18 +91,30 @@ class ExampleHandler(APIHandler):
                 }))
 
 
+# Prometheus metrics of the extension: command latencies, exit codes, timeouts, subprocesses, cache lookups, etc.
+class MetricsHandler(JupyterHandler):
+    def initialize(self, metrics: SlurmMetrics = None, log=logger):
+        super().initialize()
+        self._metrics = metrics
+        self._serverlog = log
+
+    @tornado.web.authenticated
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.finish(self._metrics.exposition())
+
+
 # A simple request handler for retrieving the username
 class UserFetchHandler(APIHandler):
     def initialize(self, log=logger):
         super().initialize()
         self._serverlog = log
-        self._serverlog.info("UserFetchHandler.initialize()")
 
     @tornado.web.authenticated
     def get(self):
         try:
             username = os.environ.get('USER')
-            self._serverlog.info("UserFetchHandler.get() {}".format(username))
+            self._serverlog.request("user", "UserFetchHandler.get(): %s", username)
             self.finish(json.dumps({
                 "user": username
                 }))
@@ -79,81 +123,150 @@ class UserFetchHandler(APIHandler):
             self.finish(json.dumps(e))
 
 
+def job_results(jobIDs: list, out: dict):
+    """Per-job status of one scancel/scontrol invocation over several jobs.
+
+    The Slurm commands report errors for individual jobs on stderr, mentioning the job ID, so jobs named in an
+    error line failed and the others succeeded. If the command failed without naming any job, they all failed.
+    """
+    errors = {}
+    for line in out["stderr"].splitlines():
+        for jobID in jobIDs:
+            if jobID not in errors and re.search(r"(?<!\w){}(?!\w)".format(re.escape(jobID)), line):
+                errors[jobID] = line.strip()
+
+    results = []
+    for jobID in jobIDs:
+        if jobID in errors:
+            results.append({"jobID": jobID, "returncode": out["returncode"] or 1, "errorMessage": errors[jobID]})
+        elif out["returncode"] != 0 and not errors:
+            results.append({"jobID": jobID, "returncode": out["returncode"], "errorMessage": out["stderr"]})
+        else:
+            results.append({"jobID": jobID, "returncode": 0, "errorMessage": ""})
+    return results
+
+
+# the backend of the cluster named by a request's cluster query argument, when several clusters are configured
+def cluster_backend(backend: SlurmBackend, cluster: str = None):
+    if isinstance(backend, FederatedBackend):
+        return backend.member(cluster)
+    return backend
+
+
+# the job's key in squeue snapshots, which include the cluster when several clusters are configured
+def snapshot_jobid(backend: SlurmBackend, jobID: str, cluster: str = None):
+    if isinstance(backend, FederatedBackend):
+        return "{}@{}".format(jobID, cluster or backend.default_cluster)
+    return jobID
+
+
 # common utility methods for running slurm commands, and defaults to the run_command() for scancel and scontrol
 # sbatch and squeue need special handling of the command and override run_command()
+#
+# Commands go through a SlurmBackend, the command line tools unless another backend (slurmrestd) is configured
 class SlurmCommandHandler(APIHandler):
-    def initialize(self, command: str = None, log=logger):
+    # the Slurm command this handler runs, as named by the backend
+    command_name = None
+
+    def initialize(self, command: str = None, squeue_cache: SnapshotCache = None, runner: CommandRunner = None,
+                   backend: SlurmBackend = None, log=logger):
         super().initialize()
         self._slurm_command = command
+        self._squeue_cache = squeue_cache
+        self._runner = runner if runner is not None else CommandRunner(log=log)
+        if backend is None:
+            backend = CLIBackend({self.command_name: command}, self._runner, log=log)
+        self._backend = backend
         self._serverlog = log
-        self._serverlog.info("SlurmCommandHandler.initialize(): {} {}".format(self._slurm_command, self._serverlog))
 
     def get_jobid(self):
+        return self.get_jobids()[0]
+
+    # jobID may be a single ID, or jobIDs a list of them, e.g. {"jobIDs": ["1234", "1235_7", "1236_[1-10]"]}
+    def get_jobids(self):
         if self.request.headers['Content-Type'] == 'application/json':
             body = json.loads(self.request.body)
-            if "jobID" not in body:
+            if "jobIDs" in body:
+                jobIDs = body["jobIDs"]
+                if not isinstance(jobIDs, list):
+                    raise InvalidSlurmJobID(jobIDs, "jobIDs must be a list of job IDs")
+            elif "jobID" in body:
+                jobIDs = [body["jobID"]]
+            else:
                 raise MissingSlurmJobID("")
-            jobID = body["jobID"]
         else:
-            jobID = self.get_body_arguments('jobID')[0]
-
-        if not jobIDMatcher.search(jobID):
-            raise InvalidSlurmJobID(jobID, "jobID {} is invalid".format(jobID))
-
-        return jobID
-
-    async def _run_command(self, command: str = None, stdin=None, cwd=None):
-        self._serverlog.info('SlurmCommandHandler._run_command(): {} {} {}'.format(command, stdin, cwd))
-        commands = shlex.split(command)
-        self._serverlog.info('SlurmCommandHandler._run_command(): {}'.format(commands))
-        process = await asyncio.create_subprocess_exec(*commands,
-                                                       stdout=asyncio.subprocess.PIPE,
-                                                       stderr=asyncio.subprocess.PIPE,
-                                                       stdin=stdin,
-                                                       cwd=cwd)
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=60.0)
-        # decode stdout and from bytes to str, and return stdout, stderr, and returncode
+            jobIDs = self.get_body_arguments('jobID')
+
+        if len(jobIDs) == 0:
+            raise MissingSlurmJobID("")
+
+        for jobID in jobIDs:
+            if not isinstance(jobID, str) or not jobIDMatcher.search(jobID):
+                raise InvalidSlurmJobID(jobID, "jobID {} is invalid".format(jobID))
+
+        return jobIDs
+
+    # too many of this command are already running or queued, tell the client when to try again
+    def busy_response(self, busy: CommandBusy):
+        self._serverlog.warning(busy.message)
+        self.set_status(503)
+        self.set_header("Retry-After", str(math.ceil(busy.retry_after / 1000)))
         return {
-            "stdout": stdout.decode().strip(),
-            "stderr": stderr.decode().strip(),
-            "returncode": process.returncode
+            "responseMessage": "Busy: {}".format(self._slurm_command),
+            "returncode": -1,
+            "errorMessage": busy.message,
+            "retryAfter": busy.retry_after
             }
 
+    def get_backend(self):
+        return cluster_backend(self._backend, self.get_query_argument('cluster', default=None))
+
+    # jobs changed state after a successful scancel/scontrol/sbatch, so cached squeue snapshots are out of date
+    def _invalidate_squeue_cache(self):
+        if self._squeue_cache is not None:
+            self._squeue_cache.invalidate()
+        self._backend.invalidate()
+
     async def run_command(self, args: list = None):
         responseMessage = ""
         errorMessage = "{} did not run!".format(self._slurm_command)
         returncode = -1
+        retryAfter = None
+        results = []
         try:
-            jobID = self.get_jobid()
+            jobIDs = self.get_jobids()
 
             if args is None:
                 args = []
 
-            out = await self._run_command("{} {} {}".format(self._slurm_command, " ".join(args), jobID))
-
-            returncode = out["returncode"]
-            cmd_stdout = ""
-            if "stdout" in out and len(out["stdout"].strip()) > 0:
-                cmd_stdout = out["stdout"]
-
-            cmd_stderr = ""
-            if "stderr" in out and len(out["stderr"].strip()) > 0:
-                cmd_stderr = out["stderr"]
-
-            if returncode != 0:
-                responseMessage = "Failure: {} {} {}".format(self._slurm_command, jobID, cmd_stdout)
-                errorMessage = cmd_stderr
+            # one command invocation per chunk of job IDs, rather than one per job
+            for start in range(0, len(jobIDs), JOBID_CHUNK_SIZE):
+                chunk = jobIDs[start:start + JOBID_CHUNK_SIZE]
+                out = await self.get_backend().job_command(self.command_name, args, chunk)
+                results += job_results(chunk, out)
+
+            failed = [result for result in results if result["returncode"] != 0]
+            jobs = " ".join(jobIDs) if len(jobIDs) == 1 else "{} jobs".format(len(jobIDs))
+            if failed:
+                returncode = failed[0]["returncode"]
+                responseMessage = "Failure: {} {} ({} of {} failed)".format(
+                    self._slurm_command, jobs, len(failed), len(results))
+                errorMessage = "\n".join(dict.fromkeys(result["errorMessage"] for result in failed))
             else:
-                responseMessage = "Success: {} {}".format(self._slurm_command, jobID)
+                returncode = 0
+                responseMessage = "Success: {} {}".format(self._slurm_command, jobs)
                 errorMessage = ""
+            if len(failed) < len(results):
+                self._invalidate_squeue_cache()
+        except CommandBusy as busy:
+            out = self.busy_response(busy)
+            responseMessage = out["responseMessage"]
+            errorMessage = out["errorMessage"]
+            returncode = -1
+            retryAfter = out["retryAfter"]
         except KeyError as ke:
             self._serverlog.exception(ke)
-            try:
-                jobID is not None
-            except NameError:
-                jobID = "No jobID parsed"
-
-            responseMessage = "Failure: {} {}".format(self._slurm_command, jobID)
+            responseMessage = "Failure: {}".format(self._slurm_command)
             errorMessage = "Missing key before running command: {}".format(str(ke))
             returncode = -1
         except MissingSlurmJobID as emj:
@@ -168,39 +281,41 @@ class SlurmCommandHandler(APIHandler):
             returncode = -1
         except Exception as e:
             self._serverlog.exception(e)
-            try:
-                jobID is not None
-            except NameError:
-                jobID = "No jobID parsed"
-
-            responseMessage = "Failure: {} {}".format(self._slurm_command, jobID)
+            responseMessage = "Failure: {}".format(self._slurm_command)
             errorMessage = "Unhandled Exception: {}".format(str(e))
             returncode = -1
         finally:
-            return {
+            out = {
                 "responseMessage": responseMessage,
                 "returncode": returncode,
-                "errorMessage": errorMessage
+                "errorMessage": errorMessage,
+                "results": results
                 }
+            if retryAfter is not None:
+                out["retryAfter"] = retryAfter
+            return out
 
 
 # Conventions: Query arguments: always settings for how to use or options provided by a SLURM command. Body
 # arguments: always job designators, e.g. job ID, paths to SLURM scripts, input streams of SLURM script contents,
 # etc. Path arguments: always commands (including commands sent to `scontrol`, e.g. `scontrol hold`/`scontrol resume`)
 
-# Unsurprisingly, the job ID's are always (for scancel and scontrol) the body argument named 'jobID'
+# Unsurprisingly, the job ID's are always (for scancel and scontrol) the body argument named 'jobID', or 'jobIDs' for
+# a list of them
 
 # Since this is idempotent, hypothetically one could also use PUT instead of DELETE here.
 class ScancelHandler(SlurmCommandHandler):
-    def initialize(self, scancel: str = "scancel", log=logger):
-        super().initialize(scancel, log)
-        self._serverlog.info("ScancelHandler.initialize(): {} {}".format(self._slurm_command, self._serverlog))
+    command_name = "scancel"
+
+    def initialize(self, scancel: str = "scancel", squeue_cache: SnapshotCache = None, runner: CommandRunner = None,
+                   backend: SlurmBackend = None, log=logger):
+        super().initialize(scancel, squeue_cache=squeue_cache, runner=runner, backend=backend, log=log)
 
     # Add `-H "Authorization: token <token>"` to the curl command for any DELETE request
     @tornado.web.authenticated
     async def delete(self):
-        self._serverlog.info('ScancelHandler.delete() - request: {}, command: {}'.format(
-            self.request, self._slurm_command))
+        self._serverlog.request("scancel", "ScancelHandler.delete(): %s", self._slurm_command)
+        self._serverlog.payload("scancel", "body", self.request.body)
         results = {
             "responseMessage": "{} has not run yet!".format(self._slurm_command),
             "errorMessage": "",
@@ -220,15 +335,103 @@ class ScancelHandler(SlurmCommandHandler):
 
 # scontrol isn't idempotent, so PUT isn't appropriate, and in general scontrol only modifies a subset of properties,
 # so POST also is not ideal
+#
+# GET scontrol/show?jobID=1234&jobID=1235 returns the jobs' parsed scontrol show job records. They are kept in a
+# JobDetailCache until the job's state or time changes in the latest squeue snapshot.
 class ScontrolHandler(SlurmCommandHandler):
-    def initialize(self, scontrol: str = "scontrol", log=logger):
-        super().initialize(scontrol, log)
-        self._serverlog.info("ScontrolHandler.initialize()")
+    command_name = "scontrol"
+
+    def initialize(self, scontrol: str = "scontrol", squeue_cache: SnapshotCache = None, runner: CommandRunner = None,
+                   backend: SlurmBackend = None, job_detail_cache: JobDetailCache = None, log=logger):
+        super().initialize(scontrol, squeue_cache=squeue_cache, runner=runner, backend=backend, log=log)
+        self._job_detail_cache = job_detail_cache if job_detail_cache is not None else JobDetailCache()
+
+    def get_query_jobids(self):
+        jobIDs = [jobID.strip() for argument in self.get_query_arguments('jobID') for jobID in argument.split(",")
+                  if jobID.strip()]
+        if len(jobIDs) == 0:
+            raise MissingSlurmJobID("")
+        if len(jobIDs) > JOBID_CHUNK_SIZE:
+            raise InvalidSlurmJobID(jobIDs[JOBID_CHUNK_SIZE], "at most {} jobs may be shown at once".format(
+                JOBID_CHUNK_SIZE))
+        for jobID in jobIDs:
+            if not jobIDMatcher.search(jobID):
+                raise InvalidSlurmJobID(jobID, "jobID {} is invalid".format(jobID))
+        return list(dict.fromkeys(jobIDs))
+
+    # the job's state, node count and nodes (or pending reason) in the latest squeue snapshot, None if there is no
+    # snapshot to tell whether it changed. Not its TIME, which changes in every snapshot while the job runs
+    def job_fingerprint(self, key: str):
+        if self._squeue_cache is None:
+            return None
+        for user_only in (False, True):
+            entry = self._squeue_cache.peek(self._backend.squeue_key(user_only))
+            if entry is None or not entry.value.succeeded:
+                continue
+            row = entry.value.by_jobid.get(key)
+            if row is not None:
+                return row[4], row[6], row[7]
+            if not user_only:
+                # no longer queued, so finished, and it won't change again
+                return "", ""
+        return None
+
+    async def show_job(self, jobID: str):
+        cluster = self.get_query_argument('cluster', default=None)
+        key = snapshot_jobid(self._backend, jobID, cluster)
+        fingerprint = self.job_fingerprint(key)
+        result = self._job_detail_cache.get(key, fingerprint)
+        if result is not None:
+            return dict(result, cached=True)
+
+        out = await cluster_backend(self._backend, cluster).show_job(jobID)
+        result = {"jobID": jobID, "returncode": out["returncode"], "errorMessage": out["stderr"].strip(),
+                  "records": out["records"]}
+        if out["returncode"] == 0:
+            self._job_detail_cache.put(key, fingerprint, result)
+        return dict(result, cached=False)
+
+    @tornado.web.authenticated
+    async def get(self, action):
+        self._serverlog.request("scontrol", "ScontrolHandler.get(): %s %s", self._slurm_command, action)
+        if action != "show":
+            raise tornado.web.HTTPError(404)
+        results = {
+            "responseMessage": "{} has not run yet!".format(self._slurm_command),
+            "errorMessage": "",
+            "returncode": -1,
+            "jobs": []
+            }
+        try:
+            jobIDs = self.get_query_jobids()
+            # one scontrol show job per job (it takes a single job ID), only for jobs not cached or changed since
+            jobs = await asyncio.gather(*[self.show_job(jobID) for jobID in jobIDs])
+            failed = [job for job in jobs if job["returncode"] != 0]
+            results = {
+                "responseMessage": "{}: {} show job {}".format("Failure" if failed else "Success",
+                                                               self._slurm_command, " ".join(jobIDs)),
+                "errorMessage": "\n".join(job["errorMessage"] for job in failed),
+                "returncode": failed[0]["returncode"] if failed else 0,
+                "jobs": jobs
+                }
+        except CommandBusy as busy:
+            results = self.busy_response(busy)
+        except (MissingSlurmJobID, InvalidSlurmJobID) as e:
+            self.set_status(400)
+            results["responseMessage"] = "Failure: {} show job".format(self._slurm_command)
+            results["errorMessage"] = e.message or "jobID is missing"
+        except Exception as e:
+            self._serverlog.exception(e)
+            results["responseMessage"] = "Failure: {} show job".format(self._slurm_command)
+            results["errorMessage"] = "Unhandled Exception: {}".format(str(e))
+        finally:
+            await self.finish(json.dumps(results))
 
     # Add `-H "Authorization: token <token>"` to the curl command for any PATCH request
     @tornado.web.authenticated
     async def patch(self, action):
-        self._serverlog.info("ScontrolHandler.patch(): {} {}".format(self._slurm_command, action))
+        self._serverlog.request("scontrol", "ScontrolHandler.patch(): %s %s", self._slurm_command, action)
+        self._serverlog.payload("scontrol", "body", self.request.body)
         results = {
             "responseMessage": "{} has not run yet!".format(self._slurm_command),
             "errorMessage": "",
@@ -248,19 +451,72 @@ class ScontrolHandler(SlurmCommandHandler):
 
 # sbatch clearly isn't idempotent, and resource ID (i.e. job ID) isn't known when running it, so only POST works for
 # the C in CRUD here, not PUT
+#
+# inputType=bulk submits many scripts in one request, either a list of them or a template expanded over a grid of
+# parameters, and streams each script's job ID (or error) back as a line of JSON as soon as sbatch returns
+#
+# The request body is streamed in. With inputType=contents and a body that is neither JSON nor a form (e.g.
+# text/plain), the body is the script itself and goes to sbatch's stdin as received, through a ScriptSpool that only
+# touches temporary_directory for very large scripts. The body arrives before post() runs, so prepare() checks the
+# user is logged in and the body is at most max_body_size bytes before anything is received.
+@tornado.web.stream_request_body
 class SbatchHandler(SlurmCommandHandler):
-    def initialize(self, sbatch: str = "sbatch", temporary_directory: str = None, log=logger):
-        super().initialize(sbatch, log)
+    command_name = "sbatch"
+
+    def initialize(self, sbatch: str = "sbatch", temporary_directory: str = None, squeue_cache: SnapshotCache = None,
+                   runner: CommandRunner = None, backend: SlurmBackend = None, bulk_parallelism: int = 4,
+                   bulk_max_jobs: int = 1000, max_body_size: int = 64 * 1024 * 1024, log=logger):
+        super().initialize(sbatch, squeue_cache=squeue_cache, runner=runner, backend=backend, log=log)
         self.temp_dir = temporary_directory
-        self._serverlog.debug("SbatchHandler.initialize()")
+        self._bulk_parallelism = max(1, bulk_parallelism)
+        self._bulk_max_jobs = bulk_max_jobs
+        self._max_body_size = max_body_size
+        self._body_chunks = []
+        self._script_spool = None
+
+    async def prepare(self):
+        await super().prepare()
+        if self.current_user is None:
+            raise tornado.web.HTTPError(403)
+        content_length = self.request.headers.get('Content-Length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self._max_body_size:
+            raise tornado.web.HTTPError(413, "sbatch request body larger than %d bytes", self._max_body_size)
+        # also ends chunked requests once they grow past it
+        self.request.connection.set_max_body_size(self._max_body_size)
+        content_type = self.request.headers.get('Content-Type', '')
+        if self.get_query_argument('inputType', None) == 'contents' and not content_type.startswith(
+                ('application/json', 'application/x-www-form-urlencoded', 'multipart/form-data')):
+            self._script_spool = ScriptSpool(dir=self.temp_dir)
+
+    def data_received(self, chunk):
+        if self._script_spool is not None:
+            self._script_spool.write(chunk)
+        else:
+            self._body_chunks.append(chunk)
+
+    # JSON and form bodies are only complete once the whole request has been received
+    def read_body(self):
+        if self._script_spool is not None:
+            return
+        self.request.body = b"".join(self._body_chunks)
+        self._body_chunks = []
+        tornado.httputil.parse_body_arguments(self.request.headers.get('Content-Type', ''), self.request.body,
+                                              self.request.body_arguments, self.request.files,
+                                              self.request.headers)
+
+    def on_finish(self):
+        if self._script_spool is not None:
+            self._script_spool.close()
 
     def get_batch_script(self):
+        if self._script_spool is not None:
+            return self._script_spool
         script_data = None
         try:
             if self.request.headers['Content-Type'] == 'application/json':
                 body = json.loads(self.request.body)
                 if "input" in body:
-                    script_data = json.loads(self.request.body)["input"]
+                    script_data = body["input"]
                 else:
                     raise MissingBatchScript("'input' argument was not found for a batch script!")
             else:
@@ -272,14 +528,16 @@ class SbatchHandler(SlurmCommandHandler):
         responseMessage = ""
         errorMessage = "{} has not run yet!".format(self._slurm_command)
         returncode = -1
+        retryAfter = None
         try:
             if inputType == 'path':
                 try:
-                    self._serverlog.info("SbatchHandler.post() - sbatch call - {} {} {}".format(
-                        self._slurm_command, script_data, outputDir))
-                    out = await self._run_command("{} {}".format(
-                        self._slurm_command, script_data), cwd=outputDir)
+                    self._serverlog.request("sbatch", "SbatchHandler: %s %s, outputDir: %s", self._slurm_command,
+                                            script_data, outputDir)
+                    out = await self.get_backend().sbatch(path=script_data, cwd=outputDir or None)
                     out["errorMessage"] = ""
+                except CommandBusy:
+                    raise
                 except Exception as e:
                     out = {
                         "stdout": "",
@@ -292,37 +550,34 @@ class SbatchHandler(SlurmCommandHandler):
                         "returncode": 1,
                         "errorMessage": str(e)
                         }
-                    self._serverlog.error("Error running sbatch: {}".format(out["stderr"]))
+                    self._serverlog.error("Error running sbatch: %s", out["stderr"])
                     self._serverlog.exception(e)
             elif inputType == 'contents':
-                self._serverlog.info("Writing script data to temp file for sbatch: {}".format(script_data))
-                with tempfile.TemporaryFile(mode='w+b', dir=self.temp_dir) as temp:
-                    buffer = str.encode(script_data)
-                    temp.write(buffer)
-                    temp.flush()
-                    temp.seek(0)
-                    try:
-                        self._serverlog.info("sbatch call - {} {} {}".format(
-                            self._slurm_command, buffer, outputDir))
-                        out = await self._run_command(self._slurm_command, stdin=temp.fileno(), cwd=outputDir)
-                        out["errorMessage"] = ""
-                    except Exception as e:
-                        out = {
-                            "stdout": "",
-                            "stderr": "Attempted to run: " +
-                                      "command - {}, script - {}, dir - {}. Check console for more details.".format(
-                                          self._slurm_command,
-                                          script_data,
-                                          outputDir
-                                          ),
-                            "returncode": 1,
-                            "errorMessage": str(e)
-                            }
-                        self._serverlog.error("Error running sbatch: {}".format(out["stderr"]))
-                        self._serverlog.exception(e)
+                try:
+                    self._serverlog.request("sbatch", "SbatchHandler: %s with a script, outputDir: %s",
+                                            self._slurm_command, outputDir)
+                    self._serverlog.payload("sbatch", "script", script_data)
+                    out = await self.get_backend().sbatch(script=script_data, cwd=outputDir or None)
+                    out["errorMessage"] = ""
+                except CommandBusy:
+                    raise
+                except Exception as e:
+                    out = {
+                        "stdout": "",
+                        "stderr": "Attempted to run: " +
+                                  "command - {}, script - {}, dir - {}. Check console for more details.".format(
+                                      self._slurm_command,
+                                      script_data,
+                                      outputDir
+                                      ),
+                        "returncode": 1,
+                        "errorMessage": str(e)
+                        }
+                    self._serverlog.error("Error running sbatch: %s", out["stderr"])
+                    self._serverlog.exception(e)
             else:
                 raise Exception(
-                    'The query argument inputType needs to be either \'path\' or \'contents\', received {}.'.format(
+                    'The query argument inputType needs to be \'path\', \'contents\' or \'bulk\', received {}.'.format(
                         inputType))
 
             returncode = out["returncode"]
@@ -340,6 +595,13 @@ class SbatchHandler(SlurmCommandHandler):
             else:
                 responseMessage = "Success: {}".format(self._slurm_command)
                 errorMessage = ""
+                self._invalidate_squeue_cache()
+        except CommandBusy as busy:
+            out = self.busy_response(busy)
+            responseMessage = out["responseMessage"]
+            errorMessage = out["errorMessage"]
+            returncode = -1
+            retryAfter = out["retryAfter"]
         except KeyError as ke:
             self._serverlog.exception(ke)
             responseMessage = "Failure: {}".format(self._slurm_command)
@@ -357,24 +619,146 @@ class SbatchHandler(SlurmCommandHandler):
                 "errorMessage": errorMessage
                 }
 
+    # {"scripts": ["#!/bin/sh ...", ...]} or {"template": "... --lr={{lr}} ...", "parameters": {"lr": [0.1, 0.01]}}
+    def get_bulk_scripts(self):
+        body = json.loads(self.request.body)
+        if not isinstance(body, dict):
+            raise InvalidSweep("the request body must be a JSON object")
+        if "scripts" in body:
+            scripts = body["scripts"]
+            if not isinstance(scripts, list) or not all(isinstance(script, str) for script in scripts):
+                raise InvalidSweep("scripts must be a list of batch script contents")
+            if len(scripts) > self._bulk_max_jobs:
+                raise InvalidSweep("{} scripts, at most {} jobs may be submitted at once".format(
+                    len(scripts), self._bulk_max_jobs))
+            submissions = [({"index": index}, script) for index, script in enumerate(scripts)]
+        elif "template" in body:
+            if not isinstance(body["template"], str):
+                raise InvalidSweep("template must be the contents of a batch script")
+            points = parameter_grid(body.get("parameters", {}), self._bulk_max_jobs)
+            submissions = [({"index": index, "parameters": point}, expand_template(body["template"], point))
+                           for index, point in enumerate(points)]
+        else:
+            raise MissingBatchScript("'scripts' or 'template' argument was not found for a bulk submission!")
+
+        if len(submissions) == 0:
+            raise InvalidSweep("no batch scripts to submit")
+        return submissions
+
+    # stopped is set when the client goes away: scripts not yet handed to sbatch are then skipped
+    async def submit_one(self, item: dict, script: str, outputDir: str, slots: asyncio.Semaphore,
+                         backend: SlurmBackend, stopped: asyncio.Event):
+        result = dict(item, jobID=None, returncode=-1, errorMessage="")
+        async with slots:
+            for attempt in range(BULK_BUSY_RETRIES + 1):
+                if stopped.is_set():
+                    result["errorMessage"] = "Not submitted, the bulk submission was abandoned"
+                    return result
+                try:
+                    out = await backend.sbatch(script=script, cwd=outputDir)
+                    break
+                except CommandBusy as busy:
+                    # other requests are using sbatch too, wait rather than fail this part of the sweep
+                    if attempt == BULK_BUSY_RETRIES:
+                        result["errorMessage"] = busy.message
+                        return result
+                    await asyncio.sleep(busy.retry_after / 1000)
+                except Exception as e:
+                    self._serverlog.exception(e)
+                    result["errorMessage"] = "Unhandled Exception: {}".format(str(e))
+                    return result
+
+        result["returncode"] = out["returncode"]
+        if out["returncode"] == 0:
+            result["jobID"] = submitted_jobid(out["stdout"])
+        else:
+            result["errorMessage"] = out["stderr"].strip()
+        return result
+
+    async def submit_bulk(self, outputDir: str):
+        try:
+            submissions = self.get_bulk_scripts()
+            backend = self.get_backend()
+        except (ValueError, InvalidSweep, MissingBatchScript, UnknownCluster) as e:
+            self._serverlog.warning("SbatchHandler.submit_bulk(): %s", e)
+            self.set_status(400)
+            await self.finish(json.dumps({
+                "responseMessage": "Failure: {} bulk submission".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": getattr(e, "message", str(e))
+                }))
+            return
+
+        self._serverlog.request("sbatch", "SbatchHandler.submit_bulk(): %d scripts, %d at a time, outputDir: %s",
+                                len(submissions), self._bulk_parallelism, outputDir)
+        self.set_header("Content-Type", "application/x-ndjson")
+        slots = asyncio.Semaphore(self._bulk_parallelism)
+        stopped = asyncio.Event()
+        # no outputDir: the jobs run in the server's working directory
+        tasks = [asyncio.ensure_future(self.submit_one(item, script, outputDir or None, slots, backend, stopped))
+                 for item, script in submissions]
+        submitted = 0
+        failed = []
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                if result["returncode"] == 0:
+                    submitted += 1
+                else:
+                    failed.append(result)
+                self.write(json.dumps(result) + "\n")
+                await self.flush()
+        except tornado.iostream.StreamClosedError:
+            # sbatch runs already started are left to finish, since killing one could leave it unknown whether
+            # its job was submitted. Scripts not yet handed to sbatch are skipped
+            stopped.set()
+            reported = submitted + len(failed)
+            results = await asyncio.gather(*tasks)
+            submitted = sum(1 for result in results if result["returncode"] == 0)
+            self._serverlog.warning("SbatchHandler.submit_bulk(): client went away after %d of %d scripts, "
+                                    "%d jobs submitted", reported, len(submissions), submitted)
+            return
+        finally:
+            if submitted:
+                self._invalidate_squeue_cache()
+
+        if failed:
+            summary = {
+                "responseMessage": "Failure: {} {} scripts ({} of {} failed)".format(
+                    self._slurm_command, len(submissions), len(failed), len(submissions)),
+                "returncode": failed[0]["returncode"],
+                "errorMessage": "\n".join(dict.fromkeys(result["errorMessage"] for result in failed))
+                }
+        else:
+            summary = {
+                "responseMessage": "Success: {} {} scripts".format(self._slurm_command, len(submissions)),
+                "returncode": 0,
+                "errorMessage": ""
+                }
+        summary.update(submitted=submitted, failed=len(failed))
+        await self.finish(json.dumps(summary) + "\n")
+
     # Add `-H "Authorization: token <token>"` to the curl command for any POST request
     @tornado.web.authenticated
     async def post(self):
-        self._serverlog.debug('SbatchHandler.post()')
-
         inputType = self.get_query_argument('inputType')
         outputDir = self.get_query_argument('outputDir', default='')
+        self.read_body()
+
+        if inputType == 'bulk':
+            await self.submit_bulk(outputDir)
+            return
 
-        self._serverlog.info('SbatchHandler.post() - sbatch request: {} {}, inputType: {}, outputDir: {}'.format(
-            self.request, self.request.body, inputType, outputDir))
+        self._serverlog.payload("sbatch", "body", self.request.body)
 
         responseMessage = "{} has not run yet!".format(self._slurm_command)
         errorMessage = ""
         returncode = -1
+        retryAfter = None
         try:
             out = {}
-            # Have two options to specify SLURM script in the request body: either with a path to the script, or with the
-            # script's text contents
+            # Have two options to specify SLURM script in the request body: either with a path to the script, or with
+            # the script's text contents
 
             script_data = self.get_batch_script()
 
@@ -383,143 +767,594 @@ class SbatchHandler(SlurmCommandHandler):
             else:
                 raise tornado.web.MissingArgumentError('inputType')
 
-            self._serverlog.info("out: {}".format(out))
+            self._serverlog.payload("sbatch", "result", out)
 
             responseMessage = out["responseMessage"]
             errorMessage = out["errorMessage"]
             returncode = out["returncode"]
+            retryAfter = out.get("retryAfter")
         except Exception as e:
             self._serverlog.exception(e)
             responseMessage = "Failure: {}".format(self._slurm_command)
             errorMessage = "Unhandled Exception: {}".format(str(e))
             returncode = -1
         finally:
-            await self.finish(json.dumps({
+            results = {
                 "responseMessage": responseMessage,
                 "errorMessage": errorMessage,
                 "returncode": returncode
-                }))
+                }
+            if retryAfter is not None:
+                results["retryAfter"] = retryAfter
+            await self.finish(json.dumps(results))
 
 
 # all squeue does is request information from SLURM scheduler, which is idempotent (for the "server-side"),
 # so clearly GET request is appropriate here
 class SqueueHandler(SlurmCommandHandler):
-    def initialize(self, squeue: str = None, log=logger):
-        super().initialize(squeue, log)
-        self._serverlog.debug("SqueueHandler.initialize()")
-
-        # squeue -h automatically removes the header row -o <format string> ensures that the output is in a
-        # format expected by the extension Hard-coding this is not great -- ideally we would allow the user to
-        # customize this, or have the default output be the user's output stdout, stderr, _ = await
-        # run_command('squeue -o "%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R" -h')
-        self.output_formatting = '-o "%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R" -h'
-
-    def get_command(self):
-        userOnly = self.get_query_argument('userOnly')
-
-        if userOnly == 'true':
-            exec_command = "{} -u {} {}".format(self._slurm_command, os.environ["USER"], self.output_formatting)
-        else:
-            exec_command = "{} {}".format(self._slurm_command, self.output_formatting)
+    command_name = "squeue"
+
+    def initialize(self, squeue: str = None, squeue_cache: SnapshotCache = None, runner: CommandRunner = None,
+                   backend: SlurmBackend = None, metrics: SlurmMetrics = None, rate_limiter: RateLimiter = None,
+                   log=logger):
+        super().initialize(squeue, squeue_cache=squeue_cache, runner=runner, backend=backend, log=log)
+        self._metrics = metrics
+        self._rate_limiter = rate_limiter
+        self._retry_after = None
+        if self._squeue_cache is None:
+            # no shared cache was configured, still collapse concurrent requests but never serve old data
+            self._squeue_cache = SnapshotCache(ttl=0, stale_ttl=0, log=log)
+
+    def get_user_only(self):
+        return self.get_query_argument('userOnly') == 'true'
+
+    def get_cache_key(self):
+        return self._backend.squeue_key(self.get_user_only())
+
+    # seconds until squeue may be run for this user again, 0 if it may be run now. The user is the one the server
+    # (and so squeue) runs as, not the Jupyter identity, which is a new anonymous one for each token authenticated
+    # request without cookies
+    def rate_limit_wait(self):
+        if self._rate_limiter is None:
+            return 0.0
+        return self._rate_limiter.take((getpass.getuser(), self.command_name))
+
+    # over the rate limit: answer from the last snapshot, however old, and tell the client when to ask again
+    def rate_limited(self, wait: float):
+        if self._metrics is not None:
+            self._metrics.rate_limited.labels(self.command_name).inc()
+        self._retry_after = math.ceil(wait) * 1000
+        self.set_header("Retry-After", str(math.ceil(wait)))
+        cached = self._squeue_cache.peek(self.get_cache_key())
+        if cached is not None:
+            self.set_header("X-Snapshot-Age", str(int(cached.age)))
+            return cached.value
+        self._serverlog.warning("SqueueHandler: rate limited with no snapshot to serve, retry in %.1fs", wait)
+        self.set_status(429)
+        return SqueueSnapshot([], {
+            "responseMessage": "Rate limited: {}".format(self._slurm_command),
+            "returncode": -1,
+            "errorMessage": "Too many requests, try again in {} seconds".format(math.ceil(wait))
+            })
 
-        return exec_command
+    # milliseconds before polling again could return anything new: the snapshot is reused until it is
+    # squeue_cache_ttl old, and a rate limited client has to wait out its Retry-After anyway. Whole seconds, like
+    # the headers, so the few distinct response bodies of a snapshot can be compressed once each
+    def next_poll_after(self):
+        cached = self._squeue_cache.peek(self.get_cache_key())
+        fresh_for = max(self._squeue_cache.ttl - cached.age, 0) if cached is not None else 0
+        return max(math.ceil(fresh_for) * 1000, self._retry_after or 0)
 
     async def run_command(self, args: list = None):
-        responseMessage = ""
-        errorMessage = "{} did not run!".format(self._slurm_command)
-        returncode = -1
-        data_list = []
         try:
-            exec_command = self.get_command()
-            self._serverlog.info("SqueueHandler.run_command(): {}".format(exec_command))
-            out = await self._run_command(exec_command)
-            # self._serverlog.info("SqueueHandler response: {}".format(out))
+            user_only = self.get_user_only()
+            wait = self.rate_limit_wait()
+            if wait > 0:
+                return self.rate_limited(wait)
+            snapshot = await self._squeue_cache.get(
+                self.get_cache_key(),
+                lambda: self._backend.squeue(user_only),
+                cacheable=squeue_succeeded)
+        except CommandBusy as busy:
+            # serve the last snapshot, however old, rather than nothing
+            cached = self._squeue_cache.peek(self.get_cache_key())
+            if cached is not None:
+                snapshot = cached.value
+            else:
+                snapshot = SqueueSnapshot([], self.busy_response(busy))
+        except KeyError as ke:
+            self._serverlog.exception(ke)
+            snapshot = SqueueSnapshot([], {
+                "responseMessage": "Failure: {}".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": "Missing key before running command: {}".format(str(ke))
+                })
+        except Exception as e:
+            self._serverlog.exception(e)
+            snapshot = SqueueSnapshot([], {
+                "responseMessage": "Failure: {}".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": "Unhandled Exception: {}".format(str(e))
+                })
+        return snapshot
+
+    def get_page_query(self, snapshot: SqueueSnapshot):
+        """Filtering, sorting and paging arguments for SqueueSnapshot.query(), or None to return every row.
+
+        Raises ValueError for arguments that are not integers, or a sort column the rows don't have.
+        """
+        if not any(self.get_query_argument(name, default=None) is not None
+                   for name in ('offset', 'limit', 'sort', 'q')):
+            return None
+
+        sort = self.get_query_argument('sort', default=None)
+        limit = self.get_query_argument('limit', default=None)
+        if sort is not None:
+            sort = int(sort)
+            if sort < 0 or (snapshot.data and sort >= len(snapshot.data[0])):
+                raise ValueError("sort must be a column index, from 0 to {}".format(len(snapshot.data[0]) - 1))
+        return {
+            "q": self.get_query_argument('q', default=''),
+            "sort": sort,
+            "descending": self.get_query_argument('order', default='asc') == 'desc',
+            "offset": max(int(self.get_query_argument('offset', default='0')), 0),
+            "limit": max(int(limit), 0) if limit is not None else None
+            }
 
-            returncode = out["returncode"]
-            cmd_stdout = ""
-            if "stdout" in out and len(out["stdout"].strip()) > 0:
-                cmd_stdout = out["stdout"]
+    def find_previous_snapshot(self, version: str):
+        for snapshot in self._squeue_cache.history(self.get_cache_key()):
+            if snapshot.version == version:
+                return snapshot
+        return None
+
+    # The rate at which this is called is limited per user (squeue_rate_limit, squeue_rate_burst). Requests over the
+    # limit are answered from the last snapshot with X-Snapshot-Age and Retry-After headers, and no squeue is run.
+    # Every response says when polling again is worthwhile, as nextPollAfter (ms) and X-Next-Poll-After (seconds).
+    #
+    # Every response carries the snapshot version, also sent as the ETag. A client that already has the current
+    # version (If-None-Match) gets a 304, and a client passing since=<version> gets only the rows added, changed
+    # and removed (by JOBID) since that version, if it is still known to the server.
+    #
+    # Large queues can instead be read a page at a time with offset, limit, sort (column index), order (asc|desc)
+    # and q (case-insensitive filter), answered from the snapshot's precomputed sort orders and search index.
+    #
+    # With format=columnar the rows are sent as columns, dictionary encoded where they have few distinct values, and
+    # responses with rows are compressed (brotli or gzip) when the client accepts it.
+    @tornado.web.authenticated
+    async def get(self):
+        self._serverlog.request("squeue", "SqueueHandler.get(): %s userOnly=%s", self._slurm_command,
+                                self.get_query_argument('userOnly', None))
+        data_dict = {"data": []}
+        rows = None
+        snapshot = None
+        whole_snapshot = False
+        try:
+            snapshot = await self.run_command()
 
-            cmd_stderr = ""
-            if "stderr" in out and len(out["stderr"].strip()) > 0:
-                cmd_stderr = out["stderr"]
+            next_poll_after = self.next_poll_after()
+            self.set_header("X-Next-Poll-After", str(next_poll_after // 1000))
+            self.set_header("Etag", '"{}"'.format(snapshot.version))
+            if snapshot.succeeded and self.check_etag_header():
+                self.set_status(304)
+                return
 
-            if returncode != 0:
-                responseMessage = "Failure: {} {}".format(exec_command, cmd_stdout)
-                errorMessage = cmd_stderr
+            data_dict = {
+                "version": snapshot.version,
+                "squeue": snapshot.status,
+                "nextPollAfter": next_poll_after
+                }
+            if self._retry_after is not None:
+                data_dict["retryAfter"] = self._retry_after
+            since = self.get_query_argument('since', default=None)
+            previous = self.find_previous_snapshot(since) if since and snapshot.succeeded else None
+            page_query = self.get_page_query(snapshot)
+            if page_query is not None:
+                data_dict["offset"] = page_query["offset"]
+                data_dict["total"], rows = snapshot.query(**page_query)
+                self.count_rows("page", len(rows))
+            elif previous is not None:
+                data_dict["since"] = since
+                data_dict["delta"] = snapshot.delta_since(previous)
+                self.count_rows("delta", len(data_dict["delta"]["added"]) + len(data_dict["delta"]["changed"]))
             else:
-                responseMessage = "Success: {}".format(exec_command)
-                errorMessage = ""
+                rows = snapshot.data
+                whole_snapshot = True
+                self.count_rows("full", len(rows))
+        except ValueError as e:
+            self.set_status(400)
+            rows = None
+            data_dict = {"data": [], "squeue": {
+                "responseMessage": "Failure: {} invalid query".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": str(e)
+                }}
+        except Exception as e:
+            self._serverlog.exception("Unhandled Exception: {}".format(e))
+            rows = None
+            data_dict = {"data": [], "squeue": {
+                "responseMessage": "Failure: {}".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": "Unhandled Exception: {}".format(str(e))
+                }}
+        finally:
+            if self.get_status() == 304:
+                await self.finish()
+            elif rows is not None:
+                await self.finish_with_rows(data_dict, rows, snapshot if whole_snapshot else None)
+            else:
+                # finish(chunk) writes chunk to the output
+                # buffer and ends the HTTP request
+                await self.finish(json.dumps(data_dict))
+
+    def count_rows(self, response: str, rows: int):
+        if self._metrics is not None:
+            self._metrics.rows_returned.labels(response).inc(rows)
+
+    # The whole queue can be tens of MB of JSON, so rather than serialising it in one go it is written and flushed
+    # a chunk of rows at a time, which bounds the size of the response buffer and sends the first bytes early
+    #
+    # snapshot is given when rows are all of its rows: the response is then the same for every client with the same
+    # nextPollAfter and retryAfter, so its compressed bytes are kept with the snapshot under those too, and each
+    # distinct body is only compressed once
+    async def finish_with_rows(self, data_dict: dict, rows: list, snapshot: SqueueSnapshot = None):
+        self.set_header("Content-Type", "application/json")
+        self.add_header("Vary", "Accept-Encoding")
+        columnar = self.get_query_argument('format', default='rows') == 'columnar'
+        encoding = None
+        if len(rows) >= COMPRESS_MIN_ROWS:
+            encoding = accepted_encoding(self.request.headers.get("Accept-Encoding", ""))
+
+        chunks = json_chunks(data_dict, rows, columnar)
+        if encoding is not None:
+            self.set_header("Content-Encoding", encoding)
+            if snapshot is not None:
+                key = (columnar, encoding, data_dict.get("nextPollAfter"), data_dict.get("retryAfter"))
+                chunks = snapshot.encoded(key, lambda: list(compress_chunks(chunks, encoding)))
+            else:
+                chunks = compress_chunks(chunks, encoding)
+        for chunk in chunks:
+            self.write(chunk)
+            await self.flush()
+        await self.finish()
+
+
+# squeue snapshots pushed to the client by the server-side poller whenever they change, so the cost of auto-reload
+# stays the same however many tabs are open
+class SqueueStreamHandler(WebSocketMixin, tornado.websocket.WebSocketHandler, JupyterHandler):
+    def initialize(self, squeue: str = None, poller: SqueuePoller = None, runner: CommandRunner = None,
+                   backend: SlurmBackend = None, metrics: SlurmMetrics = None, log=logger):
+        super().initialize()
+        self._slurm_command = squeue
+        self._poller = poller
+        self._metrics = metrics
+        if backend is None:
+            backend = CLIBackend({"squeue": squeue}, runner if runner is not None else CommandRunner(log=log), log=log)
+        self._backend = backend
+        self._serverlog = log
+        self._key = None
+
+    def set_default_headers(self):
+        # the JupyterHandler default headers don't make sense for websockets
+        pass
+
+    async def get(self, *args, **kwargs):
+        if self.current_user is None:
+            raise tornado.web.HTTPError(403)
+        self._user_only = self.get_query_argument('userOnly', 'true') == 'true'
+        await super().get(*args, **kwargs)
+
+    def open(self, *args, **kwargs):
+        super().open(*args, **kwargs)
+        user_only = self._user_only
+        self._key = self._backend.squeue_key(user_only)
+        self._serverlog.request("squeue/stream", "SqueueStreamHandler.open(): %s userOnly=%s", self._slurm_command,
+                                user_only)
+        self._poller.subscribe(self._key, lambda: self._backend.squeue(user_only), self.send_snapshot,
+                               cacheable=squeue_succeeded)
+
+    def send_snapshot(self, snapshot):
+        try:
+            self.write_message(json.dumps({
+                "version": snapshot.version,
+                "data": snapshot.data,
+                "squeue": snapshot.status
+                }))
+            if self._metrics is not None:
+                self._metrics.rows_returned.labels("stream").inc(len(snapshot.data))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_message(self, message):
+        # the client only listens, snapshots are pushed on the poller's schedule
+        pass
+
+    def on_close(self):
+        if self._key is not None:
+            self._poller.unsubscribe(self._key, self.send_snapshot)
+
+
+# A job's StdOut or StdErr file followed over a WebSocket. The file is found with scontrol show job, the client is
+# sent its last `lines` lines (found by reading backwards from the end), then only the bytes appended since the
+# previous message, checked every `interval` seconds, so following a multi-GB log never re-sends the file.
+#
+# Messages are JSON: {"path", "stream"} first, then {"offset", "data"} with data decoded from the file's bytes at
+# offset, {"reset": true} if the file was truncated and is being followed from the start again, or {"error"}.
+class JobOutputStreamHandler(WebSocketMixin, tornado.websocket.WebSocketHandler, JupyterHandler):
+    def initialize(self, scontrol: str = "scontrol", backend: SlurmBackend = None, runner: CommandRunner = None,
+                   interval: float = 1.0, log=logger):
+        super().initialize()
+        if backend is None:
+            backend = CLIBackend({"scontrol": scontrol}, runner if runner is not None else CommandRunner(log=log),
+                                 log=log)
+        self._backend = backend
+        self.interval = interval
+        self._serverlog = log
+        self._task = None
+
+    def set_default_headers(self):
+        # the JupyterHandler default headers don't make sense for websockets
+        pass
+
+    async def get(self, *args, **kwargs):
+        if self.current_user is None:
+            raise tornado.web.HTTPError(403)
+        self._jobID = self.get_query_argument('jobID')
+        if not jobIDMatcher.search(self._jobID):
+            raise tornado.web.HTTPError(400, "jobID {} is invalid".format(self._jobID))
+        self._stream = self.get_query_argument('stream', 'stdout')
+        if self._stream not in ('stdout', 'stderr'):
+            raise tornado.web.HTTPError(400, "stream must be stdout or stderr")
+        try:
+            self._lines = max(int(self.get_query_argument('lines', str(DEFAULT_TAIL_LINES))), 0)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "lines must be an integer")
+        try:
+            self._backend = cluster_backend(self._backend, self.get_query_argument('cluster', None))
+        except UnknownCluster as e:
+            raise tornado.web.HTTPError(400, e.message)
+        await super().get(*args, **kwargs)
+
+    def open(self, *args, **kwargs):
+        super().open(*args, **kwargs)
+        self._serverlog.request("job_output/stream", "JobOutputStreamHandler.open(): %s %s", self._jobID, self._stream)
+        self._task = asyncio.ensure_future(self.follow())
+
+    async def resolve_path(self):
+        out = await self._backend.show_job(self._jobID)
+        if out["returncode"] != 0 or not out["records"]:
+            raise FileNotFoundError(out["stderr"] or "job {} not found".format(self._jobID))
+        record = out["records"][0]
+        if self._stream == 'stderr':
+            return record.get("StdErr") or record.get("StdOut")
+        return record.get("StdOut")
+
+    async def follow(self):
+        try:
+            path = await self.resolve_path()
+            await self.write_message({"path": path, "stream": self._stream})
+
+            loop = asyncio.get_running_loop()
+            # files may be on a slow network filesystem, so they are only touched from the executor
+            offset = None
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            while True:
+                size = await loop.run_in_executor(None, file_size, path)
+                if size is not None:
+                    if offset is None:
+                        offset = await loop.run_in_executor(None, tail_offset, path, self._lines)
+                    elif size < offset:
+                        offset = 0
+                        decoder.reset()
+                        await self.write_message({"reset": True})
+                    while offset < size:
+                        data = await loop.run_in_executor(None, read_range, path, offset)
+                        if not data:
+                            break
+                        await self.write_message({"offset": offset, "data": decoder.decode(data)})
+                        offset += len(data)
+                await asyncio.sleep(self.interval)
+        except (asyncio.CancelledError, tornado.websocket.WebSocketClosedError):
+            pass
+        except CommandBusy as busy:
+            await self.send_error_message(busy.message)
+        except Exception as e:
+            self._serverlog.exception(e)
+            await self.send_error_message(str(e))
 
-            data = out["stdout"].splitlines()
-            # self._serverlog.info("SqueueHandler stdout: {}".format(data))
-
-            for row in data:
-                # maxsplit=7 so we can still display squeue entries with final columns with spaces like the
-                # following: (burst_buffer/cray: dws_data_in: DataWarp REST API error: offline namespaces: [34831] -
-                # ask a system administrator to consult the dwmd log for more information
-                if len(row.split(maxsplit=7)) == 8:
-                    # html.escape because some job ID's might have '<'s and similar characters in them.
-                    # Also, hypothetically we could be Bobbytable'd without html.escape here,
-                    # e.g. if someone had as a jobname '<script>virus.js</script>'.
-                    data_list += [[(html.escape(entry)).strip()
-                                   for entry in row.split(maxsplit=7)]]
-                else:
-                    continue
-        except KeyError as ke:
-            self._serverlog.exception(ke)
-            responseMessage = "Failure: {}".format(self._slurm_command)
-            errorMessage = "Missing key before running command: {}".format(str(ke))
-            returncode = -1
-            data_list = []
+    async def send_error_message(self, message: str):
+        try:
+            await self.write_message({"error": message})
+            self.close()
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_message(self, message):
+        # the client only listens
+        pass
+
+    def on_close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+# Job history from sacct, including finished jobs, which squeue no longer lists. Requests are answered from the local
+# JobHistoryStore, which is brought up to date with an incremental sacct query at most once per refresh interval
+# (the history cache's ttl), shared by concurrent requests.
+#
+# Query arguments: offset, limit, sort (column name), order (asc|desc), q (filter on job ID, name, partition and
+# nodes) and state (comma separated states, e.g. FAILED,TIMEOUT)
+class SacctHandler(SlurmCommandHandler):
+    command_name = "sacct"
+
+    def initialize(self, sacct: str = "sacct", store: JobHistoryStore = None, history_cache: SnapshotCache = None,
+                   runner: CommandRunner = None, backend: SlurmBackend = None, log=logger):
+        super().initialize(sacct, runner=runner, backend=backend, log=log)
+        self._store = store
+        self._history_cache = history_cache
+        if self._history_cache is None:
+            self._history_cache = SnapshotCache(ttl=0, stale_ttl=0, log=log)
+
+    async def refresh(self):
+        try:
+            return await self._history_cache.get(
+                "sacct", lambda: refresh_history(self._store, self._slurm_command, self._runner, getpass.getuser()),
+                cacheable=history_succeeded)
+        except CommandBusy as busy:
+            # the stored history is still served, only its refresh was skipped
+            self._serverlog.warning(busy.message)
+            return {
+                "responseMessage": "Busy: {}".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": busy.message,
+                "retryAfter": busy.retry_after
+                }
         except Exception as e:
             self._serverlog.exception(e)
-            responseMessage = "Failure: {}".format(self._slurm_command)
-            errorMessage = "Unhandled Exception: {}".format(str(e))
-            returncode = -1
-            data_list = []
-        finally:
             return {
-                "data": data_list[:],
-                "squeue": {
-                    "responseMessage": responseMessage,
-                    "returncode": returncode,
-                    "errorMessage": errorMessage
-                    }
+                "responseMessage": "Failure: {}".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": "Unhandled Exception: {}".format(str(e))
                 }
 
-    # we want to limit the rate at which this is called for a user
     @tornado.web.authenticated
     async def get(self):
-        self._serverlog.info("SqueueHandler.get() {}".format(self._slurm_command))
-        out = {
-            "returncode": -1,
-            "stderr": "Command did not run!",
-            "stdout": ""
-            }
-        data_dict = {"data": []}
+        self._serverlog.request("sacct", "SacctHandler.get(): %s", self._slurm_command)
+        data_dict = {"columns": SACCT_COLUMNS, "total": 0, "offset": 0, "data": []}
         try:
-            out = await self.run_command()
-            # self._serverlog.info("SqueueHandler response: {}".format(out))
-            data = out["data"]
-            # self._serverlog.info("SqueueHandler stdout: {}".format(data))
+            data_dict["sacct"] = await self.refresh()
+            states = self.get_query_argument('state', default='')
+            offset = max(int(self.get_query_argument('offset', default='0')), 0)
+            data_dict["offset"] = offset
+            data_dict["total"], data_dict["data"] = await self._store.run(
+                self._store.query,
+                q=self.get_query_argument('q', default=''),
+                states=[state.strip().upper() for state in states.split(",") if state.strip()],
+                sort=self.get_query_argument('sort', default='end'),
+                descending=self.get_query_argument('order', default='desc') == 'desc',
+                offset=offset,
+                limit=max(int(self.get_query_argument('limit', default='100')), 0))
+        except ValueError as e:
+            self.set_status(400)
+            data_dict["sacct"] = {
+                "responseMessage": "Failure: {} invalid query".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": str(e)
+                }
+        except Exception as e:
+            self._serverlog.exception(e)
+            data_dict["sacct"] = {
+                "responseMessage": "Failure: {}".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": "Unhandled Exception: {}".format(str(e))
+                }
+        finally:
+            await self.finish(json.dumps(data_dict))
 
-            data_dict = {
-                "data": data,
-                "squeue": out
+
+# Cluster capacity per partition (node states, CPUs, GPUs and memory), aggregated on the server from one sinfo
+# snapshot shared by every session, so the frontend gets a short summary instead of a row per node
+#
+# With several clusters (clusters: name -> sinfo command), every cluster is queried at once and cached separately.
+# Partitions are tagged with their cluster, and each cluster's status and total are returned under "clusters"; a
+# cluster that doesn't answer within timeout is left out, or its last overview used.
+class SinfoHandler(SlurmCommandHandler):
+    command_name = "sinfo"
+
+    def initialize(self, sinfo: str = "sinfo", sinfo_cache: SnapshotCache = None, runner: CommandRunner = None,
+                   backend: SlurmBackend = None, clusters: dict = None, timeout: float = 10.0, log=logger):
+        super().initialize(sinfo, runner=runner, backend=backend, log=log)
+        self._sinfo_cache = sinfo_cache
+        if self._sinfo_cache is None:
+            self._sinfo_cache = SnapshotCache(ttl=0, stale_ttl=0, log=log)
+        self._clusters = clusters
+        self._timeout = timeout
+
+    async def cluster_sinfo(self, cluster: str, sinfo: str):
+        try:
+            data_dict = await asyncio.wait_for(
+                self._sinfo_cache.get(("sinfo", cluster), lambda: query_sinfo(sinfo, self._runner),
+                                      cacheable=sinfo_succeeded), self._timeout)
+            if sinfo_succeeded(data_dict):
+                return data_dict
+            status = data_dict["sinfo"]
+        except asyncio.TimeoutError:
+            status = {
+                "responseMessage": "Failure: sinfo on {}".format(cluster),
+                "returncode": -1,
+                "errorMessage": "no answer within {} seconds".format(self._timeout)
+                }
+        except CommandBusy as busy:
+            status = {
+                "responseMessage": "Busy: sinfo on {}".format(cluster),
+                "returncode": -1,
+                "errorMessage": busy.message
                 }
+        cached = self._sinfo_cache.peek(("sinfo", cluster))
+        if cached is not None:
+            return dict(cached.value, sinfo=dict(status, stale=True))
+        return {"partitions": [], "total": None, "sinfo": status}
+
+    async def federated_sinfo(self):
+        clusters = list(self._clusters)
+        results = await asyncio.gather(*[self.cluster_sinfo(cluster, self._clusters[cluster])
+                                         for cluster in clusters])
+        failed = [cluster for cluster, result in zip(clusters, results) if not sinfo_succeeded(result)]
+        return {
+            "partitions": [dict(partition, cluster=cluster)
+                           for cluster, result in zip(clusters, results) for partition in result["partitions"]],
+            "total": None,
+            "clusters": {cluster: {"sinfo": result["sinfo"], "total": result["total"]}
+                         for cluster, result in zip(clusters, results)},
+            "sinfo": {
+                "responseMessage": "Success: sinfo on {} of {} clusters".format(len(clusters) - len(failed),
+                                                                             len(clusters)),
+                "returncode": 0,
+                "errorMessage": "\n".join("{}: {}".format(cluster, result["sinfo"]["errorMessage"])
+                                          for cluster, result in zip(clusters, results) if cluster in failed)
+                }
+            }
+
+    @tornado.web.authenticated
+    async def get(self):
+        self._serverlog.request("sinfo", "SinfoHandler.get(): %s", self._slurm_command)
+        data_dict = {"partitions": [], "total": None}
+        try:
+            if self._clusters:
+                data_dict = await self.federated_sinfo()
+            else:
+                data_dict = await self._sinfo_cache.get(
+                    "sinfo", lambda: query_sinfo(self._slurm_command, self._runner), cacheable=sinfo_succeeded)
+        except CommandBusy as busy:
+            data_dict["sinfo"] = self.busy_response(busy)
         except Exception as e:
-            self._serverlog.exception("Unhandled Exception: {}".format(e))
-            data_dict = {"data": [], "squeue": out}
+            self._serverlog.exception(e)
+            data_dict["sinfo"] = {
+                "responseMessage": "Failure: {}".format(self._slurm_command),
+                "returncode": -1,
+                "errorMessage": "Unhandled Exception: {}".format(str(e))
+                }
         finally:
-            # finish(chunk) writes chunk to the output
-            # buffer and ends the HTTP request
             await self.finish(json.dumps(data_dict))
 
 
+def make_backend(settings: dict, paths: dict, runner: CommandRunner, cluster: str = None, log=logger):
+    if settings.get('slurm_backend', 'cli') == 'slurmrestd':
+        # one pool of keep-alive connections to slurmrestd instead of a process per request
+        return SlurmrestdBackend(settings['slurmrestd_url'],
+                                 api_version=settings.get('slurmrestd_api_version', 'v0.0.40'),
+                                 token=settings.get('slurmrestd_token') or None,
+                                 max_connections=settings.get('slurmrestd_max_connections', 8),
+                                 timeout=settings.get('command_timeout', 60.0),
+                                 log=log)
+    return CLIBackend(paths, runner, squeue_format=settings.get('squeue_format', 'text'), cluster=cluster, log=log)
+
+
 def setup_handlers(web_app, temporary_directory=None, log=None):
-    if log:
-        log.debug(web_app.settings)
+    # handlers are created for every request, so everything they use is made here once, including the sampled log
+    log = SlurmLog(log or logger.logger, rate=web_app.settings.get('log_request_rate', 1.0),
+                   burst=web_app.settings.get('log_request_burst', 10),
+                   payloads=web_app.settings.get('log_payloads', False))
+    log.debug(redact_settings(web_app.settings))
 
     host_pattern = ".*$"
 
@@ -533,23 +1368,100 @@ def setup_handlers(web_app, temporary_directory=None, log=None):
     scancel_path = obtain_path("scancel")
     scontrol_path = obtain_path("scontrol")
     sbatch_path = obtain_path("sbatch")
+    sacct_path = obtain_path("sacct")
+    sinfo_path = obtain_path("sinfo")
 
     base_url = web_app.settings['base_url']
 
+    metrics = SlurmMetrics()
+    # one squeue cache for the whole server process, shared by every tab and every user request
+    squeue_cache = SnapshotCache(ttl=web_app.settings.get('squeue_cache_ttl', 5.0),
+                                 stale_ttl=web_app.settings.get('squeue_cache_stale_ttl', 30.0),
+                                 history=web_app.settings.get('squeue_cache_history', 4),
+                                 name="squeue", metrics=metrics, log=log)
+    # admission control and timeouts shared by every handler, so bursts of requests or a slow slurmctld can't leave
+    # an unbounded number of commands running
+    runner = CommandRunner(concurrency=web_app.settings.get('command_concurrency'),
+                           queue_depth=web_app.settings.get('command_queue_depth'),
+                           retry_after=web_app.settings.get('busy_retry_after', 1000),
+                           timeouts=web_app.settings.get('command_timeouts'),
+                           default_timeout=web_app.settings.get('command_timeout', 60.0),
+                           kill_grace=web_app.settings.get('kill_grace_period', 5.0),
+                           max_processes=web_app.settings.get('max_subprocesses', 32),
+                           metrics=metrics, log=log)
+    paths = {"squeue": squeue_path, "scancel": scancel_path, "scontrol": scontrol_path, "sbatch": sbatch_path,
+             "sinfo": sinfo_path}
+    clusters = web_app.settings.get('clusters') or {}
+    sinfo_clusters = None
+    if clusters:
+        members = {}
+        sinfo_clusters = {}
+        for name, options in clusters.items():
+            settings = dict(web_app.settings, **(options or {}))
+            cluster_paths = {command: settings.get(command + '_path', path) for command, path in paths.items()}
+            # clusters without commands or a slurmrestd of their own are reached through the default ones with -M
+            flag = settings.get('slurm_backend', 'cli') == 'cli' and not any(
+                command + '_path' in (options or {}) for command in paths)
+            members[name] = make_backend(settings, cluster_paths, runner, cluster=name if flag else None,
+                                         log=log)
+            sinfo_clusters[name] = cluster_paths["sinfo"] + (" -M {}".format(shlex.quote(name)) if flag else "")
+        backend = FederatedBackend(members, timeout=web_app.settings.get('cluster_timeout', 10.0),
+                                   cache_ttl=web_app.settings.get('squeue_cache_ttl', 5.0),
+                                   cache_stale_ttl=web_app.settings.get('squeue_cache_stale_ttl', 30.0),
+                                   metrics=metrics, log=log)
+    else:
+        backend = make_backend(web_app.settings, paths, runner, log=log)
+    history_store = JobHistoryStore(
+        web_app.settings.get('sacct_db_path') or os.path.join(jupyter_data_dir(), "jupyterlab_slurm", "sacct.sqlite"),
+        history_days=web_app.settings.get('sacct_history_days', 14.0), log=log)
+    history_cache = SnapshotCache(ttl=web_app.settings.get('sacct_refresh_interval', 60.0), stale_ttl=0, name="sacct",
+                                  metrics=metrics, log=log)
+    job_detail_cache = JobDetailCache(web_app.settings.get('job_detail_cache_size', 1024), metrics=metrics)
+    # a partition overview changes slowly, the previous one is served for another interval while sinfo runs again
+    sinfo_cache = SnapshotCache(ttl=web_app.settings.get('sinfo_refresh_interval', 30.0),
+                                stale_ttl=web_app.settings.get('sinfo_refresh_interval', 30.0), name="sinfo",
+                                metrics=metrics, log=log)
+    squeue_poller = SqueuePoller(squeue_cache, interval=web_app.settings.get('squeue_poll_interval', 15.0),
+                                 log=log)
+    # one token bucket per user, shared by their tabs and any scripts calling the API
+    squeue_rate_limiter = RateLimiter(web_app.settings.get('squeue_rate_limit', 2.0),
+                                      web_app.settings.get('squeue_rate_burst', 20))
+
     handlers = [
         (url_path_join(base_url, "jupyterlab_slurm", "get_example"), ExampleHandler, dict(log=log)),
         (url_path_join(base_url, "jupyterlab_slurm", "user"), UserFetchHandler, dict(log=log)),
-        (url_path_join(base_url, 'jupyterlab_slurm', 'squeue'), SqueueHandler, dict(squeue=squeue_path, log=log)),
-        (url_path_join(base_url, 'jupyterlab_slurm', 'scancel'), ScancelHandler, dict(scancel=scancel_path, log=log)),
+        (url_path_join(base_url, "jupyterlab_slurm", "metrics"), MetricsHandler, dict(metrics=metrics, log=log)),
+        (url_path_join(base_url, 'jupyterlab_slurm', 'squeue'), SqueueHandler,
+         dict(squeue=squeue_path, squeue_cache=squeue_cache, runner=runner, backend=backend, metrics=metrics,
+              rate_limiter=squeue_rate_limiter, log=log)),
+        (url_path_join(base_url, 'jupyterlab_slurm', 'squeue', 'stream'), SqueueStreamHandler,
+         dict(squeue=squeue_path, poller=squeue_poller, runner=runner, backend=backend, metrics=metrics,
+              log=log)),
+        (url_path_join(base_url, 'jupyterlab_slurm', 'scancel'), ScancelHandler,
+         dict(scancel=scancel_path, squeue_cache=squeue_cache, runner=runner, backend=backend, log=log)),
         (url_path_join(base_url, 'jupyterlab_slurm', 'scontrol', '(?P<action>.*)'), ScontrolHandler,
-         dict(scontrol=scontrol_path, log=log)),
+         dict(scontrol=scontrol_path, squeue_cache=squeue_cache, runner=runner, backend=backend,
+              job_detail_cache=job_detail_cache, log=log)),
+        (url_path_join(base_url, 'jupyterlab_slurm', 'job_output', 'stream'), JobOutputStreamHandler,
+         dict(scontrol=scontrol_path, backend=backend, runner=runner,
+              interval=web_app.settings.get('job_output_poll_interval', 1.0), log=log)),
+        (url_path_join(base_url, 'jupyterlab_slurm', 'sacct'), SacctHandler,
+         dict(sacct=sacct_path, store=history_store, history_cache=history_cache, runner=runner, backend=backend,
+              log=log)),
+        (url_path_join(base_url, 'jupyterlab_slurm', 'sinfo'), SinfoHandler,
+         dict(sinfo=sinfo_path, sinfo_cache=sinfo_cache, runner=runner, backend=backend, clusters=sinfo_clusters,
+              timeout=web_app.settings.get('cluster_timeout', 10.0), log=log)),
         (url_path_join(base_url, 'jupyterlab_slurm', 'sbatch'), SbatchHandler,
-         dict(sbatch=sbatch_path, temporary_directory=temporary_directory, log=log))
+         dict(sbatch=sbatch_path, temporary_directory=temporary_directory, squeue_cache=squeue_cache, runner=runner,
+              backend=backend, bulk_parallelism=web_app.settings.get('sbatch_bulk_parallelism', 4),
+              bulk_max_jobs=web_app.settings.get('sbatch_bulk_max_jobs', 1000),
+              max_body_size=web_app.settings.get('sbatch_max_body_size', 64 * 1024 * 1024), log=log))
         ]
 
     if log:
-        log.info("Slurm command paths: \nsqueue: {}\nscancel: {}\nscontrol: {}\nsbatch: {}\n".format(
-            squeue_path, scancel_path, scontrol_path, sbatch_path
+        log.info("Slurm command paths: \nsqueue: {}\nscancel: {}\nscontrol: {}\nsbatch: {}\nsacct: {}\n"
+                 "sinfo: {}\n".format(
+            squeue_path, scancel_path, scontrol_path, sbatch_path, sacct_path, sinfo_path
             ))
 
         log.info("Starting up handlers....\n")
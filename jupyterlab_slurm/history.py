@@ -0,0 +1,196 @@
+import asyncio
+import concurrent.futures
+import functools
+import html
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.Logger(__file__)
+
+# sacct fields stored for every job, in the order of the rows returned to clients
+SACCT_FIELDS = ["JobID", "JobName", "Partition", "User", "State", "Submit", "Start", "End", "Elapsed", "ExitCode",
+                "NNodes", "NodeList"]
+COLUMNS = ["jobid", "name", "partition", "user", "state", "submit", "start", "end", "elapsed", "exitcode", "nnodes",
+           "nodelist"]
+
+# seconds of overlap between incremental sacct queries, so jobs changing while sacct runs are not missed
+SACCT_OVERLAP = 60
+
+SACCT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    jobid TEXT PRIMARY KEY,
+    name TEXT,
+    partition TEXT,
+    user TEXT,
+    state TEXT,
+    submit TEXT,
+    start TEXT,
+    end TEXT,
+    elapsed TEXT,
+    exitcode TEXT,
+    nnodes INTEGER,
+    nodelist TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS jobs_end ON jobs (end);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def sacct_time(timestamp: float):
+    return time.strftime(SACCT_TIME_FORMAT, time.localtime(timestamp))
+
+
+def sacct_command(sacct: str, start: float, user: str = None):
+    # -X: allocations only, not their steps. -P: '|' separated, so names with spaces survive
+    command = "{} -X -P -n -S {} -E now -o {}".format(sacct, sacct_time(start), ",".join(SACCT_FIELDS))
+    if user is not None:
+        command += " -u {}".format(user)
+    return command
+
+
+def like_pattern(q: str):
+    # matches q anywhere, with LIKE's wildcards in it matched literally: a search for job_1 doesn't match jobX1
+    return "%{}%".format(q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+
+
+def parse_sacct_row(line: str):
+    entries = line.rstrip("\n").split("|")
+    if len(entries) != len(SACCT_FIELDS):
+        return None
+    record = dict(zip(COLUMNS, entries))
+    # "CANCELLED by 1234" -> "CANCELLED"
+    record["state"] = record["state"].split(" ")[0]
+    for column in ("submit", "start", "end"):
+        if record[column] in ("Unknown", "None", ""):
+            record[column] = None
+    try:
+        record["nnodes"] = int(record["nnodes"])
+    except ValueError:
+        record["nnodes"] = 0
+    return record
+
+
+# Finished and running jobs from sacct, kept in a SQLite database so history survives restarts and is only ever
+# fetched incrementally: each refresh asks sacct for the jobs active since the previous refresh (the high-water mark)
+# and upserts them, rather than querying slurmdbd for the whole history window again. Jobs that ended more than
+# history_days ago are dropped.
+#
+# The methods are blocking: handlers call them through run(), on the one thread that owns the SQLite connection.
+class JobHistoryStore:
+    def __init__(self, path: str, history_days: float = 14, log=logger):
+        self.path = path
+        self.history_days = history_days
+        self._serverlog = log
+        self._connection = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sacct-history")
+
+    async def run(self, method, *args, **kwargs):
+        """Run one of the store's methods on its database thread, off the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(method, *args, **kwargs))
+
+    @property
+    def _db(self):
+        # opened on first use, so servers where nobody looks at the history never create the database
+        if self._connection is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    @property
+    def high_water_mark(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'high_water_mark'").fetchone()
+        return float(row[0]) if row is not None else None
+
+    def next_start(self, now: float = None):
+        """Start time (epoch) of the next sacct query."""
+        now = time.time() if now is None else now
+        oldest = now - self.history_days * 86400
+        high_water_mark = self.high_water_mark
+        if high_water_mark is None:
+            return oldest
+        return max(high_water_mark - SACCT_OVERLAP, oldest)
+
+    def update(self, records: list, high_water_mark: float):
+        """Upsert records and move the high-water mark, in one transaction."""
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO jobs ({columns}) VALUES ({values}) ON CONFLICT (jobid) DO UPDATE SET {updates}".format(
+                    columns=", ".join(COLUMNS),
+                    values=", ".join(":" + column for column in COLUMNS),
+                    updates=", ".join("{0} = excluded.{0}".format(column) for column in COLUMNS[1:])),
+                records)
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('high_water_mark', ?)",
+                             (str(high_water_mark),))
+            self._db.execute("DELETE FROM jobs WHERE end < ?",
+                             (sacct_time(high_water_mark - self.history_days * 86400),))
+
+    def query(self, q: str = "", states: list = None, sort: str = "end", descending: bool = True, offset: int = 0,
+              limit: int = 100):
+        """Filter, sort and page the stored jobs, returning (number of matching jobs, rows in the page)."""
+        if sort not in COLUMNS:
+            raise ValueError("Unknown sort column {}".format(sort))
+        conditions = []
+        parameters = []
+        if states:
+            conditions.append("state IN ({})".format(", ".join("?" * len(states))))
+            parameters += states
+        if q:
+            conditions.append("({})".format(" OR ".join(
+                "{} LIKE ? ESCAPE '\\'".format(column) for column in ("jobid", "name", "partition", "nodelist"))))
+            parameters += [like_pattern(q)] * 4
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+
+        total = self._db.execute("SELECT COUNT(*) FROM jobs {}".format(where), parameters).fetchone()[0]
+        # running jobs have no end time yet and sort as the most recent
+        order = "{} IS NULL {}, {} {}".format(sort, "DESC" if descending else "ASC", sort,
+                                              "DESC" if descending else "ASC")
+        rows = self._db.execute("SELECT {} FROM jobs {} ORDER BY {} LIMIT ? OFFSET ?".format(
+            ", ".join(COLUMNS), where, order), parameters + [limit, offset]).fetchall()
+        return total, [[html.escape(str(value)) if value is not None else "" for value in row] for row in rows]
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def close(self):
+        # the connection can only be closed by the thread that opened it
+        self._executor.submit(self._close).result()
+        self._executor.shutdown()
+
+
+# runs sacct from the store's high-water mark and stores what changed, the value cached (and so shared by concurrent
+# requests) is the command status
+async def refresh_history(store: JobHistoryStore, sacct: str, runner, user: str = None):
+    started = time.time()
+    exec_command = sacct_command(sacct, await store.run(store.next_start, started), user)
+    out = await runner.run(exec_command)
+    if out["returncode"] != 0:
+        return {
+            "responseMessage": "Failure: {}".format(exec_command),
+            "returncode": out["returncode"],
+            "errorMessage": out["stderr"]
+            }
+
+    records = [record for record in map(parse_sacct_row, out["stdout"].splitlines()) if record is not None]
+    await store.run(store.update, records, started)
+    return {
+        "responseMessage": "Success: {} ({} jobs updated)".format(exec_command, len(records)),
+        "returncode": 0,
+        "errorMessage": ""
+        }
+
+
+def history_succeeded(status: dict):
+    return status["returncode"] == 0
@@ -0,0 +1,82 @@
+import mmap
+import os
+
+# files larger than this are read through mmap rather than read()
+MMAP_THRESHOLD = 1024 * 1024
+
+# most bytes read (and sent to a client) at once
+READ_CHUNK_SIZE = 1024 * 1024
+
+# block size when scanning backwards from the end of a file for the last lines
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# lines of existing output sent when a client starts following a file
+DEFAULT_TAIL_LINES = 100
+
+
+def parse_scontrol_record(line: str):
+    """One record of scontrol show -o output (Key=Value Key=Value ...) as a dict.
+
+    Values may contain spaces (Command=, Comment=, Reason=), so words without a key are appended to the previous
+    value.
+    """
+    record = {}
+    key = None
+    for word in line.strip().split(" "):
+        name, separator, value = word.partition("=")
+        if separator and name and (name[0].isupper() or name[0].isdigit()) and " " not in name:
+            key = name
+            record[key] = value
+        elif key is not None:
+            record[key] += " " + word
+    return record
+
+
+def parse_scontrol_output(stdout: str):
+    return [parse_scontrol_record(line) for line in stdout.splitlines() if "=" in line]
+
+
+def read_range(path: str, offset: int, limit: int = READ_CHUNK_SIZE):
+    """Up to limit bytes of path from offset, memory mapped for large files so only that range is paged in."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset >= size:
+            return b""
+        end = min(size, offset + limit)
+        if size < MMAP_THRESHOLD:
+            f.seek(offset)
+            return f.read(end - offset)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped[offset:end]
+
+
+def tail_offset(path: str, lines: int):
+    """Offset of the start of the last `lines` lines of path, found by reading blocks backwards from the end."""
+    with open(path, "rb") as f:
+        position = os.fstat(f.fileno()).st_size
+        if position == 0 or lines <= 0:
+            return position
+        # a trailing newline ends the last line rather than starting an empty one
+        f.seek(position - 1)
+        newlines = -1 if f.read(1) == b"\n" else 0
+        while position > 0:
+            start = max(0, position - TAIL_BLOCK_SIZE)
+            f.seek(start)
+            block = f.read(position - start)
+            index = len(block)
+            while True:
+                index = block.rfind(b"\n", 0, index)
+                if index < 0:
+                    break
+                newlines += 1
+                if newlines == lines:
+                    return start + index + 1
+            position = start
+        return 0
+
+
+def file_size(path: str):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,171 @@
+import html
+import json
+import sys
+import time
+from array import array
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# squeue's compact state codes
+JOB_STATE_CODES = {
+    "BOOT_FAIL": "BF", "CANCELLED": "CA", "COMPLETED": "CD", "CONFIGURING": "CF", "COMPLETING": "CG",
+    "DEADLINE": "DL", "FAILED": "F", "NODE_FAIL": "NF", "OUT_OF_MEMORY": "OOM", "PENDING": "PD",
+    "PREEMPTED": "PR", "RUNNING": "R", "RESV_DEL_HOLD": "RD", "REQUEUE_FED": "RF", "REQUEUE_HOLD": "RH",
+    "REQUEUED": "RQ", "RESIZING": "RS", "REVOKED": "RV", "SIGNALING": "SI", "SPECIAL_EXIT": "SE",
+    "STAGE_OUT": "SO", "STOPPED": "ST", "SUSPENDED": "S", "TIMEOUT": "TO"
+    }
+
+# jobs in these states are no longer in the queue, squeue doesn't list them by default
+FINISHED_JOB_STATES = {"BOOT_FAIL", "CANCELLED", "COMPLETED", "DEADLINE", "FAILED", "NODE_FAIL", "OUT_OF_MEMORY",
+                       "PREEMPTED", "TIMEOUT"}
+
+# array task ID stored for jobs that aren't array tasks, and for pending array ranges, which sort after their tasks
+NO_TASK = -1
+TASK_RANGE = 2 ** 62
+
+
+def number(value):
+    # newer Slurm JSON wraps numbers as {"set": true, "infinite": false, "number": 42}
+    if isinstance(value, dict):
+        if not value.get("set", True) or value.get("infinite", False):
+            return None
+        return value.get("number")
+    return value
+
+
+def job_states(job: dict):
+    states = job.get("job_state", [])
+    return [states] if isinstance(states, str) else list(states)
+
+
+def format_duration(seconds: int):
+    # as squeue's %M: [days-][hours:]minutes:seconds
+    days, seconds = divmod(max(int(seconds), 0), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return "{}-{:02d}:{:02d}:{:02d}".format(days, hours, minutes, seconds)
+    if hours:
+        return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+    return "{}:{:02d}".format(minutes, seconds)
+
+
+def job_ids(job: dict):
+    """(JOBID as squeue prints it, job ID, array task ID) of a job."""
+    array_job_id = number(job.get("array_job_id"))
+    if array_job_id:
+        array_task_id = number(job.get("array_task_id"))
+        if array_task_id is not None:
+            return "{}_{}".format(array_job_id, array_task_id), array_job_id, array_task_id
+        return "{}_[{}]".format(array_job_id, job.get("array_task_string", "")), array_job_id, TASK_RANGE
+    het_job_id = number(job.get("het_job_id"))
+    if het_job_id:
+        offset = number(job.get("het_job_offset")) or 0
+        return "{}+{}".format(het_job_id, offset), het_job_id, offset
+    return str(job.get("job_id")), number(job.get("job_id")) or 0, NO_TASK
+
+
+def decode_jobs(text: str, output_format: str = "json"):
+    """The job list of squeue --json/--yaml output, and its errors."""
+    if output_format == "yaml":
+        if yaml is None:
+            raise ValueError("squeue --yaml output needs PyYAML installed")
+        document = yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    elif orjson is not None:
+        document = orjson.loads(text)
+    else:
+        document = json.loads(text)
+    errors = [error.get("description") or error.get("error") or str(error)
+              for error in document.get("errors") or []]
+    return document.get("jobs") or [], errors
+
+
+# The jobs of one squeue snapshot in columns: numbers in typed arrays and the few distinct partition, user and
+# state values interned, rather than a list of eight strings per job. Rows in the squeue output format are
+# produced from it, and the typed columns sort without parsing the formatted text again.
+class JobTable:
+    def __init__(self):
+        self.jobid = []
+        self.job_id = array("q")
+        self.task_id = array("q")
+        self.partition = []
+        self.name = []
+        self.user = []
+        self.state = []
+        self.elapsed = array("q")
+        self.node_count = array("q")
+        self.nodelist = []
+
+    @classmethod
+    def from_jobs(cls, jobs: list, user: str = None, now: float = None):
+        """Table of the queued jobs (not the finished ones) in Slurm's JSON job list, only user's if given."""
+        table = cls()
+        now = time.time() if now is None else now
+        intern = sys.intern
+        for job in jobs:
+            states = job_states(job)
+            if "COMPLETING" not in states and any(state in FINISHED_JOB_STATES for state in states):
+                continue
+            if user is not None and job.get("user_name") != user:
+                continue
+
+            state = next((s for s in states if s in JOB_STATE_CODES), states[0] if states else "")
+            start_time = number(job.get("start_time")) or 0
+            if state in ("RUNNING", "COMPLETING", "SUSPENDED") and start_time:
+                elapsed = now - start_time - (number(job.get("suspend_time")) or 0)
+            else:
+                elapsed = 0
+            if state == "PENDING":
+                nodelist = "({})".format(job.get("state_reason", "None"))
+            else:
+                nodelist = job.get("nodes") or ""
+
+            jobid, job_id, task_id = job_ids(job)
+            table.jobid.append(jobid)
+            table.job_id.append(job_id)
+            table.task_id.append(task_id)
+            table.partition.append(intern(str(job.get("partition", ""))))
+            table.name.append(str(job.get("name", "")))
+            table.user.append(intern(str(job.get("user_name", ""))))
+            table.state.append(intern(JOB_STATE_CODES.get(state, state)))
+            table.elapsed.append(max(int(elapsed), 0))
+            table.node_count.append(number(job.get("node_count")) or 0)
+            table.nodelist.append(str(nodelist))
+        return table
+
+    def __len__(self):
+        return len(self.jobid)
+
+    def row(self, i: int):
+        # html.escape as for the text squeue output, job names and reasons are user supplied
+        return [html.escape(entry).strip() for entry in (
+            self.jobid[i],
+            self.partition[i],
+            self.name[i],
+            self.user[i],
+            self.state[i],
+            format_duration(self.elapsed[i]),
+            str(self.node_count[i]),
+            self.nodelist[i]
+            )]
+
+    def rows(self):
+        return [self.row(i) for i in range(len(self))]
+
+    def sort_keys(self, column: int):
+        """Sort keys of the typed columns (JOBID, TIME, NODES), None for the text ones."""
+        if column == 0:
+            return list(zip(self.job_id, self.task_id))
+        if column == 5:
+            return self.elapsed
+        if column == 6:
+            return self.node_count
+        return None
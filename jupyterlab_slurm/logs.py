@@ -0,0 +1,41 @@
+import logging
+
+from .ratelimit import RateLimiter
+
+
+# The server extension's log: a LoggerAdapter over the server's logger, so it is passed around (as `log`) and used
+# like one, with two additions.
+#
+# request(endpoint, msg, *args, **fields) logs a request at INFO with %-style arguments, only formatted if the record
+# is emitted, and the fields (plus the endpoint) attached to the record as attributes for structured formatters. Each
+# endpoint may log `rate` records a second (after a burst of `burst`), so request logging is bounded however much
+# traffic there is; the next record emitted says how many were dropped.
+#
+# payload(endpoint, name, value) logs a request body, batch script or command output at DEBUG, only if payloads is
+# set (the log_payloads setting): they may be large and contain anything.
+class SlurmLog(logging.LoggerAdapter):
+    def __init__(self, logger: logging.Logger, rate: float = 1.0, burst: int = 10, payloads: bool = False):
+        super().__init__(logger, {})
+        self._sampler = RateLimiter(rate, burst)
+        self._dropped = {}
+        self.payloads = payloads
+
+    def process(self, msg, kwargs):
+        return msg, kwargs
+
+    def request(self, endpoint: str, msg: str, *args, **fields):
+        if not self.isEnabledFor(logging.INFO):
+            return
+        if self._sampler.take(endpoint) > 0:
+            self._dropped[endpoint] = self._dropped.get(endpoint, 0) + 1
+            return
+        dropped = self._dropped.pop(endpoint, 0)
+        if dropped:
+            msg += " (%d more %s requests not logged)"
+            args += (dropped, endpoint)
+        fields["endpoint"] = endpoint
+        self.logger.info(msg, *args, extra=fields)
+
+    def payload(self, endpoint: str, name: str, value):
+        if self.payloads and self.isEnabledFor(logging.DEBUG):
+            self.logger.debug("%s %s: %s", endpoint, name, value, extra={"endpoint": endpoint})
@@ -0,0 +1,50 @@
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+
+# command durations range from a few ms (scontrol on an idle cluster) to minutes (squeue against a stuck slurmctld)
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+# The extension's Prometheus metrics, served at /jupyterlab_slurm/metrics. They have their own registry rather than
+# the global one jupyter_server exports at /metrics, so several servers in one process (e.g. tests) don't collide.
+class SlurmMetrics:
+    def __init__(self, registry: CollectorRegistry = None):
+        self.registry = registry if registry is not None else CollectorRegistry()
+        self.command_duration = Histogram(
+            "jupyterlab_slurm_command_duration_seconds", "Time taken by Slurm commands, including queueing",
+            ["command"], buckets=DURATION_BUCKETS, registry=self.registry)
+        self.command_exits = Counter(
+            "jupyterlab_slurm_command_exits_total", "Slurm commands run, by exit code",
+            ["command", "returncode"], registry=self.registry)
+        self.command_timeouts = Counter(
+            "jupyterlab_slurm_command_timeouts_total", "Slurm commands terminated for running too long",
+            ["command"], registry=self.registry)
+        self.command_busy = Counter(
+            "jupyterlab_slurm_command_busy_total", "Requests rejected because their command was at its limit",
+            ["command"], registry=self.registry)
+        self.rate_limited = Counter(
+            "jupyterlab_slurm_rate_limited_total", "Requests over their user's rate limit, by endpoint",
+            ["endpoint"], registry=self.registry)
+        self.subprocesses = Gauge(
+            "jupyterlab_slurm_subprocesses", "Slurm command processes running or being terminated",
+            registry=self.registry)
+        self.output_bytes = Counter(
+            "jupyterlab_slurm_command_output_bytes_total", "Bytes of Slurm command output parsed",
+            ["command"], registry=self.registry)
+        self.rows_returned = Counter(
+            "jupyterlab_slurm_squeue_rows_returned_total", "squeue rows sent to clients",
+            ["response"], registry=self.registry)
+        self.cache_lookups = Counter(
+            "jupyterlab_slurm_cache_lookups_total",
+            "Snapshot cache lookups, by result: hit (fresh), stale (served while refreshing), shared (waited for "
+            "a fetch already running) or miss",
+            ["cache", "result"], registry=self.registry)
+
+    def observe_command(self, command: str, duration: float, returncode: int = None, output_bytes: int = 0):
+        self.command_duration.labels(command).observe(duration)
+        if returncode is not None:
+            self.command_exits.labels(command, str(returncode)).inc()
+        if output_bytes:
+            self.output_bytes.labels(command).inc(output_bytes)
+
+    def exposition(self):
+        return generate_latest(self.registry)
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+from .cache import SnapshotCache
+
+logger = logging.Logger(__file__)
+
+
+# Runs squeue once per interval on behalf of every subscribed client and broadcasts changed snapshots.
+#
+# There is one polling task per cache key (e.g. userOnly=true vs. userOnly=false), started by the first subscriber
+# and stopped once the last subscriber leaves, so an idle server runs no squeue at all.
+class SqueuePoller:
+    def __init__(self, cache: SnapshotCache, interval: float = 15.0, log=logger):
+        self._cache = cache
+        self.interval = interval
+        self._serverlog = log
+        self._subscribers = {}
+        self._tasks = {}
+        self._latest = {}
+
+    def subscribe(self, key, fetch, callback, cacheable=None):
+        """Call callback(snapshot) with the latest squeue snapshot for key, and again whenever it changes."""
+        self._subscribers.setdefault(key, set()).add(callback)
+        if key in self._latest:
+            callback(self._latest[key])
+        if key not in self._tasks:
+            self._serverlog.info("SqueuePoller: starting poller for {}".format(key))
+            self._tasks[key] = asyncio.ensure_future(self._poll(key, fetch, cacheable))
+
+    def unsubscribe(self, key, callback):
+        subscribers = self._subscribers.get(key)
+        if subscribers is None:
+            return
+        subscribers.discard(callback)
+        if not subscribers:
+            self._serverlog.info("SqueuePoller: no subscribers left, pausing poller for {}".format(key))
+            del self._subscribers[key]
+            self._latest.pop(key, None)
+            task = self._tasks.pop(key, None)
+            if task is not None:
+                task.cancel()
+
+    def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._subscribers.clear()
+        self._latest.clear()
+
+    async def _poll(self, key, fetch, cacheable):
+        while self._subscribers.get(key):
+            try:
+                snapshot = await self._cache.get(key, fetch, cacheable=cacheable, allow_stale=False)
+                previous = self._latest.get(key)
+                if previous is None or snapshot.version != previous.version:
+                    self._latest[key] = snapshot
+                    for callback in list(self._subscribers.get(key, ())):
+                        callback(snapshot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._serverlog.exception(e)
+            await asyncio.sleep(self.interval)
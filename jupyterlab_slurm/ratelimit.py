@@ -0,0 +1,51 @@
+import time
+
+
+class TokenBucket:
+    def __init__(self, burst: int, now: float):
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, rate: float, burst: int, now: float):
+        self.tokens = min(float(burst), self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+# A token bucket per key, e.g. (user, endpoint): each key may make `burst` requests at once, then `rate` requests a
+# second. take() spends a token and returns 0, or returns the seconds until the next token without spending one.
+#
+# Buckets that have refilled completely are the same as new ones, so they are dropped once there are more than
+# `max_keys` of them.
+class RateLimiter:
+    def __init__(self, rate: float, burst: int, max_keys: int = 1024, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = {}
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def take(self, key):
+        if not self.enabled:
+            return 0.0
+        now = self._clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+        else:
+            bucket.refill(self.rate, self.burst, now)
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0.0
+        return (1 - bucket.tokens) / self.rate
+
+    def _prune(self, now: float):
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(self.rate, self.burst, now)
+            if bucket.tokens >= self.burst:
+                del self._buckets[key]
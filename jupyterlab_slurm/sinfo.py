@@ -0,0 +1,116 @@
+import re
+import time
+
+# one line per node and partition: name, partition, state, CPUs (allocated/idle/other/total), memory and free memory
+# (MB), generic resources
+SINFO_OUTPUT_FORMAT = "-h -N -o '%N|%P|%T|%C|%m|%e|%G'"
+
+# node state names are followed by flags, e.g. "idle~" (powered down) or "down*" (not responding)
+stateMatcher = re.compile(r"^[a-z_]+")
+
+# gpu:4, gpu:a100:4 or gpu:a100:4(S:0-1) in a node's generic resources
+gpuMatcher = re.compile(r"(?:^|,)gpu(?::[^:,(]+)?:([0-9]+)")
+
+
+def sinfo_command(sinfo: str):
+    return "{} {}".format(sinfo, SINFO_OUTPUT_FORMAT)
+
+
+def number(value: str):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def parse_sinfo_row(line: str):
+    entries = line.strip().split("|")
+    if len(entries) != 7:
+        return None
+    node, partition, state, cpus, memory, free_memory, gres = entries
+    cpus = cpus.split("/")
+    if len(cpus) != 4:
+        return None
+    match = stateMatcher.match(state.lower())
+    return {
+        "node": node,
+        "partition": partition.rstrip("*"),
+        "default": partition.endswith("*"),
+        "state": match.group(0) if match is not None else "unknown",
+        "cpus": [number(count) for count in cpus],
+        "memory": number(memory),
+        "free_memory": number(free_memory),
+        "gpus": sum(int(count) for count in gpuMatcher.findall(gres)),
+    }
+
+
+def empty_summary(name: str):
+    return {
+        "partition": name,
+        "default": False,
+        "nodes": 0,
+        "states": {},
+        "cpus": {"allocated": 0, "idle": 0, "other": 0, "total": 0},
+        "gpus": {"idle": 0, "total": 0},
+        "memory": {"free": 0, "total": 0}
+    }
+
+
+def add_node(summary: dict, node: dict):
+    summary["nodes"] += 1
+    summary["states"][node["state"]] = summary["states"].get(node["state"], 0) + 1
+    for name, count in zip(("allocated", "idle", "other", "total"), node["cpus"]):
+        summary["cpus"][name] += count
+    summary["gpus"]["total"] += node["gpus"]
+    # sinfo doesn't say which GPUs are allocated, only nodes with nothing running on them count as idle
+    if node["state"] == "idle":
+        summary["gpus"]["idle"] += node["gpus"]
+    summary["memory"]["total"] += node["memory"]
+    summary["memory"]["free"] += node["free_memory"]
+
+
+def summarize_nodes(lines):
+    """Per partition node state counts, CPU, GPU and memory totals, plus the same over every (distinct) node."""
+    partitions = {}
+    total = empty_summary("")
+    seen = set()
+    for node in map(parse_sinfo_row, lines):
+        if node is None:
+            continue
+        summary = partitions.get(node["partition"])
+        if summary is None:
+            summary = partitions[node["partition"]] = empty_summary(node["partition"])
+        summary["default"] = summary["default"] or node["default"]
+        add_node(summary, node)
+        # nodes in several partitions are counted once in the total
+        if node["node"] not in seen:
+            seen.add(node["node"])
+            add_node(total, node)
+    del total["partition"], total["default"]
+    return list(partitions.values()), total
+
+
+# runs sinfo and aggregates it, the value cached and shared by every session
+async def query_sinfo(sinfo: str, runner):
+    exec_command = sinfo_command(sinfo)
+    out = await runner.run(exec_command)
+    data_dict = {"partitions": [], "total": None, "timestamp": time.time()}
+    if out["returncode"] != 0:
+        data_dict["sinfo"] = {
+            "responseMessage": "Failure: {}".format(exec_command),
+            "returncode": out["returncode"],
+            "errorMessage": out["stderr"]
+            }
+        return data_dict
+
+    data_dict["partitions"], data_dict["total"] = summarize_nodes(out["stdout"].splitlines())
+    data_dict["sinfo"] = {
+        "responseMessage": "Success: {}".format(exec_command),
+        "returncode": 0,
+        "errorMessage": ""
+        }
+    return data_dict
+
+
+def sinfo_succeeded(data_dict: dict):
+    return data_dict["sinfo"]["returncode"] == 0
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import re
+
+jobIDSortMatcher = re.compile(r"^([0-9]+)(?:[_+]([0-9]+))?")
+
+# column indices of the squeue output format, CLUSTER is added to the rows of several clusters merged together
+JOBID_COLUMN = 0
+TIME_COLUMN = 5
+CLUSTER_COLUMN = 8
+
+
+def jobid_sort_key(jobid: str):
+    # array and heterogeneous jobs sort by (job, task), e.g. 100_2 < 100_10 < 101, pending ranges after their tasks
+    match = jobIDSortMatcher.match(jobid)
+    if match is None:
+        return (1, 0, 0, jobid)
+    task = match.group(2)
+    return (0, int(match.group(1)), int(task) if task is not None else float("inf"), jobid)
+
+
+def time_sort_key(duration: str):
+    # squeue TIME is [days-][hours:]minutes:seconds
+    try:
+        days, _, clock = duration.rpartition("-")
+        seconds = 0
+        for part in clock.split(":"):
+            seconds = seconds * 60 + int(part)
+        return (0, seconds + int(days or 0) * 86400, duration)
+    except ValueError:
+        return (1, 0, duration)
+
+
+def value_sort_key(value: str):
+    # numbers compare as numbers and sort before text
+    try:
+        return (0, float(value), value)
+    except ValueError:
+        return (1, 0, value)
+
+
+COLUMN_SORT_KEYS = {
+    JOBID_COLUMN: jobid_sort_key,
+    TIME_COLUMN: time_sort_key
+    }
+
+# number of distinct filter queries per snapshot whose matching rows are remembered
+QUERY_CACHE_SIZE = 8
+
+# number of distinct response bodies per snapshot whose compressed bytes are kept
+ENCODED_CACHE_SIZE = 8
+
+
+def cluster_row_key(row: list):
+    # job IDs are only unique within a cluster
+    return "{}@{}".format(row[JOBID_COLUMN], row[CLUSTER_COLUMN])
+
+
+# The parsed rows of one squeue run together with the command status. Snapshots are immutable once built and are
+# shared between requests through the SnapshotCache, so derived data (JOBID index, deltas) is computed once.
+#
+# Snapshots of structured squeue output (--json, --yaml, slurmrestd) also keep the JobTable the rows were made from,
+# whose typed columns are used for sorting.
+#
+# Rows are identified by JOBID, or by row_key(row) (e.g. cluster_row_key) when job IDs alone are not unique.
+class SqueueSnapshot:
+    def __init__(self, data: list, status: dict, table=None, row_key=None):
+        self.data = data
+        self.status = status
+        self.table = table
+        self.row_key = row_key
+        # content hash, so identical queues always get the same version and ETag
+        self.version = hashlib.sha1(json.dumps([data, status]).encode()).hexdigest()[:20]
+        self._by_jobid = None
+        self._deltas = {}
+        self._search_index = None
+        self._orders = {}
+        self._matches = {}
+        self._encoded = {}
+
+    @property
+    def succeeded(self):
+        return self.status["returncode"] == 0
+
+    @property
+    def by_jobid(self):
+        if self._by_jobid is None:
+            if self.row_key is not None:
+                self._by_jobid = {self.row_key(row): row for row in self.data}
+            else:
+                self._by_jobid = {row[JOBID_COLUMN]: row for row in self.data}
+        return self._by_jobid
+
+    def delta_since(self, previous: "SqueueSnapshot"):
+        """Rows added and changed, and JOBIDs (row keys) removed, going from previous to this snapshot."""
+        delta = self._deltas.get(previous.version)
+        if delta is None:
+            old = previous.by_jobid
+            new = self.by_jobid
+            delta = {
+                "added": [row for jobid, row in new.items() if jobid not in old],
+                "changed": [row for jobid, row in new.items() if jobid in old and old[jobid] != row],
+                "removed": [jobid for jobid in old if jobid not in new]
+                }
+            self._deltas[previous.version] = delta
+        return delta
+
+    @property
+    def search_index(self):
+        # one lowercase haystack per row, cells separated so a query never matches across two cells
+        if self._search_index is None:
+            self._search_index = ["\0".join(row).lower() for row in self.data]
+        return self._search_index
+
+    def sort_order(self, column: int, descending: bool = False):
+        """Row indices sorted by column, the sort keys of each column are computed once per snapshot."""
+        order = self._orders.get((column, descending))
+        if order is None:
+            ascending = self._orders.get((column, False))
+            if ascending is None:
+                keys = self.table.sort_keys(column) if self.table is not None else None
+                if keys is None:
+                    sort_key = COLUMN_SORT_KEYS.get(column, value_sort_key)
+                    keys = [sort_key(row[column]) for row in self.data]
+                ascending = sorted(range(len(keys)), key=keys.__getitem__)
+                self._orders[(column, False)] = ascending
+            order = ascending if not descending else ascending[::-1]
+            self._orders[(column, descending)] = order
+        return order
+
+    def matching(self, q: str):
+        """The set of row indices containing q (case-insensitive) in any cell."""
+        matches = self._matches.get(q)
+        if matches is None:
+            needle = q.lower()
+            matches = {i for i, haystack in enumerate(self.search_index) if needle in haystack}
+            if len(self._matches) >= QUERY_CACHE_SIZE:
+                self._matches.pop(next(iter(self._matches)))
+            self._matches[q] = matches
+        return matches
+
+    def encoded(self, key, build):
+        """The response body for key (format, encoding and anything else in the body), built once per snapshot."""
+        body = self._encoded.get(key)
+        if body is None:
+            if len(self._encoded) >= ENCODED_CACHE_SIZE:
+                self._encoded.pop(next(iter(self._encoded)))
+            body = self._encoded[key] = build()
+        return body
+
+    def query(self, q: str = "", sort: int = None, descending: bool = False, offset: int = 0, limit: int = None):
+        """Filter, sort and page the rows, returning (number of matching rows, rows in the page)."""
+        if sort is not None:
+            indices = self.sort_order(sort, descending)
+        else:
+            indices = range(len(self.data))
+
+        if q:
+            matches = self.matching(q)
+            indices = [i for i in indices if i in matches]
+            total = len(matches)
+        else:
+            total = len(self.data)
+
+        end = None if limit is None else offset + limit
+        return total, [self.data[i] for i in indices[offset:end]]
@@ -0,0 +1,44 @@
+import itertools
+import math
+import re
+
+# {{name}} placeholders in a sweep template
+placeholderMatcher = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}")
+
+# job ID in sbatch's output, "Submitted batch job 1234" or "1234;cluster" with --parsable
+submittedJobIDMatcher = re.compile(r"(?:Submitted batch job |^)([0-9]+)")
+
+
+class InvalidSweep(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def parameter_grid(parameters: dict, max_points: int = None):
+    """Every combination of the parameter values, e.g. {"a": [1, 2], "b": [3]} -> [{"a": 1, "b": 3}, {"a": 2, ...}]"""
+    if not isinstance(parameters, dict):
+        raise InvalidSweep("parameters must map parameter names to lists of values")
+    for name, values in parameters.items():
+        if not isinstance(values, list) or len(values) == 0:
+            raise InvalidSweep("parameter {} must be a non-empty list of values".format(name))
+    # checked before the grid is built, a handful of long value lists can describe billions of points
+    points = math.prod(len(values) for values in parameters.values())
+    if max_points is not None and points > max_points:
+        raise InvalidSweep("{} parameter combinations, at most {} jobs may be submitted at once".format(
+            points, max_points))
+    names = list(parameters)
+    return [dict(zip(names, values)) for values in itertools.product(*(parameters[name] for name in names))]
+
+
+def expand_template(template: str, point: dict):
+    def replace(match):
+        name = match.group(1)
+        if name not in point:
+            raise InvalidSweep("template placeholder {{{{{}}}}} has no parameter".format(name))
+        return str(point[name])
+    return placeholderMatcher.sub(replace, template)
+
+
+def submitted_jobid(stdout: str):
+    match = submittedJobIDMatcher.search(stdout.strip())
+    return match.group(1) if match is not None else None
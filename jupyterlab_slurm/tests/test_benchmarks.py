@@ -0,0 +1,194 @@
+# Latency, throughput and memory benchmarks of the handlers against stub Slurm commands.
+#
+# Skipped unless JUPYTERLAB_SLURM_BENCHMARK names the JSON file to write results to, e.g.
+#
+#   JUPYTERLAB_SLURM_BENCHMARK=bench-$(git rev-parse --short HEAD).json python -m pytest -q -k benchmark
+#
+# and tuned with JUPYTERLAB_SLURM_BENCHMARK_ROWS (squeue rows, comma separated), _LATENCY (seconds each stub command
+# takes), _CLIENTS (concurrent clients) and _REQUESTS (requests per endpoint). Compare two result files with
+# python -m jupyterlab_slurm.tests.test_benchmarks old.json new.json
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+import pytest
+
+import jupyterlab_slurm
+from .test_handlers import write_stub
+
+RESULTS_PATH = os.environ.get("JUPYTERLAB_SLURM_BENCHMARK")
+ROWS = [int(rows) for rows in os.environ.get("JUPYTERLAB_SLURM_BENCHMARK_ROWS", "10,1000,10000,100000").split(",")]
+LATENCY = float(os.environ.get("JUPYTERLAB_SLURM_BENCHMARK_LATENCY", "0.05"))
+CLIENTS = int(os.environ.get("JUPYTERLAB_SLURM_BENCHMARK_CLIENTS", "10"))
+REQUESTS = int(os.environ.get("JUPYTERLAB_SLURM_BENCHMARK_REQUESTS", "50"))
+
+pytestmark = pytest.mark.skipif(not RESULTS_PATH, reason="set JUPYTERLAB_SLURM_BENCHMARK to run the benchmarks")
+
+# name: (path, request keyword arguments)
+ENDPOINTS = {
+    "squeue": (("squeue",), dict(params={"userOnly": "false"})),
+    "squeue_columnar": (("squeue",), dict(params={"userOnly": "false", "format": "columnar"})),
+    "squeue_page": (("squeue",), dict(params={"userOnly": "false", "sort": "5", "order": "desc", "limit": "50",
+                                              "q": "regular"})),
+    "scancel": (("scancel",), dict(method="DELETE", allow_nonstandard_methods=True,
+                                   headers={"Content-Type": "application/json"},
+                                   body=json.dumps({"jobIDs": ["1001", "1002"]}))),
+    "scontrol": (("scontrol", "hold"), dict(method="PATCH", headers={"Content-Type": "application/json"},
+                                            body=json.dumps({"jobIDs": ["1001", "1002"]}))),
+    "sbatch": (("sbatch",), dict(method="POST", params={"inputType": "contents"},
+                                 headers={"Content-Type": "application/json"},
+                                 body=json.dumps({"input": "#!/bin/sh\n#SBATCH -N 1\nsrun hostname\n"}))),
+}
+
+results = []
+
+
+@pytest.fixture(scope="module", autouse=True)
+def benchmark_results():
+    yield results
+    if RESULTS_PATH and results:
+        with open(RESULTS_PATH, "w") as f:
+            json.dump({
+                "version": jupyterlab_slurm.__version__,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "latency": LATENCY,
+                "clients": CLIENTS,
+                "requests": REQUESTS,
+                "results": results
+            }, f, indent=2)
+
+
+@pytest.fixture
+def rows():
+    return 10
+
+
+@pytest.fixture
+def slurm_bin(tmp_path, rows):
+    bin_dir = tmp_path / "slurm_bin"
+    bin_dir.mkdir()
+    (bin_dir / "squeue.out").write_text("".join(
+        "{} {} job_{} user{} {} {}:{:02d} {} nid[{:05d}-{:05d}]\n".format(
+            100000 + i, ("debug", "regular", "shared")[i % 3], i, i % 50, ("R", "PD")[i % 2], i % 60, i % 60,
+            i % 8 + 1, i, i + i % 8) for i in range(rows)
+    ))
+    write_stub(bin_dir / "squeue", "sleep {}\ncat {}\n".format(LATENCY, bin_dir / "squeue.out"))
+    write_stub(bin_dir / "sbatch", "sleep {}\ncat > /dev/null\necho Submitted batch job 1\n".format(LATENCY))
+    for command in ("scancel", "scontrol"):
+        write_stub(bin_dir / command, "sleep {}\n".format(LATENCY))
+    return bin_dir
+
+
+@pytest.fixture
+def jp_server_config(slurm_bin):
+    return {
+        "ServerApp": {"jpserver_extensions": {"jupyterlab_slurm": True}},
+        "SlurmCommandPaths": {
+            "squeue_path": str(slurm_bin / "squeue"),
+            "scancel_path": str(slurm_bin / "scancel"),
+            "scontrol_path": str(slurm_bin / "scontrol"),
+            "sbatch_path": str(slurm_bin / "sbatch"),
+            # measure the handlers, not the admission limits
+            "command_queue_depth": {"squeue": REQUESTS, "sbatch": REQUESTS, "scancel": REQUESTS,
+                                    "scontrol": REQUESTS},
+            "squeue_rate_limit": 0,
+        },
+    }
+
+
+def rss_mb():
+    # current resident set size of the server process (the test process) in MB
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2 ** 20 if sys.platform == "darwin" else maxrss / 2 ** 10
+
+
+def fetch(jp_fetch, endpoint: str):
+    path, kwargs = ENDPOINTS[endpoint]
+    # jp_fetch adds the server's token to headers, so every request gets its own copy
+    kwargs = dict(kwargs, headers=dict(kwargs.get("headers", {})))
+    return jp_fetch("jupyterlab_slurm", *path, raise_error=False, **kwargs)
+
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def measure(jp_fetch, endpoint: str):
+    latencies = []
+    errors = 0
+    peak_rss = rss_mb()
+    pending = iter(range(REQUESTS))
+
+    async def client():
+        nonlocal errors
+        for _ in pending:
+            start = time.perf_counter()
+            response = await fetch(jp_fetch, endpoint)
+            latencies.append(time.perf_counter() - start)
+            if response.code != 200:
+                errors += 1
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, rss_mb())
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.ensure_future(sample_rss())
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(CLIENTS)])
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+
+    return {
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "requests_per_second": round(REQUESTS / elapsed, 1),
+        "peak_rss_mb": round(max(peak_rss, rss_mb()), 1),
+        "errors": errors
+    }
+
+
+@pytest.mark.parametrize("rows", ROWS)
+@pytest.mark.parametrize("endpoint", list(ENDPOINTS))
+async def test_benchmark(jp_fetch, rows, endpoint):
+    # the first request pays for server start up and, for squeue, the first snapshot
+    await fetch(jp_fetch, endpoint)
+
+    result = {"endpoint": endpoint, "rows": rows, "clients": CLIENTS, "requests": REQUESTS}
+    result.update(await measure(jp_fetch, endpoint))
+    results.append(result)
+    assert result["errors"] == 0
+
+
+def compare(old_path: str, new_path: str):
+    """Print the change of every measurement between two result files."""
+    with open(old_path) as f:
+        old = {(r["endpoint"], r["rows"]): r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = {(r["endpoint"], r["rows"]): r for r in json.load(f)["results"]}
+
+    metrics = ("p50_ms", "p99_ms", "requests_per_second", "peak_rss_mb")
+    print("{:<16} {:>7} ".format("endpoint", "rows") + " ".join("{:>22}".format(m) for m in metrics))
+    for key in sorted(old.keys() & new.keys()):
+        changes = []
+        for metric in metrics:
+            before, after = old[key][metric], new[key][metric]
+            change = (after - before) / before * 100 if before else 0
+            changes.append("{:>10} {:>+10.1f}%".format(after, change))
+        print("{:<16} {:>7} ".format(*key) + " ".join(changes))
+
+
+if __name__ == "__main__":
+    compare(*sys.argv[1:3])
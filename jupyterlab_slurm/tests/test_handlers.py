@@ -1,4 +1,76 @@
+import asyncio
+import gzip
 import json
+import logging
+import os
+import stat
+import time
+
+import pytest
+import tornado.web
+from tornado.httpclient import HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from traitlets import TraitError
+
+from jupyterlab_slurm import _load_jupyter_server_extension, handlers
+from jupyterlab_slurm.config import SlurmCommandPaths
+from jupyterlab_slurm.encoding import COMPRESS_MIN_ROWS
+from jupyterlab_slurm.joboutput import tail_offset
+
+SQUEUE_ROWS = """\
+             1001     debug    job_a    alice  R       1:00      1 nid001
+             1002   regular    job_b      bob PD       0:00      2 (Priority)
+"""
+
+
+def write_stub(path, body):
+    path.write_text("#!/bin/sh\n" + body)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return path
+
+
+@pytest.fixture
+def slurm_bin(tmp_path):
+    bin_dir = tmp_path / "slurm_bin"
+    bin_dir.mkdir()
+    calls = bin_dir / "calls"
+    for command in ("squeue", "scancel", "scontrol", "sbatch"):
+        write_stub(bin_dir / command, "echo {} >> {}\n".format(command, calls))
+    # squeue is slow enough for concurrent requests to overlap
+    (bin_dir / "squeue.out").write_text(SQUEUE_ROWS)
+    write_stub(bin_dir / "squeue", "echo squeue >> {}\nsleep 0.3\ncat {}\n".format(calls, bin_dir / "squeue.out"))
+    return bin_dir
+
+
+@pytest.fixture
+def slurm_config():
+    # extra SlurmCommandPaths options, overridden by tests
+    return {}
+
+
+@pytest.fixture
+def jp_server_config(slurm_bin, slurm_config):
+    return {
+        "ServerApp": {"jpserver_extensions": {"jupyterlab_slurm": True}},
+        "SlurmCommandPaths": {
+            "squeue_path": str(slurm_bin / "squeue"),
+            "scancel_path": str(slurm_bin / "scancel"),
+            "scontrol_path": str(slurm_bin / "scontrol"),
+            "sbatch_path": str(slurm_bin / "sbatch"),
+            "sacct_path": str(slurm_bin / "sacct"),
+            "sinfo_path": str(slurm_bin / "sinfo"),
+            "sacct_db_path": str(slurm_bin / "sacct.sqlite"),
+            **slurm_config
+        },
+    }
+
+
+def command_calls(slurm_bin, command):
+    calls = slurm_bin / "calls"
+    if not calls.exists():
+        return 0
+    return calls.read_text().split().count(command)
 
 
 async def test_get_example(jp_fetch):
@@ -10,3 +82,701 @@ async def test_get_example(jp_fetch):
         "data": "This is the /jupyterlab_slurm/get_example endpoint!"
     }
     assert payload == expected_payload
+
+
+async def test_squeue_concurrent_requests_share_one_command(jp_fetch, slurm_bin):
+    responses = await asyncio.gather(*[
+        jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"}) for _ in range(5)
+    ])
+
+    for response in responses:
+        assert response.code == 200
+        payload = json.loads(response.body)
+        assert [row[0] for row in payload["data"]] == ["1001", "1002"]
+    assert command_calls(slurm_bin, "squeue") == 1
+
+    # a fresh snapshot is served from the cache
+    await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+    assert command_calls(slurm_bin, "squeue") == 1
+
+
+async def test_scancel_invalidates_squeue_cache(jp_fetch, slurm_bin):
+    await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+    await jp_fetch("jupyterlab_slurm", "scancel", method="DELETE", allow_nonstandard_methods=True,
+                   headers={"Content-Type": "application/json"}, body=json.dumps({"jobID": "1001"}))
+    await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+
+    assert command_calls(slurm_bin, "scancel") == 1
+    assert command_calls(slurm_bin, "squeue") == 2
+
+
+@pytest.mark.parametrize("slurm_config", [{
+    "squeue_rate_limit": 0.5, "squeue_rate_burst": 2, "squeue_cache_ttl": 0, "squeue_cache_stale_ttl": 0
+}])
+async def test_squeue_rate_limit_serves_last_snapshot(jp_fetch, slurm_bin):
+    # enough rows for compressed responses, which are kept with the snapshot
+    (slurm_bin / "squeue.out").write_text("".join(
+        "{} debug job_{} alice R 1:00 1 nid001\n".format(1000 + i, i) for i in range(COMPRESS_MIN_ROWS + 10)))
+    for _ in range(2):
+        response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"},
+                                  headers={"Accept-Encoding": "gzip"})
+        assert "Retry-After" not in response.headers
+
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"},
+                              headers={"Accept-Encoding": "gzip"}, decompress_response=False)
+    assert response.headers["Content-Encoding"] == "gzip"
+    payload = json.loads(gzip.decompress(response.body))
+
+    # over the limit, the expired snapshot is served rather than running squeue again
+    assert command_calls(slurm_bin, "squeue") == 2
+    assert [row[0] for row in payload["data"][:2]] == ["1000", "1001"]
+    assert response.headers["Retry-After"] == "2"
+    assert response.headers["X-Snapshot-Age"] == "0"
+    assert payload["retryAfter"] == 2000
+    assert payload["nextPollAfter"] == payload["retryAfter"]
+
+    # nothing to fall back on
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "true"}, raise_error=False)
+    assert response.code == 429
+    assert response.headers["Retry-After"] == "2"
+    assert command_calls(slurm_bin, "squeue") == 2
+
+
+@pytest.mark.parametrize("slurm_config", [{"log_request_rate": 0.001, "log_request_burst": 2}])
+async def test_request_logging_is_sampled(jp_fetch, jp_serverapp, slurm_bin):
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+
+    capture = Capture(level=logging.DEBUG)
+    jp_serverapp.log.addHandler(capture)
+    try:
+        for _ in range(4):
+            await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+        await jp_fetch("jupyterlab_slurm", "scontrol", "hold", method="PATCH",
+                       headers={"Content-Type": "application/json"}, body=json.dumps({"jobID": "1001"}))
+    finally:
+        jp_serverapp.log.removeHandler(capture)
+
+    endpoints = [getattr(record, "endpoint", None) for record in records]
+    # a burst of two per endpoint, request bodies only with log_payloads
+    assert endpoints.count("squeue") == 2
+    assert endpoints.count("scontrol") == 1
+    assert not any("jobID" in record.getMessage() for record in records)
+
+
+async def test_squeue_etag_and_delta(jp_fetch, slurm_bin):
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+    version = json.loads(response.body)["version"]
+    assert response.headers["Etag"] == '"{}"'.format(version)
+    # the snapshot is reused for squeue_cache_ttl
+    assert json.loads(response.body)["nextPollAfter"] == 5000
+    assert response.headers["X-Next-Poll-After"] == "5"
+
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"},
+                       headers={"If-None-Match": response.headers["Etag"]})
+    assert e.value.code == 304
+
+    (slurm_bin / "squeue.out").write_text(
+        SQUEUE_ROWS.splitlines()[0].replace(" R ", "CG ") + "\n"
+        "             1003     debug    job_c    alice PD       0:00      1 (Resources)\n"
+    )
+    # scancel drops the cached snapshot
+    await jp_fetch("jupyterlab_slurm", "scancel", method="DELETE", allow_nonstandard_methods=True,
+                   headers={"Content-Type": "application/json"}, body=json.dumps({"jobID": "1002"}))
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false", "since": version})
+    payload = json.loads(response.body)
+
+    assert payload["since"] == version
+    assert "data" not in payload
+    assert [row[0] for row in payload["delta"]["added"]] == ["1003"]
+    assert [row[4] for row in payload["delta"]["changed"]] == ["CG"]
+    assert payload["delta"]["removed"] == ["1002"]
+
+    # unknown versions get the full snapshot
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false", "since": "unknown"})
+    assert [row[0] for row in json.loads(response.body)["data"]] == ["1001", "1003"]
+
+
+async def test_squeue_stream_pushes_snapshots(jp_ws_fetch, slurm_bin):
+    first = await jp_ws_fetch("jupyterlab_slurm", "squeue", "stream", params={"userOnly": "false"})
+    second = await jp_ws_fetch("jupyterlab_slurm", "squeue", "stream", params={"userOnly": "false"})
+
+    for ws in (first, second):
+        payload = json.loads(await ws.read_message())
+        assert [row[0] for row in payload["data"]] == ["1001", "1002"]
+        ws.close()
+    # both subscribers were served by the same poll
+    assert command_calls(slurm_bin, "squeue") == 1
+
+
+async def test_squeue_pagination_sorting_and_filtering(jp_fetch, slurm_bin):
+    (slurm_bin / "squeue.out").write_text("".join(
+        "{:>17}_{} debug job_{} alice R 1:{:02d} 1 nid{:03d}\n".format(100, task, task, task, task)
+        for task in range(1, 13)
+    ))
+
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={
+        "userOnly": "false", "sort": "0", "order": "desc", "offset": "2", "limit": "3"
+    })
+    payload = json.loads(response.body)
+    assert payload["total"] == 12
+    assert [row[0] for row in payload["data"]] == ["100_10", "100_9", "100_8"]
+
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={
+        "userOnly": "false", "sort": "5", "q": "NID01", "limit": "10"
+    })
+    payload = json.loads(response.body)
+    assert payload["total"] == 3
+    assert [row[5] for row in payload["data"]] == ["1:10", "1:11", "1:12"]
+
+    for params in ({"sort": "8"}, {"sort": "-1"}, {"sort": "name"}, {"offset": "x"}, {"limit": "1.5"}):
+        response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false", **params},
+                                  raise_error=False)
+        assert response.code == 400
+        assert json.loads(response.body)["squeue"]["returncode"] == -1
+
+
+async def test_scancel_batches_job_ids(jp_fetch, slurm_bin):
+    write_stub(slurm_bin / "scancel", (
+        "echo scancel >> {}\n"
+        "echo \"scancel: error: Kill job error on job id 1002: Invalid job id specified\" >&2\n"
+        "exit 1\n"
+    ).format(slurm_bin / "calls"))
+
+    response = await jp_fetch("jupyterlab_slurm", "scancel", method="DELETE", allow_nonstandard_methods=True,
+                              headers={"Content-Type": "application/json"},
+                              body=json.dumps({"jobIDs": ["1001", "1002", "1003_[1-4]"]}))
+    payload = json.loads(response.body)
+
+    assert command_calls(slurm_bin, "scancel") == 1
+    assert payload["returncode"] == 1
+    assert [(result["jobID"], result["returncode"]) for result in payload["results"]] == [
+        ("1001", 0), ("1002", 1), ("1003_[1-4]", 0)
+    ]
+    assert "1002" in payload["errorMessage"]
+
+
+async def test_scontrol_rejects_invalid_job_ids(jp_fetch, slurm_bin):
+    response = await jp_fetch("jupyterlab_slurm", "scontrol", "hold", method="PATCH",
+                              headers={"Content-Type": "application/json"},
+                              body=json.dumps({"jobIDs": ["1001", "1002; rm -rf ~"]}))
+    payload = json.loads(response.body)
+
+    assert payload["returncode"] == -1
+    assert command_calls(slurm_bin, "scontrol") == 0
+
+
+@pytest.mark.parametrize("slurm_config", [{"squeue_cache_ttl": 0, "squeue_cache_stale_ttl": 0}])
+async def test_scontrol_show_caches_until_job_changes(jp_fetch, slurm_bin):
+    write_stub(slurm_bin / "scontrol", "echo scontrol >> {}\necho \"JobId=$4 JobName=job UserId=alice(1000) "
+                                       "JobState=RUNNING Command=/bin/run --all\"\n".format(slurm_bin / "calls"))
+
+    async def show():
+        response = await jp_fetch("jupyterlab_slurm", "scontrol", "show", params={"jobID": "1001,1002"})
+        return {job["jobID"]: job for job in json.loads(response.body)["jobs"]}
+
+    await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+    jobs = await show()
+    assert jobs["1001"]["records"] == [{"JobId": "1001", "JobName": "job", "UserId": "alice(1000)",
+                                        "JobState": "RUNNING", "Command": "/bin/run --all"}]
+    assert command_calls(slurm_bin, "scontrol") == 2
+
+    jobs = await show()
+    assert jobs["1001"]["cached"] and jobs["1002"]["cached"]
+    assert command_calls(slurm_bin, "scontrol") == 2
+
+    # 1001 ran for longer but is otherwise unchanged, 1002 left the queue
+    (slurm_bin / "squeue.out").write_text(SQUEUE_ROWS.replace("1:00", "1:05").splitlines()[0] + "\n")
+    await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+    jobs = await show()
+    assert jobs["1001"]["cached"] and not jobs["1002"]["cached"]
+    assert command_calls(slurm_bin, "scontrol") == 3
+
+    # 1001 is completing
+    (slurm_bin / "squeue.out").write_text(SQUEUE_ROWS.replace(" R ", "CG ").splitlines()[0] + "\n")
+    await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+    jobs = await show()
+    assert not jobs["1001"]["cached"] and jobs["1002"]["cached"]
+    assert command_calls(slurm_bin, "scontrol") == 4
+    await show()
+    assert command_calls(slurm_bin, "scontrol") == 4
+
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch("jupyterlab_slurm", "scontrol", "show", params={"jobID": "1001;reboot"})
+    assert e.value.code == 400
+
+
+async def test_squeue_streams_large_queues(jp_fetch, slurm_bin):
+    (slurm_bin / "squeue.out").write_text("".join(
+        "{} regular job_{} bob R 2:00 4 nid[{:04d}-{:04d}]\n".format(20000 + i, i, i, i + 3) for i in range(5000)
+    ))
+
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+    payload = json.loads(response.body)
+
+    assert payload["squeue"]["returncode"] == 0
+    assert len(payload["data"]) == 5000
+    assert payload["data"][-1] == ["24999", "regular", "job_4999", "bob", "R", "2:00", "4", "nid[4999-5002]"]
+
+
+@pytest.mark.parametrize("slurm_config", [{
+    "command_concurrency": {"scontrol": 1}, "command_queue_depth": {"scontrol": 0}, "busy_retry_after": 1500
+}])
+async def test_busy_commands_are_rejected(jp_fetch, slurm_bin):
+    write_stub(slurm_bin / "scontrol", "echo scontrol >> {}\nsleep 0.5\n".format(slurm_bin / "calls"))
+
+    responses = await asyncio.gather(*[
+        jp_fetch("jupyterlab_slurm", "scontrol", "hold", method="PATCH", raise_error=False,
+                 headers={"Content-Type": "application/json"}, body=json.dumps({"jobID": str(jobid)}))
+        for jobid in (1001, 1002)
+    ])
+
+    assert sorted(response.code for response in responses) == [200, 503]
+    busy = next(response for response in responses if response.code == 503)
+    assert busy.headers["Retry-After"] == "2"
+    assert json.loads(busy.body)["retryAfter"] == 1500
+    assert command_calls(slurm_bin, "scontrol") == 1
+
+
+async def test_metrics(jp_fetch, slurm_bin):
+    for _ in range(2):
+        await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+
+    response = await jp_fetch("jupyterlab_slurm", "metrics")
+    metrics = response.body.decode()
+
+    assert 'jupyterlab_slurm_command_duration_seconds_count{command="squeue"} 1.0' in metrics
+    assert 'jupyterlab_slurm_command_exits_total{command="squeue",returncode="0"} 1.0' in metrics
+    assert 'jupyterlab_slurm_cache_lookups_total{cache="squeue",result="miss"} 1.0' in metrics
+    assert 'jupyterlab_slurm_cache_lookups_total{cache="squeue",result="hit"} 1.0' in metrics
+    assert 'jupyterlab_slurm_squeue_rows_returned_total{response="full"} 4.0' in metrics
+    assert 'jupyterlab_slurm_command_output_bytes_total{{command="squeue"}} {:.1f}'.format(len(SQUEUE_ROWS)) in metrics
+    assert "jupyterlab_slurm_subprocesses 0.0" in metrics
+
+
+async def test_sinfo_partition_summary(jp_fetch, slurm_bin):
+    write_stub(slurm_bin / "sinfo", "echo sinfo >> {}\ncat <<EOF\n{}EOF\n".format(slurm_bin / "calls", (
+        "nid001|debug*|mixed|16/48/0/64|256000|100000|gpu:a100:4(S:0-1)\n"
+        "nid002|debug*|idle~|0/64/0/64|256000|250000|gpu:a100:4(S:0-1)\n"
+        "nid002|regular|idle~|0/64/0/64|256000|250000|gpu:a100:4(S:0-1)\n"
+        "nid003|regular|down*|0/0/64/64|256000|N/A|(null)\n"
+    )))
+
+    responses = await asyncio.gather(*[jp_fetch("jupyterlab_slurm", "sinfo") for _ in range(3)])
+    payload = json.loads(responses[0].body)
+
+    assert command_calls(slurm_bin, "sinfo") == 1
+    assert payload["sinfo"]["returncode"] == 0
+    debug, regular = payload["partitions"]
+    assert debug["partition"] == "debug" and debug["default"] and not regular["default"]
+    assert debug["states"] == {"mixed": 1, "idle": 1}
+    assert debug["cpus"] == {"allocated": 16, "idle": 112, "other": 0, "total": 128}
+    assert debug["gpus"] == {"idle": 4, "total": 8}
+    assert regular["states"] == {"idle": 1, "down": 1}
+    assert regular["memory"] == {"free": 250000, "total": 512000}
+    # nid002 is in both partitions but only counted once
+    assert payload["total"]["nodes"] == 3
+    assert payload["total"]["cpus"]["total"] == 192
+
+
+async def test_sbatch_streams_script_to_stdin(jp_fetch, slurm_bin):
+    submitted = slurm_bin / "submitted"
+    write_stub(slurm_bin / "sbatch", "cat >> {}\necho Submitted batch job 1\n".format(submitted))
+    # large enough to be spooled to a temporary file on the way
+    script = "#!/bin/sh\n" + "".join("echo {}\n".format(i) for i in range(200000))
+
+    for body, content_type in ((script, "text/plain"), (json.dumps({"input": "#!/bin/sh\nhostname\n"}),
+                                                        "application/json")):
+        response = await jp_fetch("jupyterlab_slurm", "sbatch", method="POST", params={"inputType": "contents"},
+                                  headers={"Content-Type": content_type}, body=body)
+        assert json.loads(response.body)["returncode"] == 0
+
+    assert submitted.read_text() == script + "#!/bin/sh\nhostname\n"
+
+
+class TestSbatchAdmission:
+    @pytest.fixture
+    def slurm_config(self):
+        return {"sbatch_max_body_size": 1024}
+
+    @pytest.fixture
+    def jp_server_config(self, jp_server_config):
+        # without the XSRF check, the handler itself has to turn away requests without a user
+        return dict(jp_server_config, ServerApp=dict(jp_server_config["ServerApp"], disable_check_xsrf=True))
+
+    async def test_sbatch_body_is_refused_before_it_is_read(self, jp_fetch, slurm_bin, monkeypatch):
+        spooled = []
+
+        class RecordingSpool(handlers.ScriptSpool):
+            def write(self, data):
+                spooled.append(data)
+                super().write(data)
+
+        monkeypatch.setattr(handlers, "ScriptSpool", RecordingSpool)
+        for headers, body, code in (({"Authorization": "token wrong"}, "#!/bin/sh\nhostname\n", 403),
+                                    ({}, "#!/bin/sh\n" + "hostname\n" * 200, 413)):
+            with pytest.raises(HTTPClientError) as error:
+                await jp_fetch("jupyterlab_slurm", "sbatch", method="POST", params={"inputType": "contents"},
+                               headers={"Content-Type": "text/plain", **headers}, body=body)
+            assert error.value.code == code
+        assert spooled == []
+        assert command_calls(slurm_bin, "sbatch") == 0
+
+
+@pytest.mark.parametrize("slurm_config", [{"sbatch_bulk_parallelism": 2}])
+async def test_sbatch_bulk_sweep(jp_fetch, slurm_bin):
+    write_stub(slurm_bin / "sbatch", (
+        "echo sbatch >> {}\n"
+        "script=$(cat)\n"
+        "case \"$script\" in *seed=3*) echo \"sbatch: error: invalid partition\" >&2; exit 1;; esac\n"
+        "echo \"Submitted batch job $(echo \"$script\" | sed -n 's/^#JOB //p')\"\n"
+    ).format(slurm_bin / "calls"))
+    await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+
+    response = await jp_fetch("jupyterlab_slurm", "sbatch", method="POST", params={"inputType": "bulk"},
+                              headers={"Content-Type": "application/json"},
+                              body=json.dumps({"template": "#!/bin/sh\n#JOB {{lr}}0{{seed}}\nrun --seed={{seed}}\n",
+                                               "parameters": {"lr": [1, 2], "seed": [1, 2, 3]}}))
+    lines = [json.loads(line) for line in response.body.decode().splitlines()]
+    results = sorted(lines[:-1], key=lambda result: result["index"])
+
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    assert [(result["parameters"], result["jobID"]) for result in results] == [
+        ({"lr": 1, "seed": 1}, "101"), ({"lr": 1, "seed": 2}, "102"), ({"lr": 1, "seed": 3}, None),
+        ({"lr": 2, "seed": 1}, "201"), ({"lr": 2, "seed": 2}, "202"), ({"lr": 2, "seed": 3}, None)
+    ]
+    assert "invalid partition" in results[2]["errorMessage"]
+    assert lines[-1]["submitted"] == 4 and lines[-1]["failed"] == 2 and lines[-1]["returncode"] == 1
+    assert command_calls(slurm_bin, "sbatch") == 6
+
+    # the sweep submitted jobs, so squeue runs again
+    await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+    assert command_calls(slurm_bin, "squeue") == 2
+
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch("jupyterlab_slurm", "sbatch", method="POST", params={"inputType": "bulk"},
+                       headers={"Content-Type": "application/json"},
+                       body=json.dumps({"template": "#!/bin/sh\nrun {{missing}}\n", "parameters": {"lr": [1]}}))
+    assert e.value.code == 400
+
+
+@pytest.mark.parametrize("slurm_config", [{"command_timeouts": {"scontrol": 0.3}, "kill_grace_period": 0.2}])
+async def test_timed_out_commands_are_killed(jp_fetch, slurm_bin):
+    pidfile = slurm_bin / "scontrol.pid"
+    # ignores SIGTERM, so it has to be killed
+    write_stub(slurm_bin / "scontrol", "trap '' TERM\necho $$ > {}\nexec sleep 30\n".format(pidfile))
+
+    response = await jp_fetch("jupyterlab_slurm", "scontrol", "hold", method="PATCH",
+                              headers={"Content-Type": "application/json"}, body=json.dumps({"jobID": "1001"}))
+    payload = json.loads(response.body)
+
+    assert payload["returncode"] == -1
+    assert "timed out" in payload["errorMessage"]
+    response = await jp_fetch("jupyterlab_slurm", "metrics")
+    assert 'jupyterlab_slurm_command_timeouts_total{command="scontrol"} 1.0' in response.body.decode()
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pidfile.read_text()), 0)
+
+
+async def test_squeue_compressed_response_next_poll_after(jp_fetch, slurm_bin):
+    (slurm_bin / "squeue.out").write_text("".join(
+        "{} debug job_{} alice R 1:00 1 nid001\n".format(1000 + i, i) for i in range(COMPRESS_MIN_ROWS + 10)))
+
+    next_poll_after = []
+    for _ in range(3):
+        response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"},
+                                  headers={"Accept-Encoding": "gzip"}, decompress_response=False)
+        assert response.headers["Content-Encoding"] == "gzip"
+        payload = json.loads(gzip.decompress(response.body))
+        assert payload["nextPollAfter"] == int(response.headers["X-Next-Poll-After"]) * 1000
+        next_poll_after.append(payload["nextPollAfter"])
+        await asyncio.sleep(1.2)
+
+    # the same snapshot, but the body says how much longer it stays fresh each time
+    assert command_calls(slurm_bin, "squeue") == 1
+    assert next_poll_after[0] > next_poll_after[1] > next_poll_after[2]
+
+
+async def test_squeue_columnar_compressed_response(jp_fetch, slurm_bin):
+    (slurm_bin / "squeue.out").write_text("".join(
+        "{} regular job_{} bob {} 2:00 4 nid{:04d}\n".format(20000 + i, i, "R" if i % 2 else "PD", i) for i in range(50)
+    ))
+
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false", "format": "columnar"},
+                              headers={"Accept-Encoding": "gzip"}, decompress_response=False)
+    assert response.headers["Content-Encoding"] == "gzip"
+    payload = json.loads(gzip.decompress(response.body))
+
+    assert payload["format"] == "columnar"
+    assert "data" not in payload
+    ids, partitions, _, _, states = payload["columns"][:5]
+    assert ids["values"][:2] == ["20000", "20001"]
+    assert partitions == {"dictionary": ["regular"], "codes": [0] * 50}
+    assert [states["dictionary"][code] for code in states["codes"][:3]] == ["PD", "R", "PD"]
+
+
+@pytest.mark.parametrize("slurm_config", [{"squeue_format": "json"}])
+async def test_squeue_json_output(jp_fetch, slurm_bin):
+    (slurm_bin / "squeue.out").write_text(json.dumps({"jobs": [
+        {"job_id": 1001, "partition": "debug", "name": "a rather long job name", "user_name": "alice",
+         "job_state": ["RUNNING"], "start_time": {"set": True, "infinite": False, "number": 1},
+         "nodes": "nid001", "node_count": {"set": True, "infinite": False, "number": 1}},
+        {"job_id": 1002, "partition": "regular", "name": "<b>", "user_name": "bob", "job_state": ["PENDING"],
+         "state_reason": "burst_buffer/datawarp: offline namespaces", "node_count": 16},
+        {"job_id": 1000, "partition": "debug", "name": "done", "user_name": "alice", "job_state": ["COMPLETED"]}
+    ], "errors": []}))
+
+    response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false", "sort": "5", "limit": "5"})
+    payload = json.loads(response.body)
+
+    assert payload["squeue"]["returncode"] == 0
+    assert payload["total"] == 2
+    assert payload["data"][0] == [
+        "1002", "regular", "&lt;b&gt;", "bob", "PD", "0:00", "16", "(burst_buffer/datawarp: offline namespaces)"
+    ]
+    assert payload["data"][1][2] == "a rather long job name"
+    assert payload["data"][1][4] == "R"
+
+
+@pytest.mark.parametrize("slurm_config", [{"job_output_poll_interval": 0.05}])
+async def test_job_output_stream_sends_appended_output(jp_ws_fetch, slurm_bin):
+    log = slurm_bin / "slurm-1001.out"
+    log.write_text("".join("line {}\n".format(i) for i in range(1000)))
+    write_stub(slurm_bin / "scontrol",
+               "echo 'JobId=1001 JobName=train JobState=RUNNING StdErr={0} StdOut={0}'\n".format(log))
+
+    ws = await jp_ws_fetch("jupyterlab_slurm", "job_output", "stream", params={"jobID": "1001", "lines": "2"})
+    assert json.loads(await ws.read_message()) == {"path": str(log), "stream": "stdout"}
+    message = json.loads(await ws.read_message())
+    assert message["data"] == "line 998\nline 999\n"
+    assert message["offset"] == log.stat().st_size - len(message["data"])
+
+    with log.open("a") as f:
+        f.write("line 1000\n")
+    message = json.loads(await ws.read_message())
+    assert message == {"offset": log.stat().st_size - len("line 1000\n"), "data": "line 1000\n"}
+    ws.close()
+
+    with pytest.raises(HTTPClientError) as error:
+        await jp_ws_fetch("jupyterlab_slurm", "job_output", "stream", params={"jobID": "1001", "lines": "abc"})
+    assert error.value.code == 400
+
+
+@pytest.mark.parametrize("text", ["a\nb\nc\n", "a\nb\nc"])
+def test_tail_offset(tmp_path, text):
+    path = tmp_path / "slurm-1.out"
+    path.write_text(text)
+
+    assert [text[tail_offset(str(path), lines):] for lines in (0, 1, 2, 5)] == [
+        "", text[4:], text[2:], text
+    ]
+
+
+@pytest.mark.parametrize("slurm_config", [{"sacct_refresh_interval": 0}])
+async def test_sacct_history_is_incremental(jp_fetch, slurm_bin, tmp_path):
+    write_stub(slurm_bin / "sacct", "echo \"$@\" >> {}\ncat {}\n".format(
+        slurm_bin / "sacct.args", slurm_bin / "sacct.out"))
+    hours_ago = [time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - hours * 3600)) for hours in range(4)]
+    (slurm_bin / "sacct.out").write_text(
+        "900|old job|debug|alice|COMPLETED|{3}|{3}|{2}|01:00:00|0:0|1|nid001\n"
+        "901|running|debug|alice|RUNNING|{1}|{1}|Unknown|01:00:00|0:0|2|nid[002-003]\n".format(*hours_ago)
+    )
+    response = await jp_fetch("jupyterlab_slurm", "sacct")
+    payload = json.loads(response.body)
+    assert payload["sacct"]["returncode"] == 0
+    assert [row[0] for row in payload["data"]] == ["901", "900"]
+
+    # the next query only asks for what changed since, and updates the stored jobs
+    (slurm_bin / "sacct.out").write_text(
+        "901|running|debug|alice|CANCELLED by 0|{1}|{1}|{0}|01:00:00|0:15|2|nid[002-003]\n".format(*hours_ago)
+    )
+    response = await jp_fetch("jupyterlab_slurm", "sacct", params={"state": "cancelled", "q": "nid"})
+    payload = json.loads(response.body)
+    assert payload["total"] == 1
+    assert payload["data"][0][payload["columns"].index("state")] == "CANCELLED"
+
+    starts = [args.split()[args.split().index("-S") + 1]
+              for args in (slurm_bin / "sacct.args").read_text().splitlines()]
+    assert len(starts) == 2 and starts[1] > starts[0]
+
+    # LIKE wildcards in a search match themselves only
+    response = await jp_fetch("jupyterlab_slurm", "sacct", params={"q": "old_job"})
+    assert json.loads(response.body)["total"] == 0
+    response = await jp_fetch("jupyterlab_slurm", "sacct", params={"q": "d j"})
+    assert json.loads(response.body)["total"] == 1
+
+    response = await jp_fetch("jupyterlab_slurm", "sacct", params={"sort": "jobid", "order": "asc", "limit": "1"})
+    payload = json.loads(response.body)
+    assert payload["total"] == 2
+    assert [row[0] for row in payload["data"]] == ["900"]
+
+
+SLURMRESTD_JOBS = [
+    {"job_id": 1001, "partition": "debug", "name": "job_a", "user_name": "alice", "job_state": ["RUNNING"],
+     "start_time": {"set": True, "infinite": False, "number": 1}, "nodes": "nid001",
+     "node_count": {"set": True, "infinite": False, "number": 1}},
+    {"job_id": 1003, "array_job_id": {"set": True, "number": 1002}, "array_task_id": {"set": False, "number": 0},
+     "array_task_string": "1-4", "partition": "regular", "name": "job_b", "user_name": "bob",
+     "job_state": ["PENDING"], "state_reason": "Priority", "node_count": 2},
+    {"job_id": 1000, "partition": "debug", "name": "done", "user_name": "alice", "job_state": ["COMPLETED"]}
+]
+
+
+class FakeSlurmrestd(tornado.web.RequestHandler):
+    def initialize(self, requests):
+        self.requests = requests
+
+    def get(self):
+        self.requests.append(("GET", self.request.path))
+        self.finish({"jobs": SLURMRESTD_JOBS, "errors": []})
+
+    def post(self, jobid):
+        self.requests.append(("POST", jobid, json.loads(self.request.body)))
+        self.finish({"job_id": 1004, "errors": []})
+
+    def delete(self, jobid):
+        self.requests.append(("DELETE", jobid, self.request.headers.get("X-SLURM-USER-TOKEN")))
+        if jobid == "1002_[1-4]":
+            self.finish({"errors": [{"description": "Invalid job id specified"}]})
+        else:
+            self.finish({"errors": []})
+
+
+class TestSlurmrestdBackend:
+    @pytest.fixture
+    def slurmrestd_socket(self):
+        sock = bind_sockets(0, "127.0.0.1")[0]
+        yield sock
+        sock.close()
+
+    @pytest.fixture
+    def slurm_config(self, slurmrestd_socket):
+        return {
+            "slurm_backend": "slurmrestd",
+            "slurmrestd_url": "http://127.0.0.1:{}".format(slurmrestd_socket.getsockname()[1]),
+            "slurmrestd_token": "secret"
+        }
+
+    async def test_requests_go_to_slurmrestd(self, jp_fetch, slurm_bin, slurmrestd_socket):
+        requests = []
+        connections = []
+
+        class CountingServer(HTTPServer):
+            def handle_stream(self, stream, address):
+                connections.append(address)
+                return super().handle_stream(stream, address)
+
+        server = CountingServer(tornado.web.Application([
+            (r"/slurm/v0.0.40/jobs", FakeSlurmrestd, dict(requests=requests)),
+            (r"/slurm/v0.0.40/job/(.*)", FakeSlurmrestd, dict(requests=requests))
+        ]))
+        server.add_sockets([slurmrestd_socket])
+        try:
+            response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+            payload = json.loads(response.body)
+            assert payload["squeue"]["returncode"] == 0
+            assert payload["data"][1] == ["1002_[1-4]", "regular", "job_b", "bob", "PD", "0:00", "2", "(Priority)"]
+            assert [row[0] for row in payload["data"]] == ["1001", "1002_[1-4]"]
+
+            response = await jp_fetch("jupyterlab_slurm", "scancel", method="DELETE", allow_nonstandard_methods=True,
+                                      headers={"Content-Type": "application/json"},
+                                      body=json.dumps({"jobIDs": ["1001", "1002_[1-4]"]}))
+            payload = json.loads(response.body)
+            assert [(result["jobID"], result["returncode"]) for result in payload["results"]] == [
+                ("1001", 0), ("1002_[1-4]", 1)
+            ]
+
+            response = await jp_fetch("jupyterlab_slurm", "sbatch", method="POST", params={"inputType": "contents"},
+                                      headers={"Content-Type": "text/plain"}, body="#!/bin/sh\nhostname\n")
+            assert json.loads(response.body)["returncode"] == 0
+        finally:
+            server.stop()
+
+        assert ("DELETE", "1001", "secret") in requests
+        # the job gets a minimal environment, not the server's tokens
+        submit = next(request[2] for request in requests if request[:2] == ("POST", "submit"))
+        assert submit["script"] == "#!/bin/sh\nhostname\n"
+        assert {variable.split("=")[0] for variable in submit["job"]["environment"]} <= {
+            "PATH", "HOME", "USER", "LOGNAME", "SHELL", "LANG", "LC_ALL", "TZ"
+        }
+        # no Slurm command ran, and requests reused pooled connections
+        assert command_calls(slurm_bin, "squeue") == 0
+        assert command_calls(slurm_bin, "scancel") == 0
+        assert len(connections) <= 2
+
+
+class TestClusters:
+    @pytest.fixture
+    def slurm_config(self, slurm_bin):
+        # beta has its own (slow) squeue, alpha is reached with -M
+        write_stub(slurm_bin / "beta_squeue", "sleep 1.5\n")
+        return {
+            "clusters": {"alpha": {}, "beta": {"squeue_path": str(slurm_bin / "beta_squeue")}},
+            "cluster_timeout": 0.3
+        }
+
+    async def test_clusters_fan_out(self, jp_fetch, slurm_bin):
+        args = slurm_bin / "args"
+        write_stub(slurm_bin / "squeue", "echo \"CLUSTER: $2\"\necho \"1001 debug job_a alice R 1:00 1 nid001\"\n")
+        write_stub(slurm_bin / "scancel", "echo \"$@\" >> {}\n".format(args))
+        write_stub(slurm_bin / "sinfo", "echo \"nid001|debug*|idle|0/64/0/64|256000|250000|(null)\"\n")
+
+        start = time.monotonic()
+        response = await jp_fetch("jupyterlab_slurm", "squeue", params={"userOnly": "false"})
+        payload = json.loads(response.body)
+
+        # beta's slice is missing, not the whole response
+        assert time.monotonic() - start < 1.5
+        assert payload["squeue"]["returncode"] == 0
+        assert payload["data"] == [["1001", "debug", "job_a", "alice", "R", "1:00", "1", "nid001", "alpha"]]
+        assert payload["squeue"]["clusters"]["alpha"]["returncode"] == 0
+        assert "no answer" in payload["squeue"]["clusters"]["beta"]["errorMessage"]
+
+        await jp_fetch("jupyterlab_slurm", "scancel", method="DELETE", allow_nonstandard_methods=True,
+                       params={"cluster": "alpha"}, headers={"Content-Type": "application/json"},
+                       body=json.dumps({"jobID": "1001"}))
+        assert args.read_text() == "-M alpha 1001\n"
+
+        response = await jp_fetch("jupyterlab_slurm", "sinfo")
+        payload = json.loads(response.body)
+        assert [(partition["cluster"], partition["partition"]) for partition in payload["partitions"]] == [
+            ("alpha", "debug"), ("beta", "debug")
+        ]
+
+
+def test_clusters_reject_unknown_settings():
+    with pytest.raises(TraitError, match="backend"):
+        SlurmCommandPaths(clusters={"beta": {"backend": "slurmrestd"}})
+
+
+class TestSecrets:
+    @pytest.fixture
+    def slurm_config(self):
+        return {"slurmrestd_token": "alpha-jwt", "clusters": {"beta": {"slurmrestd_token": "beta-jwt"}}}
+
+    @pytest.fixture
+    def jp_server_config(self, jp_server_config):
+        return dict(jp_server_config, ServerApp=dict(jp_server_config["ServerApp"], log_level="DEBUG"))
+
+    async def test_token_is_not_logged(self, jp_serverapp):
+        records = []
+
+        class Capture(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        # the settings are logged when the extension loads, so load it again with the log captured
+        capture = Capture(level=logging.DEBUG)
+        jp_serverapp.log.addHandler(capture)
+        try:
+            _load_jupyter_server_extension(jp_serverapp)
+        finally:
+            jp_serverapp.log.removeHandler(capture)
+
+        messages = [record.getMessage() for record in records]
+        assert any("slurmrestd_token" in message for message in messages)
+        assert not any("-jwt" in message for message in messages)
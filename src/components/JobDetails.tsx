@@ -0,0 +1,105 @@
+import React from 'react';
+import { Spinner, Table } from 'react-bootstrap';
+import { ExpanderComponentProps } from 'react-data-table-component';
+
+// Local
+import { requestAPI } from '../handler';
+
+namespace types {
+  export type Props = ExpanderComponentProps<Record<string, unknown>>;
+
+  /**
+   * One job's scontrol show job output, one record per array task
+   */
+  export type JobDetail = {
+    jobID: string;
+    returncode: number;
+    errorMessage: string;
+    records: Record<string, string>[];
+  };
+
+  export type State = {
+    loading: boolean;
+    errorMessage: string;
+    records: Record<string, string>[];
+  };
+}
+
+/*
+ * The details of a job (scontrol show job), shown when its row in the
+ * queue table is expanded. The server caches them until the job changes,
+ * so expanding rows again is cheap.
+ */
+export default class JobDetails extends React.Component<
+  types.Props,
+  types.State
+> {
+  private unmounted = false;
+
+  constructor(props: types.Props) {
+    super(props);
+    this.state = {
+      loading: true,
+      errorMessage: '',
+      records: []
+    };
+  }
+
+  componentDidMount(): void {
+    const jobID = String(this.props.data.jobID);
+    const params = new URLSearchParams({ jobID });
+    if (this.props.data.cluster) {
+      params.set('cluster', String(this.props.data.cluster));
+    }
+    requestAPI<{ jobs: types.JobDetail[] }>('scontrol/show', params)
+      .then(result => {
+        const job = result.jobs[0];
+        if (!this.unmounted) {
+          this.setState({
+            loading: false,
+            errorMessage: job.returncode === 0 ? '' : job.errorMessage,
+            records: job.records
+          });
+        }
+      })
+      .catch(error => {
+        console.error('JobDetails error', jobID, error);
+        if (!this.unmounted) {
+          this.setState({ loading: false, errorMessage: String(error) });
+        }
+      });
+  }
+
+  componentWillUnmount(): void {
+    this.unmounted = true;
+  }
+
+  render(): React.ReactNode {
+    if (this.state.loading) {
+      return <Spinner animation="border" size="sm" />;
+    }
+    if (this.state.errorMessage) {
+      return (
+        <div className={'jp-SlurmWidget-job-details'}>
+          {this.state.errorMessage}
+        </div>
+      );
+    }
+    return (
+      <div className={'jp-SlurmWidget-job-details'}>
+        {this.state.records.map(record => (
+          <Table key={record.JobId} size="sm" borderless>
+            <tbody>
+              {Object.entries(record).map(([key, value]) => (
+                <tr key={key}>
+                  <th>{key}</th>
+                  <td>{value}</td>
+                </tr>
+              ))}
+            </tbody>
+          </Table>
+        ))}
+      </div>
+    );
+  }
+}
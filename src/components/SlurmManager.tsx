@@ -5,7 +5,7 @@ import { v4 as uuidv4 } from 'uuid';
 import { uniqueId } from 'lodash';
 
 // Local
-import { requestAPI } from '../handler';
+import { requestAPI, retryAfter } from '../handler';
 import SqueueDataTable from './SqueueDataTable';
 import JobSubmitForm from './JobSubmitForm';
 import { ISlurmUserSettings, JobAction } from '../types';
@@ -14,6 +14,12 @@ namespace types {
   // Delineate vs request status
   export type JobStatus = 'sent' | 'received' | 'error';
   export type RequestStatusTable = Map<string, JobStatus>;
+  // Status of one job in a scancel/scontrol request
+  export type JobResult = {
+    jobID: string;
+    returncode: number;
+    errorMessage: string;
+  };
 
   export type Props = {
     filebrowser: FileBrowser;
@@ -115,37 +121,61 @@ export default class SlurmManager extends React.Component<
   private async makeJobRequest(
     route: string,
     method: string,
-    jobID: string
+    jobIDs: string[],
+    cluster?: string
   ): Promise<void> {
     const requestID = uuidv4();
-    const body = JSON.stringify({ jobID: jobID });
+    const body = JSON.stringify({ jobIDs: jobIDs });
+    const params = new URLSearchParams();
+    if (cluster) {
+      params.set('cluster', cluster);
+    }
 
+    //console.log(`Request for ${method} ${route}`);
+    this.requestStatusTable.set(requestID, 'sent');
+    let result: any;
     try {
-      //console.log(`Request for ${method} ${route}`);
-      this.requestStatusTable.set(requestID, 'sent');
-      requestAPI<any>(route, new URLSearchParams(), {
+      result = await requestAPI<any>(route, params, {
         body: body,
         method: method,
         headers: { 'Content-Type': 'application/json' }
-      }).then(async result => {
-        //console.log('makeJobRequest()', result);
-
-        if (result.returncode === 0) {
-          this.addAlert(result.responseMessage, 'success');
-          this.requestStatusTable.set(requestID, 'received');
-          // trigger a refresh of the table
-          this.setState({ reloadQueue: true });
-        } else {
-          console.error(result.errorMessage);
-          this.addAlert(result.errorMessage, 'danger');
-          this.requestStatusTable.set(requestID, 'error');
-        }
       });
     } catch (reason) {
+      // e.g. a 503 when too many Slurm commands are already running
+      const wait = retryAfter(reason);
+      const message =
+        wait === undefined
+          ? `Error on ${method} ${route}\n${reason}`
+          : `The server is busy, ${method} ${route} was not run. ` +
+            `Try again in ${Math.ceil(wait / 1000)} s.`;
       console.error(`Error on ${method} ${route}\n${reason}`);
-      this.addAlert(`Error on ${method} ${route}\n${reason}`, 'danger');
+      this.addAlert(message, wait === undefined ? 'danger' : 'warning');
+      this.requestStatusTable.set(requestID, 'error');
+      return;
+    }
+    //console.log('makeJobRequest()', result);
+
+    const results: types.JobResult[] = result.results ?? [];
+    const succeeded = results.filter(job => job.returncode === 0);
+    const failed = results.filter(job => job.returncode !== 0);
+
+    if (result.returncode === 0) {
+      this.addAlert(result.responseMessage, 'success');
+      this.requestStatusTable.set(requestID, 'received');
+    } else {
+      console.error(result.errorMessage);
+      if (failed.length === 0) {
+        this.addAlert(result.errorMessage, 'danger');
+      }
+      failed.forEach(job => {
+        this.addAlert(`${job.jobID}: ${job.errorMessage}`, 'danger');
+      });
       this.requestStatusTable.set(requestID, 'error');
     }
+    if (succeeded.length > 0) {
+      // trigger a refresh of the table
+      this.setState({ reloadQueue: true });
+    }
   }
 
   async processSelectedJobs(
@@ -163,20 +193,26 @@ export default class SlurmManager extends React.Component<
           return { route: 'scontrol/release', method: 'PATCH' };
       }
     })(action);
-    // TODO: Decide if it makes sense to combine requests for fewer calls
-    rows.map(async row => {
-      const jobID = String(row[this.JOBID_IDX]);
+    // all selected jobs of a cluster are sent in a single request
+    const clusters = new Map<string | undefined, string[]>();
+    rows.forEach(row => {
+      const cluster = row.cluster as string | undefined;
+      const jobIDs = clusters.get(cluster) ?? [];
+      jobIDs.push(String(row[this.JOBID_IDX]));
+      clusters.set(cluster, jobIDs);
+    });
+    for (const [cluster, jobIDs] of clusters) {
       this.setState(prevState => {
         return { jobsPending: prevState.jobsPending + 1 };
       });
-      await this.makeJobRequest(route, method, jobID).then(() => {
+      await this.makeJobRequest(route, method, jobIDs, cluster).then(() => {
         if (this.state.jobsPending > 0) {
           this.setState(prevState => {
             return { jobsPending: prevState.jobsPending - 1 };
           });
         }
       });
-    });
+    }
   }
 
   private submitJob(input: string, inputType: string) {
@@ -208,11 +244,18 @@ export default class SlurmManager extends React.Component<
     requestAPI<any>(
       'sbatch',
       new URLSearchParams(`?inputType=${inputType}&outputDir=${outputDir}`),
-      {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ input: contents })
-      }
+      inputType === 'contents'
+        ? {
+            // the script itself is the body, streamed straight to sbatch
+            method: 'POST',
+            headers: { 'Content-Type': 'text/plain; charset=utf-8' },
+            body: contents
+          }
+        : {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ input: contents })
+          }
     )
       .then(result => {
         let reload = true;
@@ -285,6 +328,7 @@ export default class SlurmManager extends React.Component<
               reloadQueue={this.state.reloadQueue}
               reloadRate={this.state.autoReloadRate}
               autoReload={this.state.autoReload}
+              serverSideQueries={this.props.settings.serverSideQueries}
               itemsPerPage={this.props.settings.itemsPerPage}
               itemsPerPageOptions={this.props.settings.itemsPerPageOptions}
             />
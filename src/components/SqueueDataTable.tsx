@@ -20,15 +20,37 @@ import {
   BsTrashFill
 } from 'react-icons/bs';
 import DataTable, {
-  Selector,
+  SortOrder,
   TableColumn,
   TableColumn as IDataTableColumn
 } from 'react-data-table-component';
 
 // Local
-import { requestAPI } from '../handler';
+import JobDetails from './JobDetails';
+import VirtualJobTable from './VirtualJobTable';
+import { connectSocket, requestAPI, retryAfter } from '../handler';
+import { PollScheduler } from '../pollScheduler';
+import { SqueueQueryClient } from '../squeueQuery';
 import { JobAction } from '../types';
 
+/*
+ * Rows of several clusters have the cluster appended, and are identified by
+ * JOBID@CLUSTER as job IDs are only unique within a cluster
+ */
+const CLUSTER_IDX = 8;
+
+// milliseconds without typing in the filter box before the query runs
+const FILTER_DEBOUNCE = 150;
+
+// auto-reload backs off to this many times reloadRate while the queue doesn't
+// change, and polls at the 5 second floor for a few polls after a job action
+const MAX_BACKOFF = 8;
+const TIGHTENED_POLLS = 3;
+
+function rowKey(row: string[]): string {
+  return row.length > CLUSTER_IDX ? `${row[0]}@${row[CLUSTER_IDX]}` : row[0];
+}
+
 namespace types {
   export type Props = {
     availableColumns: string[];
@@ -40,12 +62,22 @@ namespace types {
     reloadQueue: boolean;
     autoReload: boolean;
     reloadRate: number;
+    serverSideQueries?: boolean;
     processJobAction: (
       action: JobAction,
       rows: Record<string, unknown>[]
     ) => void;
   };
 
+  /**
+   * Rows added, changed and removed (by JOBID) since a previous squeue snapshot
+   */
+  export type SqueueDelta = {
+    added: string[][];
+    changed: string[][];
+    removed: string[];
+  };
+
   export type State = {
     rows: string[][];
     selectedRows: Record<string, unknown>[];
@@ -63,6 +95,11 @@ namespace types {
     loading: boolean;
     theme: string;
     observer: MutationObserver;
+    // Only used when the server filters, sorts and pages the rows
+    page: number;
+    totalRows: number;
+    sortColumn: number;
+    sortDirection: SortOrder;
   };
 }
 
@@ -70,10 +107,30 @@ export default class SqueueDataTable extends Component<
   types.Props,
   types.State
 > {
+  // Pushes squeue snapshots from the server while auto-reload is on
+  private squeueSocket: WebSocket | null = null;
+  private unmounted = false;
+  // Version of the squeue snapshot held in state.rows, used to request only changes
+  private squeueVersion: string | null = null;
+  // Table row objects of state.rows, built once per snapshot
+  private items: Record<string, unknown>[] = [];
+  // Filters and sorts state.rows off the main thread
+  private query = new SqueueQueryClient();
+  private filterTimer: number | undefined = undefined;
+  // Polls squeue on auto-reload when the queue isn't pushed over a socket
+  private scheduler: PollScheduler | null = null;
+  // The server's hint of when polling again is worthwhile
+  private nextPollAfter = 0;
+  // Auto-reload is suspended while the document or the panel is hidden
+  private panel = React.createRef<HTMLDivElement>();
+  private panelObserver: IntersectionObserver | null = null;
+  private panelVisible = true;
+  private streamSuspended = false;
+
   constructor(props: types.Props) {
     super(props);
 
-    this.sortRows = this.sortRows.bind(this);
+    this.updateActivity = this.updateActivity.bind(this);
 
     let reloadRate = this.props.reloadRate;
     if (this.props.reloadRate < 5000) {
@@ -118,10 +175,6 @@ export default class SqueueDataTable extends Component<
           maxWidth: '200px'
         };
 
-        if (x === 'JOBID') {
-          column.sortFunction = this.sortJobID;
-        }
-
         return column;
       }),
       itemsPerPage: this.props.itemsPerPage, // make this prop dependent
@@ -133,7 +186,11 @@ export default class SqueueDataTable extends Component<
       userOnly: props.userOnly,
       loading: false,
       theme: 'default',
-      observer: observer
+      observer: observer,
+      page: 1,
+      totalRows: 0,
+      sortColumn: 0,
+      sortDirection: 'desc'
     };
   }
 
@@ -143,7 +200,13 @@ export default class SqueueDataTable extends Component<
 
   private toggleUserOnly() {
     const { userOnly } = this.state;
-    this.setState({ userOnly: !userOnly });
+    this.setState({ userOnly: !userOnly }, () => {
+      if (this.squeueSocket) {
+        // the stream is specific to the userOnly query
+        this.unsubscribe();
+        this.subscribe();
+      }
+    });
   }
 
   onSelectedRows(rowState: {
@@ -168,6 +231,21 @@ export default class SqueueDataTable extends Component<
   async getData(rateLimit = 0): Promise<string[][]> {
     const { userOnly } = this.state;
     const squeueParams = new URLSearchParams(`userOnly=${userOnly}`);
+    // smaller on the wire, requestAPI turns it back into rows
+    squeueParams.set('format', 'columnar');
+    if (this.props.serverSideQueries) {
+      const { page, itemsPerPage, sortColumn, sortDirection, filterQuery } =
+        this.state;
+      squeueParams.set('offset', String((page - 1) * itemsPerPage));
+      squeueParams.set('limit', String(itemsPerPage));
+      squeueParams.set('sort', String(sortColumn));
+      squeueParams.set('order', sortDirection);
+      if (filterQuery) {
+        squeueParams.set('q', filterQuery);
+      }
+    } else if (this.squeueVersion) {
+      squeueParams.set('since', this.squeueVersion);
+    }
 
     if (rateLimit > 0) {
       const currentDT = new Date();
@@ -187,122 +265,93 @@ export default class SqueueDataTable extends Component<
       .then(data => {
         console.log('SqueueDataTable getData() squeue', squeueParams, data);
 
+        const rows: string[][] = data.delta
+          ? this.applyDelta(this.state.rows, data.delta)
+          : data.data;
+        this.squeueVersion = data.version ?? null;
+        this.nextPollAfter = data.nextPollAfter ?? 0;
+
         this.setState(
           {
             lastSqueueFetch: new Date(),
-            rows: data.data,
+            rows: rows,
+            totalRows: data.total ?? rows.length,
             loading: false
           },
           () => {
-            this.updateDisplayRows();
+            this.indexRows();
             console.log('loading finished');
           }
         );
-        return data.data;
+        return rows;
       })
       .catch(error => {
         console.error('SqueueDataTable getData() error', error);
+        // e.g. a 429 or 503: the next poll waits as long as the server asked
+        this.nextPollAfter = retryAfter(error) ?? 0;
+        this.setState({ loading: false });
         return [];
       });
   }
 
-  private sortJobID(
-    rowA: Record<string, unknown>,
-    rowB: Record<string, unknown>
-  ): 0 | 1 | -1 {
-    // Requires a special sorting for job array strings where it can't be converted to a number
-    const jobIDSpecials = /[0-9][-_[\]]/g;
-    const parts_a = String(rowA.JOBID)
-      .split(jobIDSpecials)
-      .map(x => Number(x));
-    const parts_b = String(rowB.JOBID)
-      .split(jobIDSpecials)
-      .map(x => Number(x));
-    let tot_a = 0;
-    let tot_b = 0;
-    let i;
-
-    for (i = 0; i < parts_a.length; i++) {
-      tot_a += parts_a[i];
-    }
-    for (i = 0; i < parts_b.length; i++) {
-      tot_b += parts_b[i];
+  private applyDelta(rows: string[][], delta: types.SqueueDelta): string[][] {
+    if (
+      delta.added.length === 0 &&
+      delta.changed.length === 0 &&
+      delta.removed.length === 0
+    ) {
+      return rows;
     }
 
-    if (tot_a > tot_b) {
-      return 1;
-    } else if (tot_b > tot_a) {
-      return -1;
-    }
-
-    return 0;
+    const removed = new Set(delta.removed);
+    const changed = new Map(delta.changed.map(row => [rowKey(row), row]));
+    return rows
+      .filter(row => !removed.has(rowKey(row)))
+      .map(row => changed.get(rowKey(row)) ?? row)
+      .concat(delta.added);
   }
 
-  private sortRows(
-    rows: Record<string, unknown>[],
-    selector: Selector<Record<string, unknown>>,
-    direction: string
-  ): Record<string, unknown>[] {
-    function getSortValue(
-      a: Record<string, unknown>,
-      b: Record<string, unknown>
-    ): number {
-      // by default use the standard string comparison for field values
-
-      let val_a = selector(a);
-      let val_b = selector(b);
-
-      // If the field value is a number, convert to number and use that for comparison
-      if (!isNaN(Number(val_a)) && !isNaN(Number(val_b))) {
-        val_a = Number(val_a);
-        val_b = Number(val_b);
-      }
-
-      const greater = val_a > val_b;
-      if (direction === 'desc') {
-        if (greater) {
-          return 1;
-        } else {
-          return -1;
-        }
-      } else {
-        if (greater) {
-          return -1;
-        } else {
-          return 1;
-        }
-      }
+  /**
+   * Build the table's row objects once per snapshot, and in the client-side
+   * mode hand the snapshot to the query worker
+   */
+  private indexRows(): void {
+    const { rows, columns } = this.state;
+    this.items = rows.map((x: string[]) => {
+      const item: Record<string, unknown> = {
+        id: rowKey(x),
+        jobID: x[0],
+        cluster: x[CLUSTER_IDX]
+      };
+      columns.forEach((column, i) => {
+        item[column] = x[i];
+      });
+      return item;
+    });
+    if (!this.props.serverSideQueries) {
+      this.query.load(rows, columns);
     }
-
-    const sorted_rows = rows.slice(0);
-    sorted_rows.sort(getSortValue);
-    return sorted_rows;
+    this.updateDisplayRows();
   }
 
-  private updateDisplayRows() {
-    const displayRows = this.state.rows
-      .filter((row: string[]) => {
-        const filterQuery = this.state.filterQuery.toLowerCase();
-
-        for (const el of row) {
-          if (el.toLowerCase().includes(filterQuery)) {
-            // console.log(`true for ${row}`);
-            return true;
-          }
-        }
-        return false;
-      })
-      .map((x: string[]) => {
-        const item: Record<string, unknown> = { id: x[0] };
-        let i, col, colValue;
-        for (i = 0, col = 0; col < this.state.columns.length; i++, col++) {
-          colValue = this.state.columns[col];
-          item[colValue] = x[i];
-        }
-
-        return item;
-      });
-    this.setState({ displayRows: displayRows });
+  private async updateDisplayRows(): Promise<void> {
+    if (this.props.serverSideQueries) {
+      // already filtered, sorted and paged by the server
+      this.setState({ displayRows: this.items });
+      return;
+    }
+    const { filterQuery, sortColumn, sortDirection } = this.state;
+    const items = this.items;
+    const indices = await this.query.query({
+      q: filterQuery,
+      sortColumn: sortColumn,
+      ascending: sortDirection === 'asc'
+    });
+    if (indices === null || this.unmounted) {
+      // a later query or snapshot replaced this one
+      return;
+    }
+    this.setState({ displayRows: Array.from(indices, i => items[i]) });
   }
 
   async onReloadButtonClick(): Promise<void> {
@@ -333,18 +382,119 @@ export default class SqueueDataTable extends Component<
     //     return () => clearInterval(interval);
     //   }, []);
     // }
+    if (this.unmounted) {
+      return;
+    }
     if (this.state.autoReload) {
-      const reload = async () => {
-        this.setState({ loading: true });
-        await this.getData(this.state.reloadRate);
-        this.setState({ loading: false });
+      if (this.props.serverSideQueries) {
+        // pushed snapshots are full queues, pages are polled instead
+        this.poll();
+      } else {
+        this.subscribe();
+      }
+    }
 
-        setTimeout(reload, this.state.reloadRate);
-      };
-      await reload();
+    document.addEventListener('visibilitychange', this.updateActivity);
+    if (this.panel.current) {
+      // not intersecting while the panel is hidden behind another or detached
+      this.panelObserver = new IntersectionObserver(entries => {
+        this.panelVisible = entries[entries.length - 1].isIntersecting;
+        this.updateActivity();
+      });
+      this.panelObserver.observe(this.panel.current);
+    }
+  }
+
+  /**
+   * Suspend auto-reload while nobody can see the queue, and resume it once
+   * they can again
+   */
+  private updateActivity(): void {
+    const active = document.visibilityState === 'visible' && this.panelVisible;
+    if (this.scheduler) {
+      this.scheduler.setActive(active);
+    }
+    if (!active && this.squeueSocket) {
+      // the server stops polling once its last subscriber leaves
+      this.unsubscribe();
+      this.streamSuspended = true;
+    } else if (active && this.streamSuspended) {
+      this.streamSuspended = false;
+      this.subscribe();
+    }
+  }
+
+  /**
+   * Receive squeue updates pushed by the server instead of polling for them.
+   * Falls back to polling if the stream can't be kept open.
+   */
+  private subscribe(): void {
+    const { userOnly } = this.state;
+    const socket = connectSocket(
+      'squeue/stream',
+      new URLSearchParams(`userOnly=${userOnly}`)
+    );
+
+    socket.onmessage = (event: MessageEvent) => {
+      const data = JSON.parse(event.data);
+      this.squeueVersion = data.version ?? null;
+      this.setState(
+        {
+          lastSqueueFetch: new Date(),
+          rows: data.data,
+          loading: false
+        },
+        () => {
+          this.indexRows();
+        }
+      );
+    };
+    socket.onclose = () => {
+      if (this.squeueSocket === socket) {
+        console.log('squeue stream closed, falling back to polling');
+        this.squeueSocket = null;
+        this.poll();
+      }
+    };
+    this.squeueSocket = socket;
+  }
+
+  private unsubscribe(): void {
+    const socket = this.squeueSocket;
+    this.squeueSocket = null;
+    if (socket) {
+      socket.close();
     }
   }
 
+  private poll(): void {
+    if (this.scheduler || this.unmounted) {
+      return;
+    }
+    const { reloadRate, reloadLimit } = this.state;
+    this.scheduler = new PollScheduler(
+      async () => {
+        const version = this.squeueVersion;
+        await this.getData();
+        return {
+          changed: this.squeueVersion !== version,
+          nextPollAfter: this.nextPollAfter
+        };
+      },
+      {
+        interval: reloadRate,
+        minInterval: reloadLimit,
+        maxInterval: reloadRate * MAX_BACKOFF,
+        backoff: 1.5,
+        tightenedPolls: TIGHTENED_POLLS
+      }
+    );
+    this.scheduler.setActive(
+      document.visibilityState === 'visible' && this.panelVisible
+    );
+    this.scheduler.start();
+  }
+
   async componentDidUpdate(
     prevProps: Readonly<types.Props>,
     prevState: Readonly<types.State>
@@ -363,15 +513,71 @@ export default class SqueueDataTable extends Component<
     // make sure a last attempt is made to reload when all job actions have completed
     if (prevProps.reloadQueue && !this.props.reloadQueue) {
       await this.getData();
+      // and keep an eye on the jobs while they change state
+      if (this.scheduler) {
+        this.scheduler.tighten();
+      }
     }
   }
 
   componentWillUnmount(): void {
+    this.unmounted = true;
+    if (this.scheduler) {
+      this.scheduler.stop();
+    }
+    document.removeEventListener('visibilitychange', this.updateActivity);
+    if (this.panelObserver) {
+      this.panelObserver.disconnect();
+    }
+    window.clearTimeout(this.filterTimer);
+    this.query.dispose();
+    this.unsubscribe();
     this.state.observer.disconnect();
   }
 
   async handleFilter(filter: string): Promise<void> {
-    this.setState({ filterQuery: filter }, this.updateDisplayRows);
+    if (this.props.serverSideQueries) {
+      this.setState({ filterQuery: filter, page: 1 }, () => this.getData());
+    } else {
+      // the box shows every keystroke, the query runs once typing pauses
+      this.setState({ filterQuery: filter });
+      window.clearTimeout(this.filterTimer);
+      this.filterTimer = window.setTimeout(
+        () => this.updateDisplayRows(),
+        FILTER_DEBOUNCE
+      );
+    }
+  }
+
+  private handlePageChange(page: number): void {
+    this.setState({ page: page }, () => this.getData());
+  }
+
+  private handleRowsPerPageChange(itemsPerPage: number, page: number): void {
+    this.setState({ itemsPerPage: itemsPerPage, page: page }, () =>
+      this.getData()
+    );
+  }
+
+  private handleVirtualSort(column: number, direction: SortOrder): void {
+    this.setState({ sortColumn: column, sortDirection: direction }, () =>
+      this.updateDisplayRows()
+    );
+  }
+
+  private handleSort(
+    column: TableColumn<Record<string, unknown>>,
+    direction: SortOrder
+  ): void {
+    const sortColumn = this.state.columns.indexOf(String(column.name));
+    this.setState(
+      {
+        sortColumn: Math.max(sortColumn, 0),
+        sortDirection: direction,
+        page: 1
+      },
+      () => this.getData()
+    );
   }
 
   render(): ReactNode {
@@ -536,29 +742,51 @@ export default class SqueueDataTable extends Component<
           </Row>
         )}
         <Row
+          ref={this.panel}
           className={
             'justify-content-center jp-SlurmWidget-row jp-SlurmWidget-table-row'
           }
         >
-          <DataTable
-            data={this.state.displayRows}
-            columns={this.state.displayColumns}
-            defaultSortFieldId={1}
-            defaultSortAsc={false}
-            sortFunction={this.sortRows}
-            striped
-            highlightOnHover
-            pagination
-            selectableRows
-            clearSelectedRows={this.state.clearSelected}
-            onSelectedRowsChange={this.onSelectedRows.bind(this)}
-            noDataComponent={'No jobs currently queued.'}
-            paginationPerPage={this.state.itemsPerPage}
-            paginationRowsPerPageOptions={this.props.itemsPerPageOptions}
-            theme={this.state.theme}
-            noHeader={true}
-            className={'jp-SlurmWidget-table'}
-          />
+          {this.props.serverSideQueries ? (
+            <DataTable
+              data={this.state.displayRows}
+              columns={this.state.displayColumns}
+              defaultSortFieldId={1}
+              defaultSortAsc={false}
+              paginationServer
+              paginationTotalRows={this.state.totalRows}
+              onChangePage={this.handlePageChange.bind(this)}
+              onChangeRowsPerPage={this.handleRowsPerPageChange.bind(this)}
+              sortServer
+              onSort={this.handleSort.bind(this)}
+              striped
+              highlightOnHover
+              pagination
+              selectableRows
+              expandableRows
+              expandableRowsComponent={JobDetails}
+              clearSelectedRows={this.state.clearSelected}
+              onSelectedRowsChange={this.onSelectedRows.bind(this)}
+              noDataComponent={'No jobs currently queued.'}
+              paginationPerPage={this.state.itemsPerPage}
+              paginationRowsPerPageOptions={this.props.itemsPerPageOptions}
+              theme={this.state.theme}
+              noHeader={true}
+              className={'jp-SlurmWidget-table'}
+            />
+          ) : (
+            // the whole queue is here, only the rows in view are mounted
+            <VirtualJobTable
+              data={this.state.displayRows}
+              columns={this.state.displayColumns}
+              sortColumn={this.state.sortColumn}
+              sortDirection={this.state.sortDirection}
+              onSort={this.handleVirtualSort.bind(this)}
+              clearSelectedRows={this.state.clearSelected}
+              onSelectedRowsChange={this.onSelectedRows.bind(this)}
+              noDataComponent={'No jobs currently queued.'}
+            />
+          )}
         </Row>
       </>
     );
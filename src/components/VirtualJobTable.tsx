@@ -0,0 +1,342 @@
+import React, { Component, ReactNode } from 'react';
+import {
+  BsCaretDownFill,
+  BsCaretUpFill,
+  BsChevronDown,
+  BsChevronRight
+} from 'react-icons/bs';
+import { SortOrder, TableColumn } from 'react-data-table-component';
+
+// Local
+import JobDetails from './JobDetails';
+import config from '../slurm-config/config.json';
+
+type Row = Record<string, unknown>;
+
+// Every row has the same height, so the rows in view follow from the scroll
+// position alone, and expanded rows add a fixed height for their details
+const ROW_HEIGHT = 40;
+const DETAILS_HEIGHT = 240;
+// rows mounted above and below the visible ones, so fast scrolling doesn't
+// show blank space before the next render
+const OVERSCAN = 10;
+
+namespace types {
+  export type SelectedRowsState = {
+    allSelected: boolean;
+    selectedCount: number;
+    selectedRows: Row[];
+  };
+
+  export type Props = {
+    // already filtered and sorted, by sortColumn and sortDirection
+    data: Row[];
+    columns: TableColumn<Row>[];
+    sortColumn: number;
+    sortDirection: SortOrder;
+    onSort: (column: number, direction: SortOrder) => void;
+    clearSelectedRows: boolean;
+    onSelectedRowsChange: (state: SelectedRowsState) => void;
+    noDataComponent: ReactNode;
+  };
+
+  export type State = {
+    scrollTop: number;
+    viewportHeight: number;
+    selected: Set<string>;
+    expanded: Set<string>;
+  };
+}
+
+/*
+ * A table that only mounts the rows in view (plus a few either side), so a
+ * queue of tens of thousands of jobs renders and scrolls as fast as a page of
+ * them. Sorting is left to the owner, like DataTable's sortServer, and the
+ * selection callbacks are the same as DataTable's.
+ */
+export default class VirtualJobTable extends Component<
+  types.Props,
+  types.State
+> {
+  private viewport = React.createRef<HTMLDivElement>();
+  private resizeObserver: ResizeObserver | null = null;
+  // positions of the rows of the current data, by id
+  private positions: { data: Row[] | null; index: Map<string, number> } = {
+    data: null,
+    index: new Map()
+  };
+
+  constructor(props: types.Props) {
+    super(props);
+    this.state = {
+      scrollTop: 0,
+      viewportHeight: 0,
+      selected: new Set(),
+      expanded: new Set()
+    };
+    this.onScroll = this.onScroll.bind(this);
+  }
+
+  componentDidMount(): void {
+    const viewport = this.viewport.current;
+    if (viewport) {
+      this.resizeObserver = new ResizeObserver(() => {
+        this.setState({ viewportHeight: viewport.clientHeight });
+      });
+      this.resizeObserver.observe(viewport);
+      this.setState({ viewportHeight: viewport.clientHeight });
+    }
+  }
+
+  componentDidUpdate(prevProps: Readonly<types.Props>): void {
+    if (this.props.clearSelectedRows && !prevProps.clearSelectedRows) {
+      this.setSelected(new Set());
+    } else if (
+      this.props.data !== prevProps.data &&
+      this.state.selected.size > 0
+    ) {
+      // forget jobs that left the queue (or the filter)
+      const ids = new Set(this.props.data.map(row => String(row.id)));
+      const selected = new Set(
+        [...this.state.selected].filter(id => ids.has(id))
+      );
+      if (selected.size !== this.state.selected.size) {
+        this.setSelected(selected);
+      }
+    }
+  }
+
+  componentWillUnmount(): void {
+    if (this.resizeObserver) {
+      this.resizeObserver.disconnect();
+    }
+  }
+
+  private onScroll(event: React.UIEvent<HTMLDivElement>): void {
+    this.setState({ scrollTop: event.currentTarget.scrollTop });
+  }
+
+  private getPositions(): Map<string, number> {
+    const { data } = this.props;
+    if (this.positions.data !== data) {
+      this.positions = {
+        data: data,
+        index: new Map(data.map((row, i) => [String(row.id), i]))
+      };
+    }
+    return this.positions.index;
+  }
+
+  private setSelected(selected: Set<string>): void {
+    this.setState({ selected: selected });
+    const selectedRows = this.props.data.filter(row =>
+      selected.has(String(row.id))
+    );
+    this.props.onSelectedRowsChange({
+      allSelected:
+        selectedRows.length > 0 &&
+        selectedRows.length === this.props.data.length,
+      selectedCount: selectedRows.length,
+      selectedRows: selectedRows
+    });
+  }
+
+  private toggleRow(id: string): void {
+    const selected = new Set(this.state.selected);
+    if (!selected.delete(id)) {
+      selected.add(id);
+    }
+    this.setSelected(selected);
+  }
+
+  private toggleAll(): void {
+    const { data } = this.props;
+    if (data.length > 0 && this.state.selected.size === data.length) {
+      this.setSelected(new Set());
+    } else {
+      this.setSelected(new Set(data.map(row => String(row.id))));
+    }
+  }
+
+  private toggleExpanded(id: string): void {
+    const expanded = new Set(this.state.expanded);
+    if (!expanded.delete(id)) {
+      expanded.add(id);
+    }
+    this.setState({ expanded: expanded });
+  }
+
+  private handleSort(column: number): void {
+    const { sortColumn, sortDirection } = this.props;
+    this.props.onSort(
+      column,
+      sortColumn === column && sortDirection === 'asc' ? 'desc' : 'asc'
+    );
+  }
+
+  /**
+   * Index of the row at a vertical offset into the table, given the sorted
+   * indices of the expanded rows
+   */
+  private rowAt(y: number, expanded: number[]): number {
+    let extra = 0;
+    for (const i of expanded) {
+      if (y < (i + 1) * ROW_HEIGHT + extra + DETAILS_HEIGHT) {
+        return Math.min(i, Math.floor((y - extra) / ROW_HEIGHT));
+      }
+      extra += DETAILS_HEIGHT;
+    }
+    return Math.floor((y - extra) / ROW_HEIGHT);
+  }
+
+  private gridColumns(): string {
+    // checkbox and expander, then the job's columns
+    return `2rem 2rem repeat(${this.props.columns.length}, minmax(0, 1fr))`;
+  }
+
+  private renderCell(column: TableColumn<Row>, row: Row): ReactNode {
+    const value = column.selector ? String(column.selector(row) ?? '') : '';
+    if (String(column.name).startsWith('NODELIST') && config.cutoff > 0) {
+      if (value.length > config.cutoff) {
+        return (
+          <span title={value}>{value.slice(0, config.cutoff) + '…'}</span>
+        );
+      }
+    }
+    return value;
+  }
+
+  private renderRow(row: Row, top: number): ReactNode {
+    const id = String(row.id);
+    const expanded = this.state.expanded.has(id);
+    const selected = this.state.selected.has(id);
+    return (
+      <div
+        key={id}
+        className={'jp-SlurmWidget-virtual-table-row'}
+        style={{ top: top }}
+      >
+        <div
+          className={
+            'jp-SlurmWidget-virtual-table-grid' +
+            (selected ? ' jp-SlurmWidget-virtual-table-selected' : '')
+          }
+          style={{
+            height: ROW_HEIGHT,
+            gridTemplateColumns: this.gridColumns()
+          }}
+        >
+          <div className={'jp-SlurmWidget-virtual-table-cell'}>
+            <input
+              type="checkbox"
+              checked={selected}
+              onChange={() => this.toggleRow(id)}
+            />
+          </div>
+          <div
+            className={'jp-SlurmWidget-virtual-table-cell'}
+            onClick={() => this.toggleExpanded(id)}
+          >
+            {expanded ? <BsChevronDown /> : <BsChevronRight />}
+          </div>
+          {this.props.columns.map(column => (
+            <div
+              key={String(column.name)}
+              className={
+                'jp-SlurmWidget-virtual-table-cell' +
+                (config.wordbreak
+                  ? ' jp-SlurmWidget-virtual-table-wordbreak'
+                  : '')
+              }
+            >
+              {this.renderCell(column, row)}
+            </div>
+          ))}
+        </div>
+        {expanded && (
+          <div
+            className={'jp-SlurmWidget-virtual-table-details'}
+            style={{ height: DETAILS_HEIGHT }}
+          >
+            <JobDetails data={row} />
+          </div>
+        )}
+      </div>
+    );
+  }
+
+  render(): ReactNode {
+    const rows = this.props.data;
+    const positions = this.getPositions();
+    const { scrollTop, viewportHeight } = this.state;
+    const { sortColumn, sortDirection } = this.props;
+    const expanded = [...this.state.expanded]
+      .map(id => positions.get(id))
+      .filter((i): i is number => i !== undefined)
+      .sort((a, b) => a - b);
+    const offset = (i: number) =>
+      i * ROW_HEIGHT +
+      DETAILS_HEIGHT * expanded.filter(expandedRow => expandedRow < i).length;
+
+    const first = Math.max(this.rowAt(scrollTop, expanded) - OVERSCAN, 0);
+    const last = Math.min(
+      this.rowAt(scrollTop + viewportHeight, expanded) + OVERSCAN,
+      rows.length - 1
+    );
+    const visible = [];
+    for (let i = first; i <= last; i++) {
+      visible.push(this.renderRow(rows[i], offset(i)));
+    }
+
+    const allSelected =
+      rows.length > 0 && this.state.selected.size === rows.length;
+    return (
+      <div className={'jp-SlurmWidget-virtual-table'}>
+        <div
+          className={
+            'jp-SlurmWidget-virtual-table-grid ' +
+            'jp-SlurmWidget-virtual-table-header'
+          }
+          style={{ gridTemplateColumns: this.gridColumns() }}
+        >
+          <div className={'jp-SlurmWidget-virtual-table-cell'}>
+            <input
+              type="checkbox"
+              checked={allSelected}
+              onChange={() => this.toggleAll()}
+            />
+          </div>
+          <div className={'jp-SlurmWidget-virtual-table-cell'} />
+          {this.props.columns.map((column, i) => (
+            <div
+              key={String(column.name)}
+              className={'jp-SlurmWidget-virtual-table-cell'}
+              onClick={() => column.sortable && this.handleSort(i)}
+            >
+              {column.name}
+              {sortColumn === i &&
+                (sortDirection === 'asc' ? (
+                  <BsCaretUpFill />
+                ) : (
+                  <BsCaretDownFill />
+                ))}
+            </div>
+          ))}
+        </div>
+        <div
+          ref={this.viewport}
+          className={'jp-SlurmWidget-virtual-table-body'}
+          onScroll={this.onScroll}
+        >
+          {rows.length === 0 ? (
+            this.props.noDataComponent
+          ) : (
+            <div style={{ position: 'relative', height: offset(rows.length) }}>
+              {visible}
+            </div>
+          )}
+        </div>
+      </div>
+    );
+  }
+}
@@ -72,5 +72,92 @@ export async function requestAPI<T>(
     throw new ServerConnection.ResponseError(response, data.message || data);
   }
 
+  if (data && data.format === 'columnar') {
+    // callers get rows, however the response was encoded
+    data.data = decodeColumns(data.columns);
+    delete data.columns;
+    delete data.format;
+  }
+
   return data;
 }
+
+/**
+ * How long (in ms) the server asked a failed request to wait before it is
+ * retried: the retryAfter field of a busy or rate limited response, or else
+ * its Retry-After header
+ *
+ * @param error the error thrown by requestAPI
+ * @returns The wait in ms, or undefined if the server gave none
+ */
+export function retryAfter(error: unknown): number | undefined {
+  if (!(error instanceof ServerConnection.ResponseError)) {
+    return undefined;
+  }
+  try {
+    const body = JSON.parse(error.message);
+    if (typeof body.retryAfter === 'number') {
+      return body.retryAfter;
+    }
+  } catch (parseError) {
+    // not a JSON body
+  }
+  const header = error.response.headers.get('Retry-After');
+  if (header === null || isNaN(Number(header))) {
+    return undefined;
+  }
+  return Number(header) * 1000;
+}
+
+/**
+ * A column of a columnar response, either dictionary encoded or plain values
+ */
+type EncodedColumn =
+  | { dictionary: string[]; codes: number[] }
+  | { values: string[] };
+
+/**
+ * Turn the columns of a columnar response back into rows
+ *
+ * @param columns the encoded columns
+ * @returns The rows
+ */
+export function decodeColumns(columns: EncodedColumn[]): string[][] {
+  const decoded = columns.map(column =>
+    'dictionary' in column
+      ? column.codes.map(code => column.dictionary[code])
+      : column.values
+  );
+  const length = decoded.length > 0 ? decoded[0].length : 0;
+  const rows: string[][] = new Array(length);
+  for (let i = 0; i < length; i++) {
+    rows[i] = decoded.map(values => values[i]);
+  }
+  return rows;
+}
+
+/**
+ * Open a WebSocket to the API extension
+ *
+ * @param endPoint API websocket end point for the extension
+ * @param urlParams additional URL parameters included for the endpoint
+ * @returns The connected WebSocket
+ */
+export function connectSocket(
+  endPoint = '',
+  urlParams: URLSearchParams = new URLSearchParams()
+): WebSocket {
+  const settings = ServerConnection.makeSettings();
+  const params = new URLSearchParams(urlParams);
+
+  if (settings.appendToken && settings.token !== '') {
+    params.set('token', settings.token);
+  }
+
+  let socketUrl = URLExt.join(settings.wsUrl, 'jupyterlab_slurm', endPoint);
+  if (params.toString().length > 0) {
+    socketUrl = socketUrl + '?' + params.toString();
+  }
+
+  return new settings.WebSocket(socketUrl);
+}
@@ -64,7 +64,8 @@ const extension: JupyterFrontEndPlugin<void> = {
       itemsPerPage: 10,
       itemsPerPageOptions: [10, 15, 20, 25, 30, 40, 50],
       autoReload: false,
-      autoReloadRate: 60000
+      autoReloadRate: 60000,
+      serverSideQueries: false
     };
     function loadSetting(setting: ISettingRegistry.ISettings): void {
       // Read the settings and convert to the correct type
@@ -79,6 +80,8 @@ const extension: JupyterFrontEndPlugin<void> = {
         .composite as boolean;
       parsedSettings.autoReloadRate = setting.get('autoReloadRate')
         .composite as number;
+      parsedSettings.serverSideQueries = setting.get('serverSideQueries')
+        .composite as boolean;
 
       console.log('Loaded UserSettings: ' + parsedSettings);
     }
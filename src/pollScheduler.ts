@@ -0,0 +1,117 @@
+/**
+ * The outcome of one poll: whether anything changed, and the server's hint of
+ * how long (in ms) until polling again is worthwhile
+ */
+export type PollResult = {
+  changed: boolean;
+  nextPollAfter?: number;
+};
+
+export type PollSchedulerOptions = {
+  // the interval while things are changing
+  interval: number;
+  // the interval right after a job action, and the floor for every poll
+  minInterval: number;
+  // the longest interval reached by backing off
+  maxInterval: number;
+  // interval multiplier for each poll that found nothing new
+  backoff: number;
+  // polls at minInterval after a job action
+  tightenedPolls: number;
+};
+
+/**
+ * Runs a poll function on an adaptive schedule: it backs off while nothing
+ * changes, polls quickly for a while after tighten() (e.g. after cancelling
+ * a job), never polls before the server's hint, and is suspended entirely
+ * while inactive (e.g. a hidden tab). There is at most one timer, cleared by
+ * stop().
+ */
+export class PollScheduler {
+  private options: PollSchedulerOptions;
+  private poll: () => Promise<PollResult>;
+  private interval: number;
+  private tightened = 0;
+  private timer: number | undefined = undefined;
+  private running = false;
+  private active = true;
+  private polling = false;
+  // when the next poll is due, even if the scheduler is suspended
+  private due = 0;
+
+  constructor(poll: () => Promise<PollResult>, options: PollSchedulerOptions) {
+    this.poll = poll;
+    this.options = options;
+    this.interval = options.interval;
+  }
+
+  start(): void {
+    this.running = true;
+    this.schedule(0);
+  }
+
+  stop(): void {
+    this.running = false;
+    window.clearTimeout(this.timer);
+    this.timer = undefined;
+  }
+
+  /**
+   * Suspend polling, or resume it (polling at once if a poll came due while
+   * suspended)
+   */
+  setActive(active: boolean): void {
+    if (active === this.active) {
+      return;
+    }
+    this.active = active;
+    if (active) {
+      this.schedule(Math.max(this.due - Date.now(), 0));
+    } else {
+      window.clearTimeout(this.timer);
+      this.timer = undefined;
+    }
+  }
+
+  /**
+   * Poll soon and often: jobs are about to change state
+   */
+  tighten(): void {
+    this.tightened = this.options.tightenedPolls;
+    this.interval = this.options.minInterval;
+    this.schedule(this.options.minInterval);
+  }
+
+  private schedule(delay: number): void {
+    window.clearTimeout(this.timer);
+    this.timer = undefined;
+    this.due = Date.now() + delay;
+    if (this.running && this.active && !this.polling) {
+      this.timer = window.setTimeout(() => this.run(), delay);
+    }
+  }
+
+  private async run(): Promise<void> {
+    this.timer = undefined;
+    this.polling = true;
+    let result: PollResult = { changed: false };
+    try {
+      result = await this.poll();
+    } catch (error) {
+      console.error('PollScheduler poll failed', error);
+    } finally {
+      this.polling = false;
+    }
+
+    const { interval, minInterval, maxInterval, backoff } = this.options;
+    if (this.tightened > 0) {
+      this.tightened -= 1;
+      this.interval = minInterval;
+    } else if (result.changed) {
+      this.interval = interval;
+    } else {
+      this.interval = Math.min(this.interval * backoff, maxInterval);
+    }
+    this.schedule(Math.max(this.interval, result.nextPollAfter ?? 0));
+  }
+}
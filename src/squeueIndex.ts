@@ -0,0 +1,142 @@
+/**
+ * Filtering and sorting of squeue rows, run in a Web Worker (squeueWorker.ts)
+ * so typing in the filter box never waits on them. Everything that can be is
+ * computed once per snapshot: lowercased text to search, and per column sort
+ * keys and sort orders.
+ */
+
+/**
+ * A filter and sort of the rows of a snapshot
+ */
+export type SqueueQuery = {
+  q: string;
+  sortColumn: number;
+  ascending: boolean;
+};
+
+// Array task IDs go up to MaxArraySize (at most 4000001), so base job ID and
+// task fit together in one number, exact up to 2^53
+const TASK_RANGE = 2 ** 23;
+
+// 1234, 1234_5, 1234_[1-10%2] (pending tasks) or 1234+1 (heterogeneous job)
+const jobIDMatcher = /^([0-9]+)(?:_\[?([0-9]+)|\+([0-9]+))?/;
+
+/**
+ * Sort key of a job ID: the job, then its array task or het job component.
+ * A pending task range sorts at its first task, after a plain job ID.
+ */
+export function jobIDSortKey(jobID: string): number {
+  const match = jobIDMatcher.exec(jobID);
+  if (match === null) {
+    return NaN;
+  }
+  const task = match[2] ?? match[3];
+  const offset = task === undefined ? 0 : 1 + Number(task);
+  return Number(match[1]) * TASK_RANGE + offset;
+}
+
+/**
+ * Seconds in a squeue duration: M:SS, H:MM:SS or D-HH:MM:SS
+ */
+export function parseDuration(time: string): number {
+  const [days, clock] = time.includes('-') ? time.split('-', 2) : ['0', time];
+  const parts = clock.split(':').map(Number);
+  if (parts.length < 2 || parts.length > 3 || parts.some(isNaN)) {
+    return NaN;
+  }
+  return (
+    Number(days) * 86400 + parts.reduce((total, part) => total * 60 + part, 0)
+  );
+}
+
+function sortKeys(rows: string[][], column: number, name: string) {
+  const values = rows.map(row => row[column] ?? '');
+  let keys: number[];
+  if (name === 'JOBID') {
+    keys = values.map(jobIDSortKey);
+  } else if (name.startsWith('TIME')) {
+    keys = values.map(parseDuration);
+  } else {
+    keys = values.map(value => (value === '' ? NaN : Number(value)));
+  }
+  return { keys: keys, values: values };
+}
+
+export class SqueueIndex {
+  private rows: string[][];
+  private columns: string[];
+  private haystacks: string[];
+  // row indices in ascending order, per column
+  private orders = new Map<number, Int32Array>();
+  // the last filter, so that typing more of it only searches what it matched
+  private lastQ = '';
+  private lastMatches: Uint8Array | null = null;
+
+  constructor(rows: string[][], columns: string[]) {
+    this.rows = rows;
+    this.columns = columns;
+    // a query can't match across columns
+    this.haystacks = rows.map(row => row.join('\u0000').toLowerCase());
+  }
+
+  /**
+   * Indices of the rows matching q, in sort order
+   */
+  query(query: SqueueQuery): Int32Array {
+    const matches = this.matches(query.q.toLowerCase());
+    const order = this.order(query.sortColumn);
+    const result = new Int32Array(this.rows.length);
+    let count = 0;
+    for (let i = 0; i < order.length; i++) {
+      const row = query.ascending ? order[i] : order[order.length - 1 - i];
+      if (matches === null || matches[row]) {
+        result[count++] = row;
+      }
+    }
+    return result.slice(0, count);
+  }
+
+  private matches(q: string): Uint8Array | null {
+    if (q === '') {
+      return null;
+    }
+    const previous = q.startsWith(this.lastQ) ? this.lastMatches : null;
+    const matches = new Uint8Array(this.rows.length);
+    for (let i = 0; i < this.haystacks.length; i++) {
+      if (previous !== null && !previous[i]) {
+        continue;
+      }
+      matches[i] = this.haystacks[i].includes(q) ? 1 : 0;
+    }
+    this.lastQ = q;
+    this.lastMatches = matches;
+    return matches;
+  }
+
+  private order(column: number): Int32Array {
+    let order = this.orders.get(column);
+    if (order !== undefined) {
+      return order;
+    }
+    const { keys, values } = sortKeys(
+      this.rows,
+      column,
+      this.columns[column] ?? ''
+    );
+    order = Int32Array.from(this.rows.keys());
+    // numbers before text, text in string order, ties in row order
+    order.sort((a, b) => {
+      const numberA = !isNaN(keys[a]);
+      const numberB = !isNaN(keys[b]);
+      if (numberA && numberB) {
+        return keys[a] - keys[b] || a - b;
+      }
+      if (numberA !== numberB) {
+        return numberA ? -1 : 1;
+      }
+      return values[a] < values[b] ? -1 : values[a] > values[b] ? 1 : a - b;
+    });
+    this.orders.set(column, order);
+    return order;
+  }
+}
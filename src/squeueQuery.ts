@@ -0,0 +1,92 @@
+import { SqueueIndex, SqueueQuery } from './squeueIndex';
+import type {
+  SqueueWorkerRequest,
+  SqueueWorkerResponse
+} from './squeueWorker';
+
+/**
+ * Runs filter and sort queries of the current squeue snapshot in a Web Worker.
+ * Only the latest query is answered: ones it replaced resolve to null, and so
+ * do queries of a snapshot replaced while they ran.
+ */
+export class SqueueQueryClient {
+  private worker: Worker | null = null;
+  // used where Web Workers aren't available
+  private index: SqueueIndex | null = null;
+  private generation = 0;
+  private lastID = 0;
+  private waiting = new Map<number, (indices: Int32Array | null) => void>();
+
+  constructor() {
+    try {
+      this.worker = new Worker(new URL('./squeueWorker.js', import.meta.url));
+      this.worker.onmessage = (event: MessageEvent<SqueueWorkerResponse>) => {
+        const { id, generation, indices } = event.data;
+        this.settle(id, generation === this.generation ? indices : null);
+      };
+    } catch (error) {
+      console.warn('SqueueQueryClient: no Web Worker, querying inline', error);
+    }
+  }
+
+  /**
+   * Index a new snapshot, replacing the last one
+   */
+  load(rows: string[][], columns: string[]): void {
+    this.generation += 1;
+    if (this.worker) {
+      const request: SqueueWorkerRequest = {
+        type: 'load',
+        generation: this.generation,
+        rows: rows,
+        columns: columns
+      };
+      this.worker.postMessage(request);
+    } else {
+      this.index = new SqueueIndex(rows, columns);
+    }
+  }
+
+  /**
+   * Indices of the snapshot's rows matching the query, in order
+   */
+  query(query: SqueueQuery): Promise<Int32Array | null> {
+    const id = ++this.lastID;
+    // everything still waiting is stale now
+    for (const waiting of this.waiting.keys()) {
+      this.settle(waiting, null);
+    }
+    const worker = this.worker;
+    if (!worker) {
+      return Promise.resolve(this.index ? this.index.query(query) : null);
+    }
+    const request: SqueueWorkerRequest = {
+      type: 'query',
+      id: id,
+      generation: this.generation,
+      query: query
+    };
+    return new Promise(resolve => {
+      this.waiting.set(id, resolve);
+      worker.postMessage(request);
+    });
+  }
+
+  dispose(): void {
+    for (const waiting of this.waiting.keys()) {
+      this.settle(waiting, null);
+    }
+    if (this.worker) {
+      this.worker.terminate();
+      this.worker = null;
+    }
+  }
+
+  private settle(id: number, indices: Int32Array | null): void {
+    const resolve = this.waiting.get(id);
+    if (resolve) {
+      this.waiting.delete(id);
+      resolve(indices);
+    }
+  }
+}
@@ -0,0 +1,56 @@
+import { SqueueIndex, SqueueQuery } from './squeueIndex';
+
+/**
+ * Messages from SqueueQueryClient: a new snapshot to index, or a query of the
+ * last one
+ */
+export type SqueueWorkerRequest =
+  | { type: 'load'; generation: number; rows: string[][]; columns: string[] }
+  | { type: 'query'; id: number; generation: number; query: SqueueQuery };
+
+export type SqueueWorkerResponse = {
+  id: number;
+  generation: number;
+  indices: Int32Array;
+};
+
+const ctx = self as unknown as Worker;
+
+let index: SqueueIndex | null = null;
+let generation = -1;
+// only the latest query waiting to run is answered, ones it replaced are stale
+let pending: { id: number; generation: number; query: SqueueQuery } | null =
+  null;
+
+function runPending(): void {
+  const request = pending;
+  pending = null;
+  if (request === null || index === null) {
+    return;
+  }
+  if (request.generation !== generation) {
+    // asked of a snapshot that has since been replaced
+    return;
+  }
+  const indices = index.query(request.query);
+  const response: SqueueWorkerResponse = {
+    id: request.id,
+    generation: generation,
+    indices: indices
+  };
+  ctx.postMessage(response, [indices.buffer]);
+}
+
+ctx.onmessage = (event: MessageEvent<SqueueWorkerRequest>) => {
+  const request = event.data;
+  if (request.type === 'load') {
+    index = new SqueueIndex(request.rows, request.columns);
+    generation = request.generation;
+  } else {
+    if (pending === null) {
+      // run after any queries already posted, so they can replace this one
+      setTimeout(runPending, 0);
+    }
+    pending = request;
+  }
+};
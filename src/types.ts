@@ -8,6 +8,7 @@ export interface ISlurmUserSettings {
   itemsPerPageOptions: Array<number>;
   autoReload: boolean;
   autoReloadRate: number;
+  serverSideQueries: boolean;
 }
 
 export type JobAction = 'kill' | 'hold' | 'release';